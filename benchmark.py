@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Benchmark de envio ponta a ponta
+Sobe um servidor falso da API do Telegram no próprio processo (sendMessage,
+sendPhoto e getMe) e roda campanhas sintéticas pelo caminho real de envio
+(_sending_loop → MessageSender → MessageQueue/CampaignStore), medindo
+mensagens/s, latência p50/p99, pico de RSS e bytes gravados em disco
+
+Uso:
+    python benchmark.py                                  # 1k, 10k e 100k linhas
+    python benchmark.py --rows 1000000 --latency-ms 50 --rate-429 0.01
+    python benchmark.py --rows 10000 --rate-5xx 0.02 --rate-timeout 0.001 --json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import subprocess
+import tempfile
+from collections import Counter
+from typing import Dict, List, Optional, Any, Tuple
+
+# Campanhas padrão (linhas); cada uma roda em um subprocesso para medir o RSS isolado
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+class FakeBotAPI:
+    """
+    Servidor HTTP/1.1 (keep-alive) que imita a API do Telegram
+    Cada requisição pode atrasar (latência + jitter), responder 429 com
+    retry_after, falhar com 5xx ou não responder a tempo (timeout)
+    """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_429: float = 0,
+                 retry_after: int = 1, rate_5xx: float = 0, rate_timeout: float = 0,
+                 hang_seconds: float = 5, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_5xx = rate_5xx
+        self.rate_timeout = rate_timeout
+        self.hang_seconds = hang_seconds
+        self.random = random.Random(seed)
+        self.requests: Counter = Counter()  # por método
+        self.responses: Counter = Counter()  # por status HTTP
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.port = 0
+        self._writers = set()
+        self._message_id = 0
+
+    @property
+    def url(self) -> str:
+        """Base para MessageSender.API_URL"""
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self.server.wait_closed()
+
+    async def _reply(self, method: str) -> Tuple[int, Dict[str, Any]]:
+        """Status HTTP e corpo JSON para o método chamado"""
+        self.requests[method] += 1
+        draw = self.random.random()
+        if draw < self.rate_timeout:
+            await asyncio.sleep(self.hang_seconds)  # cliente desiste antes
+            return 504, {'ok': False, 'error_code': 504, 'description': 'Gateway Timeout'}
+        draw -= self.rate_timeout
+
+        delay = self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if draw < self.rate_429:
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }
+        draw -= self.rate_429
+        if draw < self.rate_5xx:
+            return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}}
+        if method in ('sendMessage', 'sendPhoto'):
+            self._message_id += 1
+            message = {'message_id': self._message_id, 'date': int(time.time())}
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': f'bench-photo-{self._message_id}', 'width': 90, 'height': 90}]
+            return 200, {'ok': True, 'result': message}
+        return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)  # corpo (JSON ou multipart) é descartado
+
+                path = request_line.decode('latin-1').split()[1]
+                status, body = await self._reply(path.rsplit('/', 1)[-1])
+                self.responses[status] += 1
+                payload = json.dumps(body).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, IndexError):
+            pass  # cliente fechou a conexão (ex.: timeout)
+        except asyncio.CancelledError:
+            pass  # servidor encerrado com conexões keep-alive abertas
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+class _FakeBot:
+    """Bot do admin: notificações e relatório são descartados"""
+
+    class _Message:
+        message_id = 1
+
+    async def send_message(self, *args, **kwargs):
+        return _FakeBot._Message()
+
+    async def edit_message_text(self, *args, **kwargs):
+        return None
+
+    async def send_document(self, *args, **kwargs):
+        return None
+
+
+class _FakeContext:
+    def __init__(self):
+        self.bot = _FakeBot()
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    """Percentil (nearest-rank) de uma lista já ordenada"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def _disk_write_bytes() -> Optional[int]:
+    """Bytes gravados pelo processo na camada de armazenamento (Linux)"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _dir_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def _synthetic_rows(count: int, bots: int):
+    """Linhas da campanha: destinos únicos distribuídos entre os bots"""
+    for i in range(count):
+        yield {
+            'api_key': f'{100000 + i % bots}:BENCH',
+            'chat_id': str(-1000000000000 - i),
+            'mensagem': f'Mensagem de benchmark {i}'
+        }
+
+
+async def run_campaign(rows: int, api: FakeBotAPI, bots: int = 100, batch_size: int = 100,
+                       max_in_flight: int = 10, rate_limit: bool = True, client_timeout: float = 2,
+                       retry_delay: float = 0.05, work_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Roda uma campanha sintética pelo loop de envio real contra o servidor falso
+    Banco e relatório ficam em work_dir (temporário se não informado)
+    retry_delay substitui RETRY_BASE_DELAY, para que os reenvios não dominem o tempo medido
+    """
+    import handlers
+    import utils
+    from config import INGEST_CHUNK_SIZE
+    from handlers import BotHandlers, user_sessions
+    from utils import CampaignStore, MessageQueue, MessageSender, CampaignControl, RateLimiter, RetryPolicy
+    log_level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARNING)  # logs por linha distorcem a medição
+
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='bench_')
+    os.makedirs(os.path.join(work_dir, 'reports'), exist_ok=True)
+
+    saved = (CampaignStore._default, utils.REPORTS_DIR, utils.HTTP_TIMEOUT,
+             MessageSender.API_URL, handlers.rate_limiter, handlers.retry_policy)
+    store = CampaignStore(os.path.join(work_dir, 'campaigns.db'))
+    CampaignStore._default = store
+    utils.REPORTS_DIR = os.path.join(work_dir, 'reports')
+    utils.HTTP_TIMEOUT = client_timeout
+    MessageSender.API_URL = api.url
+    if not rate_limit:
+        handlers.rate_limiter = RateLimiter(bot_rate=1e9, chat_interval=0)
+    handlers.retry_policy = RetryPolicy(base_delay=retry_delay, max_delay=retry_delay * 16)
+    await MessageSender.close()  # novo cliente com o timeout do benchmark
+
+    user_id = 'benchmark'
+    written_before = _disk_write_bytes()
+    try:
+        # Ingestão em blocos, como na leitura da planilha
+        started = time.perf_counter()
+        campaign_id = store.create_campaign(user_id)
+        queue = MessageQueue(store, campaign_id)
+        chunk = []
+        for row in _synthetic_rows(rows, bots):
+            chunk.append(row)
+            if len(chunk) >= INGEST_CHUNK_SIZE:
+                queue.ingest(chunk)
+                chunk = []
+        if chunk:
+            queue.ingest(chunk)
+        ingest_seconds = time.perf_counter() - started
+
+        user_sessions.update_session(user_id, {
+            'authenticated': True,
+            'campaign_id': campaign_id,
+            'messages_queue': queue,
+            'current_config': {'interval': 0, 'batch_size': batch_size, 'max_in_flight': max_in_flight},
+            'selected_template': None,
+            'sending_active': True
+        })
+
+        started = time.perf_counter()
+        await BotHandlers._sending_loop(_FakeContext(), user_id, 'pt-BR', CampaignControl(), campaign_id, queue)
+        send_seconds = time.perf_counter() - started
+
+        counts = store.count_by_status(campaign_id)
+        with store.lock:
+            latencies = [
+                value for (value,) in store.conn.execute(
+                    'SELECT latency_ms FROM attempts WHERE campaign_id = ? AND success = 1 '
+                    'AND latency_ms IS NOT NULL ORDER BY latency_ms',
+                    (campaign_id,)
+                )
+            ]
+            attempts = store.conn.execute(
+                'SELECT COUNT(*) FROM attempts WHERE campaign_id = ?', (campaign_id,)
+            ).fetchone()[0]
+            retries = store.conn.execute(
+                'SELECT COALESCE(SUM(retries), 0) FROM rows WHERE campaign_id = ?', (campaign_id,)
+            ).fetchone()[0]
+        sent = counts.get('✅ Enviado', 0)
+        written_after = _disk_write_bytes()
+        stages = (store.get_campaign(campaign_id) or {}).get('config', {}).get('timings', {})
+
+        return {
+            'rows': rows,
+            'sent': sent,
+            'errors': sum(counts.values()) - sent - counts.get('Pendente', 0),
+            'attempts': attempts,
+            'retries': retries,
+            'ingest_seconds': round(ingest_seconds, 3),
+            'send_seconds': round(send_seconds, 3),
+            'messages_per_second': round(sent / send_seconds, 1) if send_seconds else None,
+            'latency_p50_ms': _percentile(latencies, 50),
+            'latency_p99_ms': _percentile(latencies, 99),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'bytes_written': (written_after - written_before) if written_before is not None else None,
+            'disk_bytes': _dir_size(work_dir),
+            'api_requests': dict(api.requests),
+            'api_responses': {str(status): count for status, count in api.responses.items()},
+            'stages': stages
+        }
+    finally:
+        user_sessions.clear_session(user_id)
+        await MessageSender.close()
+        store.close()
+        (CampaignStore._default, utils.REPORTS_DIR, utils.HTTP_TIMEOUT,
+         MessageSender.API_URL, handlers.rate_limiter, handlers.retry_policy) = saved
+        logging.getLogger().setLevel(log_level)
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def _run_single(args) -> Dict[str, Any]:
+    api = FakeBotAPI(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+        retry_after=args.retry_after, rate_5xx=args.rate_5xx, rate_timeout=args.rate_timeout,
+        hang_seconds=args.client_timeout + 1, seed=args.seed
+    )
+    await api.start()
+    try:
+        return await run_campaign(
+            args.rows[0], api, bots=args.bots, batch_size=args.batch_size,
+            max_in_flight=args.max_in_flight, rate_limit=not args.no_rate_limit,
+            client_timeout=args.client_timeout, retry_delay=args.retry_delay
+        )
+    finally:
+        await api.stop()
+
+
+def _print_table(results: List[Dict[str, Any]]):
+    header = f"{'linhas':>9} {'enviadas':>9} {'erros':>7} {'reenvios':>9} {'msg/s':>9} {'p50 ms':>8} {'p99 ms':>8} " \
+             f"{'RSS MB':>8} {'disco MB':>9} {'envio s':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        def fmt(value, spec):
+            return format(value, spec) if value is not None else '—'
+        print(
+            f"{r['rows']:>9} {r['sent']:>9} {r['errors']:>7} {r['retries']:>9} "
+            f"{fmt(r['messages_per_second'], '>9.1f')} "
+            f"{fmt(r['latency_p50_ms'], '>8.1f')} {fmt(r['latency_p99_ms'], '>8.1f')} "
+            f"{r['peak_rss_mb']:>8.1f} {r['disk_bytes'] / 1e6:>9.1f} {r['send_seconds']:>8.1f}"
+        )
+    # Tempo por etapa do loop de envio (StageTimer da campanha)
+    from utils import StageTimer
+    for r in results:
+        if r.get('stages'):
+            print(f"\nTempo por etapa ({r['rows']} linhas)")
+            print(StageTimer.from_dict(r['stages']).format_text())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de envio contra uma API do Telegram simulada')
+    parser.add_argument('--rows', type=int, action='append', help='linhas da campanha (pode repetir)')
+    parser.add_argument('--bots', type=int, default=100, help='bots (api_keys) distintos')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--max-in-flight', type=int, default=None, help='padrão: MAX_IN_FLIGHT do config')
+    parser.add_argument('--latency-ms', type=float, default=20, help='latência simulada da API')
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--rate-429', type=float, default=0, help='fração de respostas 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--rate-5xx', type=float, default=0, help='fração de respostas 502')
+    parser.add_argument('--rate-timeout', type=float, default=0, help='fração de requisições sem resposta')
+    parser.add_argument('--client-timeout', type=float, default=2, help='timeout HTTP do cliente (s)')
+    parser.add_argument('--retry-delay', type=float, default=0.05, help='espera base dos reenvios (s)')
+    parser.add_argument('--no-rate-limit', action='store_true', help='desliga o RateLimiter do bot')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='saída em JSON (uma linha por campanha)')
+    parser.add_argument('--in-process', action='store_true', help='não isolar cada campanha em subprocesso')
+    args = parser.parse_args(argv)
+    args.rows = args.rows or DEFAULT_SIZES
+    if args.max_in_flight is None:
+        from config import DEFAULT_MAX_IN_FLIGHT
+        args.max_in_flight = DEFAULT_MAX_IN_FLIGHT
+    return args
+
+
+def _child_argv(args) -> List[str]:
+    """Opções já interpretadas repassadas a cada subprocesso (exceto --rows e --json)"""
+    forwarded = []
+    for name, value in vars(args).items():
+        if name in ('rows', 'json', 'in_process'):
+            continue
+        option = '--' + name.replace('_', '-')
+        if isinstance(value, bool):
+            if value:
+                forwarded.append(option)
+        else:
+            forwarded.extend([option, str(value)])
+    return forwarded
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = []
+    if len(args.rows) == 1 or args.in_process:
+        for rows in args.rows:
+            args.rows = [rows]
+            results.append(asyncio.run(_run_single(args)))
+    else:
+        # Um subprocesso por campanha: pico de RSS e bytes gravados não se misturam
+        forwarded = _child_argv(args)
+        for rows in args.rows:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--rows', str(rows), '--json', *forwarded],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        _print_table(results)
+
+
+if __name__ == '__main__':
+    main()
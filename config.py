@@ -9,14 +9,77 @@ SYSTEM_PASSWORD = os.getenv('SYSTEM_PASSWORD', 'kangoo@#2019')
 ADMIN_USER_ID = os.getenv('ADMIN_USER_ID')
 
 # Configurações de backup
-BACKUP_FILE = 'backup.json'
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'campaigns.db')  # campanhas, linhas e tentativas (SQLite em modo WAL)
+QUEUE_PAGE_SIZE = 1000  # linhas pendentes carregadas por vez na memória
 REPORTS_DIR = 'reports'
+REPORT_FORMAT = os.getenv('REPORT_FORMAT', 'csv')  # csv, csv.gz ou xlsx
+MEDIA_DIR = 'media'  # fotos de templates (bytes originais, um arquivo por conteúdo)
+MEDIA_FILE_IDS_FILE = 'file_ids.json'  # file_id de cada foto por bot, dentro de MEDIA_DIR
+
+# Sessões de usuário
+SESSION_PERSIST = os.getenv('SESSION_PERSIST', 'true').lower() == 'true'  # sessões autenticadas gravadas no banco (sobrevivem a reinícios)
+SESSION_TTL = 3600  # segundos sem atividade antes de descartar uma sessão não autenticada
+SESSION_MAX_ENTRIES = 10000  # sessões em memória; acima disso as não autenticadas mais antigas saem primeiro
 
 # Configurações de envio
 DEFAULT_INTERVAL = 5  # minutos
 DEFAULT_BATCH_SIZE = 10  # mensagens por ciclo
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', '10'))  # requisições simultâneas por lote (1 = sequencial)
+NOTIFY_EACH_MESSAGE = os.getenv('NOTIFY_EACH_MESSAGE', 'false').lower() == 'true'  # uma notificação por linha (opcional)
+PROGRESS_UPDATE_INTERVAL = 10  # segundos mínimos entre edições da mensagem de progresso
+PROGRESS_MAX_ERRORS = 5  # últimos erros exibidos no progresso
+
+# Supervisão das campanhas
+SUPERVISOR_MAX_RESTARTS = 3  # reinícios de um loop que falhou antes de desistir
+SUPERVISOR_RESTART_DELAY = 5  # segundos (multiplicado pela tentativa)
+SHUTDOWN_TIMEOUT = 30  # segundos para concluir envios em andamento ao desligar
+
+# Limites de taxa da API do Telegram
+BOT_RATE_LIMIT = 30  # mensagens por segundo por bot (api_key)
+CHAT_MIN_INTERVAL = 1.0  # segundos entre mensagens do mesmo bot para o mesmo chat
+CHAT_LIMITER_MAX_ENTRIES = 10000  # chats rastreados antes de limpar os expirados
+RATE_LIMIT_MAX_WAIT = 5  # segundos; pausas maiores devolvem a linha para a fila
+
+# Reenvio de falhas transitórias (timeout, conexão, erro 5xx) com backoff exponencial e jitter
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))  # reenvios de uma linha antes da fila de falhas (0 desativa)
+RETRY_BASE_DELAY = 2  # segundos; dobra a cada reenvio da mesma linha
+RETRY_MAX_DELAY = 300  # segundos; teto da espera entre reenvios
+RETRY_BUDGET_RATIO = 0.1  # reenvios por campanha, proporcional às linhas (mínimo RETRY_BUDGET_MIN)
+RETRY_BUDGET_MIN = 100
+DEAD_DESTINATION_TTL = int(os.getenv('DEAD_DESTINATION_TTL', str(7 * 24 * 3600)))  # segundos que um destino recusado (bot bloqueado, chat inexistente) é pulado; 0 desativa
+
+# Conferência dos tokens da planilha (getMe) antes do envio
+BOT_PREFLIGHT_TTL = 600  # segundos que o resultado do getMe de um token fica em cache
+BOT_PREFLIGHT_MAX_IN_FLIGHT = 20  # getMe simultâneos na conferência
+BOT_PREFLIGHT_TIMEOUT = 5  # segundos por getMe (separado do HTTP_TIMEOUT dos envios)
 MAX_LOGIN_ATTEMPTS = 5
 
+# Configurações de leitura de planilhas
+INGEST_CHUNK_SIZE = 5000  # linhas lidas por bloco (CSV em chunks, XLSX linha a linha)
+INGEST_TRANSACTION_ROWS = 500  # linhas gravadas por transação; entre elas o envio usa o banco
+DEDUP_POLICY = os.getenv('DEDUP_POLICY', 'first')  # linhas repetidas (api_key, chat_id): off, first, drop ou merge
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096  # caracteres; mensagens agrupadas (merge) não passam disso
+
+# Configurações de HTTP (API do Telegram)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+HTTP_TIMEOUT = 30  # segundos
+HTTP_MAX_CONNECTIONS = 100  # conexões simultâneas no pool
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20  # conexões mantidas abertas entre envios
+
+# Recebimento de updates: webhook quando WEBHOOK_URL está definida, senão polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # URL pública (https) chamada pelo Telegram; o caminho vira a rota local
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')  # obrigatório no modo webhook, igual em todas as instâncias
+WEBHOOK_MAX_CONNECTIONS = 40  # conexões simultâneas do Telegram ao webhook (1 a 100)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '8'))  # updates processados em paralelo (em ordem por usuário)
+
+# Métricas (formato Prometheus) e verificação de saúde
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # 0 desativa o endpoint
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # segundos
+EVENT_LOOP_LAG_INTERVAL = 1.0  # segundos entre medições do atraso do event loop
+
 # Idiomas suportados
 SUPPORTED_LANGUAGES = {
     'pt': 'pt-BR',
@@ -25,4 +88,4 @@ SUPPORTED_LANGUAGES = {
 }
 
 # Criar diretórios necessários
-os.makedirs(REPORTS_DIR, exist_ok=True)
\ No newline at end of file
+os.makedirs(REPORTS_DIR, exist_ok=True)
@@ -2,17 +2,23 @@ import asyncio
 import os
 import logging
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Set
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from config import SYSTEM_PASSWORD, MAX_LOGIN_ATTEMPTS
+from config import (
+    SYSTEM_PASSWORD, ADMIN_USER_ID, SUPPORTED_LANGUAGES, MAX_LOGIN_ATTEMPTS, DEFAULT_MAX_IN_FLIGHT, DEDUP_POLICY, NOTIFY_EACH_MESSAGE,
+    SUPERVISOR_MAX_RESTARTS, SUPERVISOR_RESTART_DELAY, SHUTDOWN_TIMEOUT, PROGRESS_MAX_ERRORS
+)
 from translations import get_text, detect_language
+import metrics
 from utils import (
-    BackupManager, SpreadsheetProcessor, MessageSender, 
+    CampaignStore, SpreadsheetProcessor, MessageSender, 
     ReportGenerator, UserSession, validate_number,
-    MessageTemplate, MessageBuilder, LoopManager
+    MessageTemplate, MessageBuilder, LoopManager, RateLimiter, RetryPolicy, BotPreflight,
+    MessageQueue, MediaStore, CampaignProgress, CampaignControl, StageTimer, CallbackRouter,
+    format_duration
 )
 
 logger = logging.getLogger(__name__)
@@ -20,6 +26,15 @@ logger = logging.getLogger(__name__)
 # Instância global para gerenciar sessões
 user_sessions = UserSession()
 
+# Limite de taxa compartilhado por todas as campanhas (por bot e por chat)
+rate_limiter = RateLimiter()
+
+# Backoff e orçamento dos reenvios de falhas transitórias
+retry_policy = RetryPolicy()
+
+# Tokens conferidos com getMe (cache compartilhado por todas as campanhas)
+bot_preflight = BotPreflight()
+
 class BotHandlers:
     """Handlers principais do bot"""
     
@@ -32,9 +47,9 @@ class BotHandlers:
         session = user_sessions.get_session(user_id)
         user_sessions.update_session(user_id, {'language': user_lang})
         
-        # Verificar se há backup
-        backup_data = BackupManager.load_backup()
-        if backup_data and backup_data.get('user_id') == user_id:
+        # Verificar se há campanha interrompida deste usuário
+        store = CampaignStore.default()
+        if store.list_campaigns(user_id, CampaignStore.RESUMABLE) and not session.get('sending_active'):
             await BotHandlers._show_backup_recovery(update, context, user_lang)
         else:
             await BotHandlers._show_login(update, context, user_lang)
@@ -56,6 +71,54 @@ class BotHandlers:
             reply_markup=reply_markup
         )
     
+    @staticmethod
+    def _is_admin(user_id: str) -> bool:
+        """ADMIN_USER_ID quando configurado; senão, qualquer usuário autenticado"""
+        if ADMIN_USER_ID:
+            return user_id == str(ADMIN_USER_ID)
+        return user_sessions.get_session(user_id).get('authenticated', False)
+    
+    @staticmethod
+    async def timings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Handler para comando /timings [campanha]
+        Tempo por etapa das campanhas em envio (ou da campanha informada)
+        Sem ADMIN_USER_ID configurado, cada usuário vê só as próprias campanhas
+        """
+        user_id = str(update.effective_user.id)
+        lang = user_sessions.get_session(user_id).get('language', 'pt-BR')
+        if not BotHandlers._is_admin(user_id):
+            await update.message.reply_text(get_text('admin_only', lang))
+            return
+        sees_all = bool(ADMIN_USER_ID)
+        
+        # Campanhas em envio: acumulado em memória; as demais: gravado no banco
+        timers = {}
+        for session in list(user_sessions.sessions.values()):
+            if not sees_all and session.user_id != user_id:
+                continue
+            if session.get('campaign_id') and session.get('stage_timer') is not None:
+                timers[session['campaign_id']] = session['stage_timer']
+        if context.args:
+            campaign_id = context.args[0]
+            timers = {campaign_id: timers[campaign_id]} if campaign_id in timers else {}
+            if not timers:
+                campaign = CampaignStore.default().get_campaign(campaign_id)
+                if campaign and (sees_all or campaign['user_id'] == user_id) and campaign['config'].get('timings'):
+                    timers[campaign_id] = StageTimer.from_dict(campaign['config']['timings'])
+        
+        if not timers:
+            await update.message.reply_text(get_text('timings_empty', lang))
+            return
+        
+        store = CampaignStore.default()
+        for campaign_id, timer in timers.items():
+            campaign = store.get_campaign(campaign_id) or {}
+            title = get_text('timings_title', lang, campaign_id=f"`{campaign_id}`",
+                             status=campaign.get('status', '—'))
+            await update.message.reply_text(f"{title}\n```\n{timer.format_text()}\n```",
+                                            parse_mode='Markdown')
+    
     @staticmethod
     async def _show_login(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
         """Mostra tela de login"""
@@ -184,23 +247,57 @@ class BotHandlers:
             await update.message.reply_text(text)
             return
         
+        # Um envio por usuário: nova planilha só depois de concluir ou cancelar o atual
+        if session.get('sending_active') or supervisor.is_running(session.get('campaign_id')):
+            await update.message.reply_text(get_text('upload_busy', lang))
+            return
+        
+        # Arquivo e campanha criados aqui são descartados se a leitura em
+        # segundo plano não chegar a recebê-los
+        file_path, campaign_id, handed_off = None, None, False
         try:
             # Download do arquivo
             file = await context.bot.get_file(document.file_id)
             file_path = f"temp_{user_id}_{document.file_name}"
             await file.download_to_drive(file_path)
             
-            # Processar planilha
-            messages = SpreadsheetProcessor.process_file(file_path)
-            
-            # Remover arquivo temporário
-            os.remove(file_path)
+            # Processar primeiro bloco da planilha (o restante é lido em segundo plano)
+            rejected_rows = {}
+            chunks = SpreadsheetProcessor.iter_file(file_path, rejected=rejected_rows)
+            try:
+                messages = await asyncio.to_thread(SpreadsheetProcessor.next_chunk, chunks)
+            except Exception as e:
+                logger.error(f"Erro ao processar planilha: {e}")
+                messages = None
             
             if messages:
+                # Nova campanha em rascunho
+                store = CampaignStore.default()
+                campaign_id = store.create_campaign(user_id, DEDUP_POLICY)
+                messages_queue = MessageQueue(store, campaign_id)
+                # Tokens já recusados (cache) entram separados; os demais são conferidos
+                # em segundo plano, sem atrasar a resposta ao upload
+                api_keys = {row['api_key'] for row in messages}
+                await asyncio.to_thread(messages_queue.ingest, messages,
+                                        invalid_bots=bot_preflight.known_invalid(api_keys))
+                
+                # O rascunho anterior (não enviado) só é descartado com o novo já gravado
+                previous = session.get('campaign_id')
+                if previous and (store.get_campaign(previous) or {}).get('status') == 'draft':
+                    store.delete_campaign(previous)
+                
                 user_sessions.update_session(user_id, {
-                    'messages_queue': messages,
+                    'messages_queue': messages_queue,
+                    'campaign_id': campaign_id,
+                    'ingesting': True,
+                    'rejected_rows': rejected_rows,  # atualizado durante a leitura
                     'state': 'file_uploaded'
                 })
+                supervisor.spawn(BotHandlers._preflight_bots(messages_queue, api_keys),
+                                 f'preflight-{campaign_id}')
+                supervisor.spawn(BotHandlers._ingest_remaining(user_id, chunks, messages_queue, file_path),
+                                 f'ingest-{campaign_id}')
+                handed_off = True
                 
                 text = get_text('upload_success', lang)
                 await update.message.reply_text(text)
@@ -221,6 +318,62 @@ class BotHandlers:
             logger.error(f"Erro ao processar arquivo: {e}")
             text = get_text('upload_error', lang)
             await update.message.reply_text(text)
+        finally:
+            if not handed_off:
+                # Remover arquivo temporário e a campanha que ficou sem planilha
+                if file_path and os.path.exists(file_path):
+                    os.remove(file_path)
+                if campaign_id:
+                    CampaignStore.default().delete_campaign(campaign_id)
+    
+    @staticmethod
+    async def _preflight_bots(messages_queue: MessageQueue, api_keys: Set[str]):
+        """Confere os tokens com getMe e separa as linhas pendentes dos bots inválidos"""
+        try:
+            invalid_bots = await bot_preflight.check(api_keys)
+            messages_queue.set_aside_bots(invalid_bots)
+        except Exception as e:
+            logger.error(f"Erro ao conferir tokens dos bots: {e}")
+    
+    @staticmethod
+    async def _ingest_remaining(user_id: str, chunks, messages_queue: MessageQueue, file_path: str):
+        """Continua a leitura da planilha em segundo plano, alimentando a fila"""
+        session = user_sessions.get_session(user_id)
+        total = messages_queue.total
+        
+        try:
+            while True:
+                chunk = await asyncio.to_thread(SpreadsheetProcessor.next_chunk, chunks)
+                # Parar se a planilha acabou ou se a fila foi substituída
+                if chunk is None or session.get('messages_queue') is not messages_queue:
+                    break
+                
+                # Linhas gravadas numa thread, em transações curtas: o event loop (e o envio
+                # em andamento) não espera pelo bloco; os tokens novos são conferidos em paralelo
+                api_keys = {row['api_key'] for row in chunk}
+                await asyncio.to_thread(messages_queue.ingest, chunk,
+                                        invalid_bots=bot_preflight.known_invalid(api_keys))
+                supervisor.spawn(BotHandlers._preflight_bots(messages_queue, api_keys),
+                                 f'preflight-{messages_queue.campaign_id}')
+                total += len(chunk)
+            
+            # Planilha completa no banco: o rascunho pode ser retomado após um reinício
+            if session.get('messages_queue') is messages_queue:
+                CampaignStore.default().update_campaign(messages_queue.campaign_id, config={'ingested': True})
+            
+            logger.info(
+                f"Processadas {total} mensagens da planilha "
+                f"({messages_queue.collapsed} duplicadas, política {messages_queue.dedup})"
+            )
+        except Exception as e:
+            logger.error(f"Erro ao processar planilha: {e}")
+        finally:
+            if session.get('messages_queue') is messages_queue:
+                user_sessions.update_session(user_id, {'ingesting': False})
+            
+            # Remover arquivo temporário
+            if os.path.exists(file_path):
+                os.remove(file_path)
     
     @staticmethod
     async def _show_config_interval(update_or_query, context: ContextTypes.DEFAULT_TYPE, lang: str):
@@ -267,6 +420,7 @@ class BotHandlers:
             config = session.get('current_config', {})
             config['batch_size'] = batch_size
             user_sessions.update_session(user_id, {'current_config': config})
+            BotHandlers._signal(user_id, 'reconfigure')
             
             await BotHandlers._show_config_summary(update, context, lang)
         else:
@@ -280,12 +434,36 @@ class BotHandlers:
         session = user_sessions.get_session(user_id)
         
         config = session.get('current_config', {})
-        messages_count = len(session.get('messages_queue', []))
+        messages_count = len(session.get('messages_queue') or [])
         
         text = get_text('config_summary', lang, 
                        count=messages_count,
                        interval=config.get('interval', 0),
                        batch=config.get('batch_size', 0))
+        rejected_rows = session.get('rejected_rows')
+        if rejected_rows:
+            details = ', '.join(
+                f"{get_text('reject_' + reason, lang)}: {count}"
+                for reason, count in rejected_rows.items()
+            )
+            text += '\n' + get_text('config_rejected', lang, details=details)
+        messages_queue = session.get('messages_queue')
+        if messages_queue is not None and messages_queue.collapsed:
+            text += '\n' + get_text('config_duplicates', lang,
+                                    count=messages_queue.collapsed,
+                                    policy=messages_queue.dedup)
+        if messages_queue is not None and messages_queue.dead_skipped:
+            text += '\n' + get_text('config_dead_destinations', lang, count=messages_queue.dead_skipped)
+        if messages_queue is not None and messages_queue.invalid_bots:
+            # Só o id numérico do bot, o token nunca aparece
+            details = ', '.join(
+                f"{metrics.bot_label(messages_queue.store.api_key(bot_id))}: {count}"
+                for bot_id, count in sorted(messages_queue.invalid_bots.items(), key=lambda item: -item[1])
+            )
+            text += '\n' + get_text('config_invalid_bots', lang,
+                                    count=sum(messages_queue.invalid_bots.values()), details=details)
+        if session.get('ingesting'):
+            text += '\n' + get_text('config_ingesting', lang)
         
         keyboard = [
             [InlineKeyboardButton(get_text('config_start', lang), callback_data='start_sending')],
@@ -307,95 +485,82 @@ class BotHandlers:
         session = user_sessions.get_session(user_id)
         lang = session.get('language', 'pt-BR')
         
-        data = query.data
-        
-        if data == 'backup_resume':
-            await BotHandlers._resume_from_backup(query, context, lang)
-        elif data == 'backup_cancel':
-            BackupManager.clear_backup()
-            await BotHandlers._show_login(query, context, lang)
-        elif data == 'upload_replace':
-            await BotHandlers._show_upload_prompt(query, context, lang)
-        elif data == 'upload_continue':
-            await BotHandlers._show_config_interval(query, context, lang)
-        elif data == 'upload_cancel':
-            await BotHandlers._show_upload_prompt(query, context, lang)
-        elif data == 'start_sending':
-            await BotHandlers._start_sending_process(query, context, lang)
-        elif data == 'reconfigure':
-            await BotHandlers._show_config_interval(query, context, lang)
-        elif data == 'cancel_config':
-            await BotHandlers._show_upload_prompt(query, context, lang)
-        elif data == 'pause_sending':
-            await BotHandlers._pause_sending(query, context, lang)
-        elif data == 'resume_sending':
-            await BotHandlers._resume_sending(query, context, lang)
-        elif data == 'cancel_sending':
-            await BotHandlers._cancel_sending(query, context, lang)
-        elif data == 'back_to_menu':
-            await BotHandlers._show_upload_prompt(query, context, lang)
-        elif data == 'upload_file':
-            user_sessions.update_session(user_id, {'state': 'awaiting_file'})
-            await query.edit_message_text(get_text('upload_prompt', lang))
-        elif data == 'manage_templates':
-            await BotHandlers._show_template_menu(query, context, lang)
-        elif data == 'manage_loop':
-            await BotHandlers._show_loop_menu(query, context, lang)
-        elif data == 'create_new_template':
-            await BotHandlers._handle_template_creation(query, context)
-        elif data.startswith('select_template_'):
-            template_name = data.replace('select_template_', '')
-            await BotHandlers._handle_template_selection(query, context, template_name)
-        elif data == 'no_template':
-            await BotHandlers._handle_no_template_selection(query, context)
-        elif data.startswith('edit_template_'):
-            template_name = data.replace('edit_template_', '')
-            # TODO: Implementar edição de template existente
-            await query.edit_message_text(f"Editando template: {template_name}")
-        elif data.startswith('delete_template_'):
-            template_name = data.replace('delete_template_', '')
-            if MessageTemplate.delete_template(template_name):
-                text = get_text('template_deleted', lang, name=template_name)
-                await query.edit_message_text(text)
-                await asyncio.sleep(2)
-                await BotHandlers._show_template_menu(query, context, lang)
-        elif data.startswith('new_') or data.startswith('edit_'):
-            await BotHandlers._handle_template_edit_actions(query, context, data)
-        elif data == 'back_to_templates':
-            await BotHandlers._show_template_menu(query, context, lang)
-        elif data == 'enable_loop':
-            await BotHandlers._handle_loop_enable(query, context)
-        elif data == 'disable_loop':
-            await BotHandlers._handle_loop_disable(query, context)
-        elif data == 'config_loop_interval':
-            await BotHandlers._handle_loop_interval_config(query, context)
-        elif data == 'loop_status':
-            await BotHandlers._handle_loop_status(query, context)
-        elif data.startswith('lang_'):
-            # Mudança de idioma
-            new_lang = data.replace('lang_', '')
-            user_sessions.update_session(user_id, {'language': new_lang})
-            
-            text = get_text('login_success', new_lang)
+        # Rota resolvida pela tabela em callback_router (fim do módulo)
+        if not await callback_router.dispatch(query.data or '', query, context, lang):
+            logger.warning(f"Callback sem rota do usuário {user_id}: {query.data!r}")
+    
+    @staticmethod
+    async def _handle_backup_cancel(query, context: ContextTypes.DEFAULT_TYPE, lang: str, param=None):
+        """Descarta a campanha interrompida e volta ao login"""
+        BotHandlers._discard_interrupted(str(query.from_user.id))
+        await BotHandlers._show_login(query, context, lang)
+    
+    @staticmethod
+    async def _handle_upload_request(query, context: ContextTypes.DEFAULT_TYPE, lang: str, param=None):
+        """Aguarda o envio da planilha"""
+        user_sessions.update_session(str(query.from_user.id), {'state': 'awaiting_file'})
+        await query.edit_message_text(get_text('upload_prompt', lang))
+    
+    @staticmethod
+    async def _handle_template_edit_request(query, context: ContextTypes.DEFAULT_TYPE, lang: str,
+                                            template_name: str):
+        """Edição de template existente"""
+        # TODO: Implementar edição de template existente
+        await query.edit_message_text(f"Editando template: {template_name}")
+    
+    @staticmethod
+    async def _handle_template_delete(query, context: ContextTypes.DEFAULT_TYPE, lang: str,
+                                      template_name: str):
+        """Remove template e volta ao menu de templates"""
+        if MessageTemplate.delete_template(template_name):
+            text = get_text('template_deleted', lang, name=template_name)
             await query.edit_message_text(text)
-            
-            # Voltar ao estado atual
-            if session.get('authenticated'):
-                await BotHandlers._show_upload_prompt(query, context, new_lang)
-            else:
-                await BotHandlers._show_login(query, context, new_lang)
+            await asyncio.sleep(2)
+            await BotHandlers._show_template_menu(query, context, lang)
+    
+    @staticmethod
+    async def _handle_language_change(query, context: ContextTypes.DEFAULT_TYPE, lang: str, new_lang: str):
+        """Muda o idioma e volta ao estado atual"""
+        user_id = str(query.from_user.id)
+        user_sessions.update_session(user_id, {'language': new_lang})
+        
+        text = get_text('login_success', new_lang)
+        await query.edit_message_text(text)
+        
+        if user_sessions.get_session(user_id).get('authenticated'):
+            await BotHandlers._show_upload_prompt(query, context, new_lang)
+        else:
+            await BotHandlers._show_login(query, context, new_lang)
+    
+    @staticmethod
+    def _discard_interrupted(user_id: str):
+        """Descarta as campanhas interrompidas do usuário (ficam no banco para consulta)"""
+        store = CampaignStore.default()
+        for campaign in store.list_campaigns(user_id, CampaignStore.RESUMABLE):
+            store.update_campaign(campaign['id'], status='discarded')
+    
+    @staticmethod
+    def _restore_campaign(user_id: str, campaign: Dict[str, Any]) -> Dict[str, Any]:
+        """Dados de sessão para retomar uma campanha do banco"""
+        config = campaign['config']
+        return {
+            'campaign_id': campaign['id'],
+            'messages_queue': MessageQueue(CampaignStore.default(), campaign['id']),
+            'current_config': config.get('current_config', {}),
+            'selected_template': config.get('selected_template'),
+            'ingesting': False,
+            'state': 'sending'
+        }
     
     @staticmethod
     async def _resume_from_backup(query, context: ContextTypes.DEFAULT_TYPE, lang: str):
-        """Resume envio a partir do backup"""
-        backup_data = BackupManager.load_backup()
-        if backup_data:
-            user_id = str(query.from_user.id)
+        """Resume envio da campanha interrompida mais recente"""
+        user_id = str(query.from_user.id)
+        campaigns = CampaignStore.default().list_campaigns(user_id, CampaignStore.RESUMABLE)
+        if campaigns:
             user_sessions.update_session(user_id, {
                 'authenticated': True,
-                'messages_queue': backup_data.get('messages_queue', []),
-                'current_config': backup_data.get('current_config', {}),
-                'state': 'sending'
+                **BotHandlers._restore_campaign(user_id, campaigns[-1])
             })
             
             text = get_text('send_resumed', lang)
@@ -403,33 +568,70 @@ class BotHandlers:
             
             await BotHandlers._start_sending_process(query, context, lang)
     
+    @staticmethod
+    async def _handle_redrive(query, context: ContextTypes.DEFAULT_TYPE, lang: str, campaign_id: str):
+        """Devolve a fila de falhas de uma campanha concluída ao envio"""
+        user_id = str(query.from_user.id)
+        session = user_sessions.get_session(user_id)
+        if not session.get('authenticated'):
+            await BotHandlers._show_login(query, context, lang)
+            return
+        
+        campaign = CampaignStore.default().get_campaign(campaign_id)
+        if campaign is None or campaign['user_id'] != user_id:
+            await query.edit_message_text(get_text('redrive_empty', lang))
+            return
+        
+        # Um envio por usuário: o botão continua disponível para depois
+        if session.get('sending_active') or supervisor.is_running(campaign_id):
+            await context.bot.send_message(user_id, get_text('redrive_busy', lang))
+            return
+        
+        restored = BotHandlers._restore_campaign(user_id, campaign)
+        count = restored['messages_queue'].redrive()
+        if not count:
+            await query.edit_message_text(get_text('redrive_empty', lang))
+            return
+        
+        user_sessions.update_session(user_id, restored)
+        await query.edit_message_text(get_text('redrive_started', lang, count=count))
+        await BotHandlers._start_sending_process(query, context, lang)
+    
     @staticmethod
     async def _start_sending_process(query, context: ContextTypes.DEFAULT_TYPE, lang: str):
         """Inicia processo de envio"""
         user_id = str(query.from_user.id)
         session = user_sessions.get_session(user_id)
-        
-        # Salvar mensagens originais para loop infinito
-        messages_queue = session.get('messages_queue', [])
+        campaign_id = session.get('campaign_id')
+        if not campaign_id or session.get('messages_queue') is None:
+            await BotHandlers._show_upload_prompt(query, context, lang)
+            return
         
         user_sessions.update_session(user_id, {
             'sending_active': True,
             'sending_paused': False,
-            'state': 'sending',
-            'original_messages': messages_queue.copy()  # Para loop infinito
+            'state': 'sending'
         })
         
-        # Salvar backup inicial
-        backup_data = {
-            'user_id': user_id,
-            'messages_queue': session.get('messages_queue', []),
-            'current_config': session.get('current_config', {}),
-            'timestamp': datetime.now().isoformat()
-        }
-        BackupManager.save_backup(backup_data)
+        control = session.get('control')
+        if supervisor.is_running(campaign_id) and control is not None and control.cancelled:
+            # Loop cancelado ainda conclui o lote em andamento: esperar antes de iniciar outro
+            await supervisor.wait_stopped(campaign_id)
         
-        # Iniciar envio em background
-        asyncio.create_task(BotHandlers._sending_loop(context, user_id, lang))
+        if supervisor.is_running(campaign_id):
+            # Campanha já em andamento: um único loop por campanha, apenas retomar
+            if control is not None and control.paused and not control.cancelled:
+                control.resume()
+        else:
+            # Loop de outra campanha (fila substituída por nova planilha) é encerrado
+            previous = session.get('control')
+            if previous:
+                previous.cancel()
+            
+            # Iniciar envio em background (o status da campanha é gravado pelo loop)
+            control = CampaignControl()
+            user_sessions.update_session(user_id, {'control': control})
+            supervisor.start(context, user_id, campaign_id, lang, control, session['messages_queue'])
         
         # Mostrar controles de envio
         await BotHandlers._show_sending_controls(query, context, lang)
@@ -448,183 +650,375 @@ class BotHandlers:
         await query.edit_message_text(text, reply_markup=reply_markup)
     
     @staticmethod
-    async def _sending_loop(context: ContextTypes.DEFAULT_TYPE, user_id: str, lang: str):
-        """Loop principal de envio de mensagens"""
+    async def _sending_loop(context: ContextTypes.DEFAULT_TYPE, user_id: str, lang: str,
+                            control: CampaignControl, campaign_id: str, messages_queue: MessageQueue):
+        """
+        Loop principal de envio de mensagens (controlado por eventos de control)
+        campaign_id e messages_queue (fila no banco, status de cada lote gravado
+        em flush()) vêm de quem inicia o envio, não da sessão: uma nova
+        planilha troca a campanha da sessão sem afetar o envio em andamento
+        """
+        session = user_sessions.get_session(user_id)
+        
+        # Tempo por etapa acumulado desde o início da campanha (inclusive antes de retomá-la)
+        campaign = CampaignStore.default().get_campaign(campaign_id) or {}
+        timer = StageTimer.from_dict(campaign.get('config', {}).get('timings'))
+        user_sessions.update_session(user_id, {'stage_timer': timer})
+        BotHandlers._save_campaign(user_id, campaign_id, lang, control.status)
+        
+        # Uma única mensagem de progresso, editada em intervalo mínimo
+        progress = CampaignProgress()
+        user_sessions.update_session(user_id, {'progress': progress})
+        metrics.queue_depth.set(len(messages_queue), campaign_id)
+        
+        finished = False
+        try:
+            finished = await BotHandlers._run_sending_loop(
+                context, user_id, lang, control, campaign_id, messages_queue, progress, timer
+            )
+        finally:
+            if not finished:
+                # Falha, cancelamento ou desligamento: linhas em envio voltam
+                # para a fila e o status (interrompida) vai para o banco, a não
+                # ser que a campanha já tenha sido concluída
+                messages_queue.release_in_flight()
+                messages_queue.flush()
+                campaign = CampaignStore.default().get_campaign(campaign_id) or {}
+                if campaign.get('status') != 'completed':
+                    BotHandlers._save_campaign(user_id, campaign_id, lang, control.status)
+            if session.get('progress') is progress:
+                user_sessions.update_session(user_id, {'progress': None})
+            if session.get('stage_timer') is timer:
+                user_sessions.update_session(user_id, {'stage_timer': None})
+            metrics.queue_depth.remove(campaign_id)
+    
+    @staticmethod
+    def _save_campaign(user_id: str, campaign_id: str, lang: str, status: str):
+        """Grava status e configuração da campanha (usados para retomá-la)"""
+        session = user_sessions.get_session(user_id)
+        config = {
+            'current_config': session.get('current_config', {}),
+            'selected_template': session.get('selected_template'),
+            'language': lang
+        }
+        if session.get('stage_timer') is not None:
+            config['timings'] = session['stage_timer'].to_dict()
+        CampaignStore.default().update_campaign(campaign_id, status=status, config=config)
+    
+    @staticmethod
+    async def _run_sending_loop(context: ContextTypes.DEFAULT_TYPE, user_id: str, lang: str,
+                                control: CampaignControl, campaign_id: str, messages_queue: MessageQueue,
+                                progress: CampaignProgress, timer: StageTimer):
+        """
+        Envia os lotes até esvaziar a fila ou a campanha ser cancelada
+        Retorna True se a campanha foi concluída
+        
+        Cada etapa do lote é medida em timer (queue_take, template, send_batch,
+        notify, store_flush, progress; MessageSender mede as etapas por linha)
+        """
         session = user_sessions.get_session(user_id)
-        processed_messages = []  # Lista para armazenar mensagens processadas
         
-        while session.get('sending_active') and session.get('messages_queue'):
-            if session.get('sending_paused'):
-                await asyncio.sleep(5)  # Verificar a cada 5 segundos se foi retomado
+        while not control.cancelled:
+            if control.paused:
+                BotHandlers._save_campaign(user_id, campaign_id, lang, 'paused')
+                await control.wait_resumed()  # Acorda assim que retomado ou cancelado
+                if not control.paused:
+                    BotHandlers._save_campaign(user_id, campaign_id, lang, control.status)
                 continue
             
+            if not messages_queue and session.get('ingesting'):
+                await control.wait(1)  # Aguardar próximo bloco da planilha
+                continue
+            
+            # Fila vazia e planilha lida: reinício do loop infinito ou conclusão
+            # (também ao retomar uma campanha cujo último lote já foi gravado)
+            if not messages_queue:
+                loop_config = LoopManager.load_loop_config(user_id)
+                if loop_config and loop_config.get('enabled', False) and messages_queue.total:
+                    # Reiniciar fila com mensagens originais (cursor volta ao início)
+                    await BotHandlers._update_progress(context, user_id, lang, messages_queue, force=True)
+                    messages_queue.reset()
+                    
+                    # Notificar reinício do loop
+                    text = get_text('loop_restarting', lang)
+                    try:
+                        await context.bot.send_message(user_id, text)
+                    except:
+                        pass
+                    
+                    # Aguardar intervalo do loop antes de reiniciar (interrompível)
+                    await control.sleep(
+                        lambda: (LoopManager.load_loop_config(user_id) or {}).get('interval_minutes', 60) * 60
+                    )
+                    continue
+                
+                # Finalizar envio normal
+                await BotHandlers._finish_sending(context, user_id, lang, campaign_id, messages_queue)
+                return True
+            
             config = session.get('current_config', {})
-            interval = config.get('interval', 5) * 60  # converter para segundos
             batch_size = config.get('batch_size', 10)
+            notify_each = config.get('notify_each', NOTIFY_EACH_MESSAGE)
             
             # Enviar lote de mensagens
             messages_sent = 0
-            messages_queue = session.get('messages_queue', [])
+            max_in_flight = config.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT)
             
-            for i in range(min(batch_size, len(messages_queue))):
-                if not session.get('sending_active') or session.get('sending_paused'):
-                    break
+            with timer.measure('queue_take'):
+                indexes = messages_queue.take(batch_size)
+                batch = [messages_queue.row(index) for index in indexes]
+            
+            # Só restam reenvios agendados: esperar o primeiro vencer (sinais acordam antes);
+            # fila vazia volta para a conclusão no início do loop
+            if not indexes:
+                if messages_queue:
+                    await control.wait(messages_queue.next_retry_in() or 1)
+                continue
+            
+            # Verificar se há template selecionado (usar template ao invés da mensagem da planilha)
+            # Resolvido uma vez por lote, a partir do cache em memória
+            template = None
+            selected_template = session.get('selected_template')
+            if selected_template:
+                with timer.measure('template'):
+                    template = MessageTemplate.get_template(selected_template)
+            
+            with timer.measure('send_batch'):
+                results = await MessageSender.send_batch_async(
+                    batch,
+                    template,
+                    max_in_flight=max_in_flight,
+                    should_continue=control.should_continue,
+                    rate_limiter=rate_limiter,
+                    timer=timer
+                )
+            
+            # Linhas não enviadas (pausa/cancelamento) voltam para o início da fila
+            messages_queue.push_front([index for index, result in zip(indexes, results) if result is None])
+            
+            revoked = {}  # api_key -> (error_code, erro) dos tokens recusados neste lote
+            for index, message_data, result in zip(indexes, batch, results):
+                if result is None:
+                    continue
                 
-                message_data = messages_queue.pop(0)
+                failure = MessageSender.classify_error(result)
                 
-                # Verificar se há template selecionado
-                selected_template = session.get('selected_template')
-                if selected_template:
-                    template = MessageTemplate.get_template(selected_template)
-                    if template:
-                        # Usar template ao invés da mensagem da planilha
-                        result = MessageSender.send_template_message(
-                            message_data['api_key'],
-                            message_data['chat_id'],
-                            template
-                        )
-                    else:
-                        # Fallback para mensagem normal
-                        result = MessageSender.send_message(
-                            message_data['api_key'],
-                            message_data['chat_id'],
-                            message_data['mensagem']
-                        )
-                else:
-                    # Enviar mensagem normal
-                    result = MessageSender.send_message(
-                        message_data['api_key'],
-                        message_data['chat_id'],
-                        message_data['mensagem']
-                    )
+                # Bot limitado pela API: linha volta para o fim da fila
+                if failure == 'throttled':
+                    messages_queue.requeue(index, result.get('error'), result.get('error_code'),
+                                           result.get('latency_ms'))
+                    progress.record_requeued()
+                    logger.info(f"Envio para {message_data['chat_id']} adiado por limite de taxa")
+                    continue
+                
+                # Falha transitória: reenvio agendado com backoff, os próximos lotes não esperam
+                if failure == 'transient':
+                    delay = retry_policy.next_delay(messages_queue.retries(index),
+                                                    messages_queue.retries_spent, messages_queue.total)
+                    if delay is not None:
+                        messages_queue.schedule_retry(index, delay, result.get('error'),
+                                                      result.get('error_code'), result.get('latency_ms'))
+                        progress.record_retry()
+                        metrics.retries_scheduled.inc(metrics.bot_label(message_data['api_key']))
+                        continue
                 
-                # Atualizar status
+                # Atualizar status (falhas ficam na fila de falhas da campanha)
                 if result['success']:
-                    message_data['status_envio'] = '✅ Enviado'
-                    message_data['data_hora_envio'] = result['timestamp']
-                    
-                    # Notificar usuário
-                    text = get_text('send_success', lang, chat_id=message_data['chat_id'])
-                    try:
-                        await context.bot.send_message(user_id, text)
-                    except:
-                        pass  # Ignorar erros de notificação
+                    status, sent_at, error = '✅ Enviado', result['timestamp'], None
                 else:
-                    message_data['status_envio'] = f"❌ Erro: {result['error']}"
-                    message_data['erro'] = result['error']
-                    
-                    # Notificar erro
-                    text = get_text('send_error', lang, chat_id=message_data['chat_id'])
-                    try:
-                        await context.bot.send_message(user_id, text)
-                    except:
-                        pass
+                    status, sent_at, error = f"❌ Erro: {result['error']}", None, result['error']
+                    metrics.dead_letters.inc('exhausted' if failure == 'transient' else 'permanent')
+                    # Bot bloqueado/removido ou chat inexistente: próximas linhas para o destino são puladas
+                    if MessageSender.is_dead_destination(result):
+                        messages_queue.remember_dead(index, result.get('error_code'), error)
+                    # Token revogado durante o envio: as demais linhas do bot são separadas
+                    if result.get('error_code') == 401:
+                        revoked[message_data['api_key']] = (401, error)
+                progress.record(result['success'], message_data['chat_id'], error)
                 
-                # Adicionar à lista de processadas
-                processed_messages.append(message_data)
-                messages_sent += 1
-                
-                # Atualizar sessão
-                user_sessions.update_session(user_id, {'messages_queue': messages_queue})
-                
-                # Salvar backup com mensagens processadas
-                backup_data = {
-                    'user_id': user_id,
-                    'messages_queue': messages_queue,
-                    'processed_messages': processed_messages,
-                    'current_config': config,
-                    'timestamp': datetime.now().isoformat()
-                }
-                BackupManager.save_backup(backup_data)
-            
-            # Verificar se ainda há mensagens
-            if not messages_queue:
-                # Verificar se loop infinito está ativo
-                loop_config = LoopManager.load_loop_config(user_id)
-                if loop_config and loop_config.get('enabled', False):
-                    # Reiniciar fila com mensagens originais
-                    original_messages = session.get('original_messages', [])
-                    if original_messages:
-                        user_sessions.update_session(user_id, {
-                            'messages_queue': original_messages.copy()
-                        })
-                        
-                        # Notificar reinício do loop
-                        text = get_text('loop_restarting', lang)
+                # Notificação por linha (opcional; o padrão é só a mensagem de progresso)
+                if notify_each:
+                    key = 'send_success' if result['success'] else 'send_error'
+                    text = get_text(key, lang, chat_id=message_data['chat_id'])
+                    with timer.measure('notify'):
                         try:
                             await context.bot.send_message(user_id, text)
                         except:
-                            pass
-                        
-                        # Aguardar intervalo do loop antes de reiniciar
-                        loop_interval = loop_config.get('interval_minutes', 60)
-                        await asyncio.sleep(loop_interval * 60)
-                        continue
+                            pass  # Ignorar erros de notificação
                 
-                # Finalizar envio normal
-                await BotHandlers._finish_sending(context, user_id, lang)
-                break
+                # Marcar como processada (gravada com o restante do lote)
+                messages_queue.mark(index, status, sent_at, error, result.get('error_code'),
+                                    result.get('latency_ms'))
+                messages_sent += 1
             
-            # Aguardar intervalo
-            if session.get('sending_active') and not session.get('sending_paused'):
-                text = get_text('status_waiting', lang)
-                try:
-                    await context.bot.send_message(user_id, text)
-                except:
-                    pass
-                
-                await asyncio.sleep(interval)
+            # Uma única transação com os resultados do lote
+            with timer.measure('store_flush'):
+                messages_queue.flush()
+                if revoked:
+                    for api_key, (error_code, error) in revoked.items():
+                        bot_preflight.mark_invalid(api_key, error_code, error)
+                    messages_queue.set_aside_bots(revoked)
+            metrics.queue_depth.set(len(messages_queue), campaign_id)
+            
+            # Fila esvaziada: conclusão (ou reinício do loop) no início da próxima volta
+            if not messages_queue and not session.get('ingesting'):
+                continue
+            
+            # Aguardar intervalo (reconfiguração recalcula, pausa/cancelamento interrompem)
+            if control.should_continue():
+                with timer.measure('progress'):
+                    await BotHandlers._update_progress(context, user_id, lang, messages_queue, waiting=True)
+                await control.sleep(lambda: session.get('current_config', {}).get('interval', 5) * 60)
+        
+        return False
+    
+    @staticmethod
+    async def _update_progress(context: ContextTypes.DEFAULT_TYPE, user_id: str, lang: str,
+                               messages_queue: MessageQueue, waiting: bool = False, force: bool = False):
+        """
+        Cria ou edita a mensagem de progresso da campanha (com limite de frequência)
+        Pendentes contados na fila do loop, não na da sessão (que uma nova planilha troca)
+        """
+        session = user_sessions.get_session(user_id)
+        progress = session.get('progress')
+        if not progress or not progress.should_update(force):
+            return
+        
+        pending = len(messages_queue)
+        eta = progress.eta_seconds(pending)
+        text = get_text('progress_message', lang,
+                        sent=progress.sent,
+                        errors=progress.errors,
+                        pending=pending,
+                        rate=f"{progress.rate_per_minute():.1f}",
+                        eta=format_duration(eta) if eta is not None else '—')
+        if progress.retried:
+            text += '\n' + get_text('progress_retries', lang, count=progress.retried)
+        if progress.recent_errors:
+            text += '\n\n' + get_text('progress_recent_errors', lang)
+            for chat_id, error in progress.recent_errors:
+                text += f"\n• {chat_id}: {str(error)[:100]}"
+        if waiting:
+            text += '\n\n' + get_text('status_waiting', lang)
+        
+        try:
+            if progress.message_id is None:
+                message = await context.bot.send_message(user_id, text)
+                progress.message_id = message.message_id
+            else:
+                await context.bot.edit_message_text(text, chat_id=user_id, message_id=progress.message_id)
+        except:
+            pass  # Ignorar erros de notificação (ex.: texto não modificado)
+        progress.mark_updated()
     
     @staticmethod
-    async def _finish_sending(context: ContextTypes.DEFAULT_TYPE, user_id: str, lang: str):
-        """Finaliza processo de envio"""
+    async def _finish_sending(context: ContextTypes.DEFAULT_TYPE, user_id: str, lang: str,
+                              campaign_id: str, messages_queue: MessageQueue):
+        """
+        Finaliza processo de envio da campanha campaign_id
+        A campanha é gravada como concluída antes de qualquer mensagem ao
+        usuário; relatório e notificações são entregues sem garantia
+        """
         session = user_sessions.get_session(user_id)
         
-        # Obter todas as mensagens processadas (incluindo as que deram erro)
-        backup_data = BackupManager.load_backup()
-        all_messages = []
+        # Resultados pendentes de gravação vão para o banco antes do relatório
+        dead_letters = messages_queue.dead_letters()
+        
+        # Campanha concluída continua no banco para consultas
+        store = CampaignStore.default()
+        store.update_campaign(campaign_id, status='completed')
         
-        if backup_data and 'processed_messages' in backup_data:
-            all_messages = backup_data['processed_messages']
+        await BotHandlers._update_progress(context, user_id, lang, messages_queue, force=True)
         
-        # Gerar relatório
-        report_path = ReportGenerator.generate_report(all_messages, user_id)
+        # Relatório lido do banco e gravado em uma thread (não trava o bot),
+        # com o tempo por etapa da campanha na seção de resumo
+        report_path, summary = None, None
+        timer = session.get('stage_timer') or StageTimer()
+        try:
+            with timer.measure('report'):
+                report_path, summary = await ReportGenerator.generate_campaign_report(
+                    store, campaign_id, user_id, timer=timer
+                )
+            store.update_campaign(campaign_id, config={'timings': timer.to_dict()})
+        except Exception as e:
+            logger.error(f"Erro ao gerar relatório da campanha {campaign_id}: {e}")
         
-        # Notificar conclusão
+        # Notificar conclusão (mensagens ao usuário não alteram o estado da campanha)
         text = get_text('completion_success', lang)
-        await context.bot.send_message(user_id, text)
+        if summary:
+            text += '\n\n' + BotHandlers._format_report_summary(summary, lang)
+        try:
+            await context.bot.send_message(user_id, text)
+        except Exception as e:
+            logger.error(f"Erro ao notificar conclusão da campanha {campaign_id}: {e}")
         
         # Enviar relatório
         if report_path and os.path.exists(report_path):
             text = get_text('completion_report', lang)
-            await context.bot.send_document(
-                user_id, 
-                document=open(report_path, 'rb'),
-                caption=text
-            )
+            try:
+                with open(report_path, 'rb') as document:
+                    await context.bot.send_document(user_id, document=document, caption=text)
+            except Exception as e:
+                logger.error(f"Erro ao enviar relatório da campanha {campaign_id}: {e}")
         
-        # Solicitar nova planilha
+        # Solicitar nova planilha (ou reenviar a fila de falhas com um botão)
         text = get_text('completion_new_sheet', lang)
         keyboard = [[InlineKeyboardButton(get_text('btn_new_sheet', lang), callback_data='upload_replace')]]
+        if dead_letters:
+            text = get_text('redrive_prompt', lang, count=dead_letters) + '\n\n' + text
+            keyboard.insert(0, [InlineKeyboardButton(get_text('btn_redrive', lang, count=dead_letters),
+                                                     callback_data=f'redrive_{campaign_id}')])
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(user_id, text, reply_markup=reply_markup)
+        try:
+            await context.bot.send_message(user_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"Erro ao solicitar nova planilha: {e}")
         
-        # Limpar estado
-        user_sessions.update_session(user_id, {
+        # Limpar estado (campanha e fila só se a sessão ainda apontar para esta campanha)
+        updates = {
             'sending_active': False,
             'sending_paused': False,
-            'messages_queue': [],
+            'stage_timer': None,
             'state': 'completed'
-        })
-        
-        # Limpar backup
-        BackupManager.clear_backup()
+        }
+        if session.get('campaign_id') == campaign_id:
+            updates.update({'messages_queue': None, 'campaign_id': None})
+        user_sessions.update_session(user_id, updates)
+    
+    @staticmethod
+    def _format_report_summary(summary, lang: str) -> str:
+        """Resumo do relatório para a mensagem de conclusão"""
+        latency = [summary.percentile(p) for p in (50, 95, 99)]
+        text = get_text('report_summary', lang,
+                        total=summary.total,
+                        sent=summary.sent,
+                        errors=summary.errors,
+                        skipped=summary.skipped,
+                        rate=f"{summary.success_rate:.1f}",
+                        latency=' / '.join('—' if value is None else f"{value:.0f}" for value in latency))
+        if summary.dead:
+            text += '\n' + get_text('report_dead_destinations', lang, count=summary.dead)
+        if summary.invalid_bot:
+            text += '\n' + get_text('report_invalid_bots', lang, count=summary.invalid_bot)
+        if summary.errors_by_code:
+            text += '\n' + get_text('report_errors_by_code', lang)
+            for code, count in summary.errors_by_code.most_common(PROGRESS_MAX_ERRORS):
+                text += f"\n• {code}: {count}"
+        return text
+    
+    @staticmethod
+    def _signal(user_id: str, action: str):
+        """Envia sinal (pause, resume, cancel, reconfigure) à campanha em andamento"""
+        control = user_sessions.get_session(user_id).get('control')
+        if control:
+            getattr(control, action)()
     
     @staticmethod
     async def _pause_sending(query, context: ContextTypes.DEFAULT_TYPE, lang: str):
         """Pausa o envio"""
         user_id = str(query.from_user.id)
         user_sessions.update_session(user_id, {'sending_paused': True})
+        BotHandlers._signal(user_id, 'pause')
         
         text = get_text('send_paused', lang)
         keyboard = [
@@ -640,6 +1034,7 @@ class BotHandlers:
         """Retoma o envio"""
         user_id = str(query.from_user.id)
         user_sessions.update_session(user_id, {'sending_paused': False})
+        BotHandlers._signal(user_id, 'resume')
         
         text = get_text('send_resumed', lang)
         await query.edit_message_text(text)
@@ -656,6 +1051,7 @@ class BotHandlers:
             'sending_paused': False,
             'state': 'cancelled'
         })
+        BotHandlers._signal(user_id, 'cancel')
         
         text = get_text('send_cancelled', lang)
         await query.edit_message_text(text)
@@ -998,6 +1394,7 @@ class BotHandlers:
                         'interval_minutes': interval,
                         'state': 'authenticated'
                     })
+                    BotHandlers._signal(user_id, 'reconfigure')
                     
                     await update.message.reply_text(
                         f"✅ Intervalo configurado para {interval} minutos!"
@@ -1024,10 +1421,19 @@ class BotHandlers:
         if state == 'editing_template_photo':
             # Salvar foto no template temporário
             photo = update.message.photo[-1]  # Maior resolução
-            file_id = photo.file_id
+            
+            # Guardar os bytes: o file_id recebido só vale para este bot
+            try:
+                file = await context.bot.get_file(photo.file_id)
+                content = bytes(await file.download_as_bytearray())
+                photo_ref = MediaStore.save(content)
+                MediaStore.remember(MediaStore.media_id(photo_ref), context.bot.token, photo.file_id)
+            except Exception as e:
+                logger.error(f"Erro ao baixar foto do template: {e}")
+                photo_ref = photo.file_id
             
             temp_template = session.get('temp_template', {})
-            temp_template['photo'] = file_id
+            temp_template['photo'] = photo_ref
             
             user_sessions.update_session(user_id, {
                 'temp_template': temp_template,
@@ -1108,4 +1514,244 @@ class BotHandlers:
         
         # Ir para configuração de intervalo
         await asyncio.sleep(2)
-        await BotHandlers._show_config_interval(query, context, lang)
\ No newline at end of file
+        await BotHandlers._show_config_interval(query, context, lang)
+
+
+class CampaignSupervisor:
+    """
+    Acompanha as tasks de envio (uma por campanha)
+    Reinicia loops que falharam a partir do estado gravado no banco, encerra
+    os envios de forma ordenada no desligamento e retoma as campanhas
+    interrompidas quando o bot inicia
+    """
+    
+    def __init__(self, max_restarts: int = SUPERVISOR_MAX_RESTARTS,
+                 restart_delay: float = SUPERVISOR_RESTART_DELAY):
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self.tasks: Dict[str, asyncio.Task] = {}  # campaign_id -> task do loop
+        self.controls: Dict[str, CampaignControl] = {}
+        self.restarts: Dict[str, int] = {}
+        self.background: Set[asyncio.Task] = set()  # leitura de planilhas e conferência de tokens
+        self.shutting_down = False
+    
+    def is_running(self, campaign_id: str) -> bool:
+        """Indica se a campanha tem loop de envio ativo"""
+        task = self.tasks.get(campaign_id)
+        return task is not None and not task.done()
+    
+    def running(self) -> List[str]:
+        """Campanhas com loop de envio ativo"""
+        return [campaign_id for campaign_id in self.tasks if self.is_running(campaign_id)]
+    
+    def spawn(self, coro, name: str) -> asyncio.Task:
+        """
+        Inicia uma task de apoio acompanhada pelo supervisor: a referência
+        fica guardada até o fim, a falha vai para o log e o desligamento
+        espera por ela
+        """
+        task = asyncio.create_task(coro, name=name)
+        self.background.add(task)
+        task.add_done_callback(self._on_background_done)
+        return task
+    
+    def _on_background_done(self, task: asyncio.Task):
+        self.background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Task {task.get_name()} falhou: {task.exception()}")
+    
+    def start(self, context, user_id: str, campaign_id: str, lang: str,
+              control: CampaignControl, messages_queue: MessageQueue, delay: float = 0):
+        """Inicia (ou reinicia, após delay) o loop de envio da campanha"""
+        task = asyncio.create_task(self._run(context, user_id, campaign_id, lang, control, messages_queue, delay))
+        self.tasks[campaign_id] = task
+        self.controls[campaign_id] = control
+        task.add_done_callback(
+            lambda done: self._on_done(context, user_id, campaign_id, lang, control, messages_queue, done)
+        )
+    
+    async def wait_stopped(self, campaign_id: str):
+        """Espera o loop da campanha terminar (sem propagar a falha dele)"""
+        task = self.tasks.get(campaign_id)
+        if task is not None:
+            await asyncio.wait([task])
+    
+    async def _run(self, context, user_id: str, campaign_id: str, lang: str, control: CampaignControl,
+                   messages_queue: MessageQueue, delay: float):
+        if delay:
+            await control.sleep(delay)
+        await BotHandlers._sending_loop(context, user_id, lang, control, campaign_id, messages_queue)
+    
+    def _on_done(self, context, user_id: str, campaign_id: str, lang: str,
+                 control: CampaignControl, messages_queue: MessageQueue, task: asyncio.Task):
+        if self.tasks.get(campaign_id) is task:
+            del self.tasks[campaign_id]
+        
+        error = None if task.cancelled() else task.exception()
+        if error is None or self.shutting_down or control.cancelled:
+            if error is not None:
+                logger.error(f"Loop da campanha {campaign_id} falhou: {error}")
+            if self.controls.get(campaign_id) is control and campaign_id not in self.tasks:
+                del self.controls[campaign_id]
+                self.restarts.pop(campaign_id, None)
+            return
+        
+        # Os resultados do último lote já foram gravados no banco ao sair do loop
+        session = user_sessions.get_session(user_id)
+        attempts = self.restarts.get(campaign_id, 0) + 1
+        if attempts > self.max_restarts or session.get('control') is not control:
+            logger.error(f"Loop da campanha {campaign_id} falhou: {error}. Campanha não será reiniciada")
+            self.controls.pop(campaign_id, None)
+            self.restarts.pop(campaign_id, None)
+            return
+        
+        self.restarts[campaign_id] = attempts
+        logger.error(
+            f"Loop da campanha {campaign_id} falhou: {error}. "
+            f"Reiniciando do estado gravado (tentativa {attempts})"
+        )
+        self.start(context, user_id, campaign_id, lang, control, messages_queue,
+                   delay=self.restart_delay * attempts)
+    
+    async def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """
+        Desligamento ordenado: nenhum envio novo começa, as requisições em
+        andamento terminam e cada loop grava seu estado (status stopped)
+        """
+        self.shutting_down = True
+        tasks = list(self.tasks.values())
+        for control in self.controls.values():
+            control.stop()
+        
+        # Leituras de planilha em andamento também terminam (ou são canceladas);
+        # rascunho lido pela metade é descartado ao iniciar
+        background = list(self.background)
+        if tasks or background:
+            _, pending = await asyncio.wait(tasks + background, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.info(f"{len(tasks)} campanha(s) encerrada(s) para desligamento")
+    
+    async def resume_interrupted(self, application):
+        """
+        Retoma, em paralelo, a campanha mais recente de cada usuário que foi
+        interrompida (desligamento ou queda), sem esperar o backup_resume
+        """
+        store = CampaignStore.default()
+        
+        # Rascunhos só são mantidos se lidos por completo e ainda ligados a uma
+        # sessão gravada (o usuário continua a configuração de onde parou)
+        referenced = store.session_campaigns() if user_sessions.persist else set()
+        for campaign in store.list_campaigns(statuses=('draft',)):
+            if campaign['id'] not in referenced or not campaign['config'].get('ingested'):
+                store.delete_campaign(campaign['id'])
+        
+        latest = {}
+        for campaign in store.list_campaigns(statuses=CampaignStore.RESUMABLE):
+            latest[campaign['user_id']] = campaign  # a lista vem da mais antiga para a mais recente
+        
+        for user_id, campaign in latest.items():
+            if campaign['status'] not in ('running', 'paused', 'stopped'):
+                continue
+            
+            campaign_id = campaign['id']
+            lang = campaign['config'].get('language', 'pt-BR')
+            control = CampaignControl()
+            control.paused = campaign['status'] == 'paused'
+            restored = BotHandlers._restore_campaign(user_id, campaign)
+            user_sessions.update_session(user_id, {
+                **restored,
+                'language': lang,
+                'sending_active': True,
+                'sending_paused': control.paused,
+                'control': control
+            })
+            self.start(application, user_id, campaign_id, lang, control, restored['messages_queue'])
+            logger.info(f"Campanha {campaign_id} do usuário {user_id} retomada automaticamente")
+            
+            try:
+                await application.bot.send_message(user_id, get_text('campaign_auto_resumed', lang))
+            except Exception:
+                pass  # Ignorar erros de notificação
+
+
+# Supervisor global das campanhas em envio
+supervisor = CampaignSupervisor()
+metrics.active_campaigns.set_function(lambda: len(supervisor.running()))
+
+
+def _template_name(value: str) -> str:
+    """Parâmetro das rotas de template: nome não vazio"""
+    if not value:
+        raise ValueError('Template sem nome')
+    return value
+
+
+def _language_code(value: str) -> str:
+    """Parâmetro de lang_: só idiomas suportados"""
+    if value not in SUPPORTED_LANGUAGES.values():
+        raise ValueError(f"Idioma não suportado: {value}")
+    return value
+
+
+def _campaign_id(value: str) -> str:
+    """Parâmetro de redrive_: id no formato de CampaignStore.new_campaign_id"""
+    if not CampaignStore.ID_PATTERN.fullmatch(value):
+        raise ValueError(f"Campanha inválida: {value}")
+    return value
+
+
+def _build_callback_router() -> CallbackRouter:
+    """Tabela de rotas dos botões inline; handlers recebem (query, context, lang, parâmetro)"""
+    router = CallbackRouter()
+    
+    # Telas que recebem (query, context, lang)
+    for key, handler in (
+        ('backup_resume', BotHandlers._resume_from_backup),
+        ('upload_replace', BotHandlers._show_upload_prompt),
+        ('upload_continue', BotHandlers._show_config_interval),
+        ('upload_cancel', BotHandlers._show_upload_prompt),
+        ('start_sending', BotHandlers._start_sending_process),
+        ('reconfigure', BotHandlers._show_config_interval),
+        ('cancel_config', BotHandlers._show_upload_prompt),
+        ('pause_sending', BotHandlers._pause_sending),
+        ('resume_sending', BotHandlers._resume_sending),
+        ('cancel_sending', BotHandlers._cancel_sending),
+        ('back_to_menu', BotHandlers._show_upload_prompt),
+        ('back_to_main', BotHandlers._show_upload_prompt),
+        ('manage_templates', BotHandlers._show_template_menu),
+        ('manage_loop', BotHandlers._show_loop_menu),
+        ('back_to_templates', BotHandlers._show_template_menu),
+    ):
+        router.add(key, lambda query, context, lang, param, handler=handler: handler(query, context, lang))
+    
+    # Ações que recebem (query, context)
+    for key, handler in (
+        ('create_new_template', BotHandlers._handle_template_creation),
+        ('no_template', BotHandlers._handle_no_template_selection),
+        ('enable_loop', BotHandlers._handle_loop_enable),
+        ('disable_loop', BotHandlers._handle_loop_disable),
+        ('config_loop_interval', BotHandlers._handle_loop_interval_config),
+        ('loop_status', BotHandlers._handle_loop_status),
+    ):
+        router.add(key, lambda query, context, lang, param, handler=handler: handler(query, context))
+    
+    router.add('backup_cancel', BotHandlers._handle_backup_cancel)
+    router.add('upload_file', BotHandlers._handle_upload_request)
+    
+    # Prefixos com parâmetro (o mais longo vence: edit_template_ antes de edit_)
+    router.add_prefix('select_template_', lambda query, context, lang, name:
+                      BotHandlers._handle_template_selection(query, context, name), _template_name)
+    router.add_prefix('edit_template_', BotHandlers._handle_template_edit_request, _template_name)
+    router.add_prefix('delete_template_', BotHandlers._handle_template_delete, _template_name)
+    for prefix in ('new_', 'edit_'):
+        router.add_prefix(prefix, lambda query, context, lang, action, prefix=prefix:
+                          BotHandlers._handle_template_edit_actions(query, context, prefix + action))
+    router.add_prefix('lang_', BotHandlers._handle_language_change, _language_code)
+    router.add_prefix('redrive_', BotHandlers._handle_redrive, _campaign_id)
+    return router
+
+
+# Rotas de handle_callback_query
+callback_router = _build_callback_router()
@@ -96,7 +96,7 @@ def test_configuration():
     try:
         # Testar imports
         from config import BOT_TOKEN
-        from utils import BackupManager
+        from utils import CampaignStore
         from translations import get_text
         
         if not BOT_TOKEN:
@@ -8,7 +8,7 @@ Funcionalidades:
 - Upload de planilhas (CSV/XLSX)
 - Configuração de intervalos e lotes
 - Envio automatizado com notificações
-- Sistema de backup e recuperação
+- Campanhas persistidas em SQLite e recuperação
 - Tratamento de erros com skip automático
 - Relatórios detalhados
 - Interface multilíngue (PT-BR, EN-US, ZH-CN)
@@ -17,14 +17,24 @@ Funcionalidades:
 
 import logging
 import asyncio
+import importlib.util
+import re
+import sys
+from typing import Any, Awaitable, Dict, List, Optional
+from urllib.parse import urlparse
 from telegram import Update
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, 
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, 
     CallbackQueryHandler, filters
 )
 
-from config import BOT_TOKEN
-from handlers import BotHandlers
+from config import (
+    BOT_TOKEN, METRICS_PORT, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS, MAX_CONCURRENT_UPDATES
+)
+from handlers import BotHandlers, supervisor
+from utils import MessageSender, CampaignStore
+from metrics import MetricsServer
 
 # Configurar logging
 logging.basicConfig(
@@ -37,21 +47,125 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def main():
-    """Função principal do bot"""
+# Tipos de update tratados por BotHandlers (documentos e fotos chegam como message);
+# os demais nem são enviados pelo Telegram
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Formato aceito pelo Telegram para o cabeçalho X-Telegram-Bot-Api-Secret-Token
+SECRET_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,256}$')
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processa até max_concurrent_updates updates ao mesmo tempo, mas os de um
+    mesmo usuário um de cada vez e na ordem de chegada (senha, intervalo e
+    botões dependem do estado da sessão deixado pelo update anterior)
+    """
     
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN não configurado! Verifique o arquivo .env")
-        return
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.users: Dict[Any, List] = {}  # usuário -> [lock, updates pendentes]
     
-    # Criar aplicação
-    application = Application.builder().token(BOT_TOKEN).build()
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # A vez do usuário é aguardada antes da vaga do semáforo, para que
+        # updates em fila de um mesmo usuário não ocupem as vagas dos demais
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self.users.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.users[user.id]
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+
+def webhook_settings() -> Optional[Dict[str, Any]]:
+    """
+    Parâmetros de run_webhook, ou None para receber updates por polling
+    (WEBHOOK_URL vazia)
+    Com WEBHOOK_URL definida mas sem o extra [webhooks] ou com segredo
+    ausente ou inválido, encerra o processo (código 1): voltar para polling
+    apagaria o webhook compartilhado pelas demais instâncias do balanceador,
+    e um segredo por execução faria as outras instâncias recusarem os updates
+    """
+    if not WEBHOOK_URL:
+        return None
+    if importlib.util.find_spec('tornado') is None:
+        logger.error('Modo webhook requer "python-telegram-bot[webhooks]"; encerrando')
+        sys.exit(1)
+    if not WEBHOOK_SECRET_TOKEN:
+        logger.error('Modo webhook requer WEBHOOK_SECRET_TOKEN (o mesmo em todas as instâncias); encerrando')
+        sys.exit(1)
+    if not SECRET_TOKEN_PATTERN.match(WEBHOOK_SECRET_TOKEN):
+        logger.error("WEBHOOK_SECRET_TOKEN inválido (1 a 256 caracteres A-Z, a-z, 0-9, _ e -); encerrando")
+        sys.exit(1)
+    return {
+        'listen': WEBHOOK_LISTEN,
+        'port': WEBHOOK_PORT,
+        'url_path': urlparse(WEBHOOK_URL).path.strip('/'),
+        'webhook_url': WEBHOOK_URL,
+        # Requisições sem o cabeçalho com este segredo recebem 403
+        'secret_token': WEBHOOK_SECRET_TOKEN,
+        'max_connections': WEBHOOK_MAX_CONNECTIONS,
+        'allowed_updates': ALLOWED_UPDATES
+    }
+
+# Endpoint de métricas e saúde (iniciado junto com o bot)
+metrics_server = MetricsServer(
+    ready=lambda: not supervisor.shutting_down and CampaignStore.default().conn.execute('SELECT 1').fetchone()
+)
+
+async def post_init(application: Application):
+    """Inicia as métricas e retoma campanhas interrompidas por desligamento ou queda"""
+    if METRICS_PORT:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logger.error(f"Não foi possível abrir a porta de métricas {METRICS_PORT}: {e}")
+    await supervisor.resume_interrupted(application)
+
+async def post_stop(application: Application):
+    """Encerra os envios em andamento (SIGTERM/SIGINT) e grava o estado"""
+    await supervisor.shutdown()
+
+async def post_shutdown(application: Application):
+    """Libera recursos compartilhados ao encerrar o bot"""
+    await MessageSender.close()
+    await metrics_server.stop()
+    CampaignStore.default().close()
+
+def build_application(token: str) -> Application:
+    """Cria a aplicação com os handlers do bot (mesma para webhook e polling)"""
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(UserOrderedUpdateProcessor(max(1, MAX_CONCURRENT_UPDATES)))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Registrar handlers
     application.add_handler(CommandHandler("start", BotHandlers.start_command))
     application.add_handler(CommandHandler("help", BotHandlers.start_command))
     application.add_handler(CommandHandler("menu", BotHandlers.start_command))
     application.add_handler(CommandHandler("language", BotHandlers.language_command))
+    application.add_handler(CommandHandler("timings", BotHandlers.timings_command))
     
     # Handler para mensagens de texto
     application.add_handler(MessageHandler(
@@ -74,12 +188,27 @@ def main():
     # Handler para botões inline
     application.add_handler(CallbackQueryHandler(BotHandlers.handle_callback_query))
     
+    return application
+
+def main():
+    """Função principal do bot"""
+    
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN não configurado! Verifique o arquivo .env")
+        return
+    
+    # Modo de recebimento conferido antes de tudo: webhook mal configurado encerra aqui
+    settings = webhook_settings()
+    
+    # Criar aplicação
+    application = build_application(BOT_TOKEN)
+    
     # Iniciar bot
     logger.info("🚀 Bot iniciado com sucesso!")
     logger.info("📋 Funcionalidades ativas:")
     logger.info("   ✅ Autenticação por senha")
     logger.info("   ✅ Upload de planilhas CSV/XLSX")
-    logger.info("   ✅ Sistema de backup automático")
+    logger.info("   ✅ Campanhas persistidas em SQLite (WAL)")
     logger.info("   ✅ Envio com notificações em tempo real")
     logger.info("   ✅ Tratamento de erros com skip")
     logger.info("   ✅ Interface multilíngue (PT/EN/ZH)")
@@ -90,8 +219,12 @@ def main():
     logger.info("   🆕 Salvamento e seleção de mensagens")
     logger.info("   ✅ Navegação com botões interativos")
     
-    # Executar bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Executar bot: webhook quando configurado, senão polling
+    if settings:
+        logger.info(f"Recebendo updates por webhook em {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{settings['url_path']}")
+        application.run_webhook(**settings)
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     try:
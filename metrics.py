@@ -0,0 +1,281 @@
+"""
+Métricas do bot no formato texto do Prometheus
+Servidas em METRICS_HOST:METRICS_PORT (/metrics), junto com as
+verificações de saúde /healthz (processo vivo) e /readyz (pronto para enviar)
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Callable, Tuple
+
+from config import METRICS_HOST, METRICS_PORT, METRICS_LATENCY_BUCKETS, EVENT_LOOP_LAG_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value: str) -> str:
+    """Escapa valor de label (barra invertida, aspas e quebra de linha)"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def bot_label(api_key: str) -> str:
+    """Label do bot: só o id numérico, o token nunca é exposto"""
+    return str(api_key).split(':', 1)[0]
+
+
+class Counter:
+    """Contador monotônico, opcionalmente com labels"""
+
+    TYPE = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        key = tuple(str(value) for value in label_values)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self.values.get(tuple(str(value) for value in label_values), 0)
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Counter):
+    """Valor que sobe e desce; set_function calcula o valor na coleta"""
+
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, *label_values):
+        self.values[tuple(str(v) for v in label_values)] = value
+
+    def remove(self, *label_values):
+        self.values.pop(tuple(str(value) for value in label_values), None)
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render(self) -> List[str]:
+        if self.function is not None:
+            try:
+                self.values[()] = self.function()
+            except Exception as e:
+                logger.error(f"Erro ao coletar métrica {self.name}: {e}")
+        return super().render()
+
+
+class Histogram:
+    """Histograma com buckets cumulativos (le), soma e contagem"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values: Dict[Tuple[str, ...], List[float]] = {}  # contagens por bucket + [soma]
+
+    def observe(self, value: float, *label_values):
+        key = tuple(str(v) for v in label_values)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-1] += value
+
+    def count(self, *label_values) -> int:
+        series = self.values.get(tuple(str(v) for v in label_values))
+        return sum(series[:-1]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Conjunto de métricas expostas em /metrics"""
+
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Registro global e métricas alimentadas por MessageSender e pelo loop de envio
+registry = MetricsRegistry()
+
+messages_sent = registry.register(Counter(
+    'botgerenciador_messages_sent_total', 'Mensagens enviadas com sucesso', ('bot',)
+))
+messages_failed = registry.register(Counter(
+    'botgerenciador_messages_failed_total', 'Envios com erro (inclui limite de taxa)', ('bot', 'error_code')
+))
+api_latency = registry.register(Histogram(
+    'botgerenciador_api_request_duration_seconds', 'Latência das requisições à API do Telegram', ('method',)
+))
+queue_depth = registry.register(Gauge(
+    'botgerenciador_campaign_queue_depth', 'Linhas pendentes por campanha', ('campaign',)
+))
+store_write_seconds = registry.register(Histogram(
+    'botgerenciador_store_write_duration_seconds', 'Tempo de gravação dos resultados de um lote no banco',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+))
+event_loop_lag = registry.register(Gauge(
+    'botgerenciador_event_loop_lag_seconds', 'Atraso do event loop na última medição'
+))
+active_campaigns = registry.register(Gauge(
+    'botgerenciador_active_campaigns', 'Campanhas com loop de envio ativo'
+))
+retries_scheduled = registry.register(Counter(
+    'botgerenciador_retries_scheduled_total', 'Reenvios agendados após falha transitória', ('bot',)
+))
+dead_letters = registry.register(Counter(
+    'botgerenciador_dead_letters_total', 'Linhas enviadas à fila de falhas (permanent ou exhausted)', ('reason',)
+))
+dead_destinations_skipped = registry.register(Counter(
+    'botgerenciador_dead_destinations_skipped_total', 'Linhas puladas por destino recusado antes', ('stage',)
+))
+bot_preflight = registry.register(Counter(
+    'botgerenciador_bot_preflight_total', 'Tokens conferidos com getMe por resultado', ('result',)
+))
+invalid_bot_rows = registry.register(Counter(
+    'botgerenciador_invalid_bot_rows_total', 'Linhas separadas por token de bot inválido'
+))
+callbacks = registry.register(Counter(
+    'botgerenciador_callbacks_total', 'Botões inline despachados por rota', ('route',)
+))
+callbacks_unknown = registry.register(Counter(
+    'botgerenciador_callbacks_unknown_total', 'Callbacks sem rota ou com parâmetro inválido'
+))
+callback_routing_seconds = registry.register(Histogram(
+    'botgerenciador_callback_routing_seconds', 'Tempo para resolver a rota de um callback',
+    buckets=(0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.001)
+))
+
+
+def record_send(api_key: str, result: Dict) -> None:
+    """Contabiliza o resultado de um envio por bot e código de erro"""
+    if result.get('success'):
+        messages_sent.inc(bot_label(api_key))
+    else:
+        messages_failed.inc(bot_label(api_key), result.get('error_code') or 'none')
+
+
+class MetricsServer:
+    """
+    Servidor HTTP mínimo (asyncio) para /metrics, /healthz e /readyz
+    Roda no mesmo event loop do bot e mede o atraso desse loop
+    """
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                 ready: Optional[Callable[[], bool]] = None):
+        self.host = host
+        self.port = port
+        self.ready = ready or (lambda: True)
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.lag_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Abre a porta e inicia a medição do atraso do event loop"""
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # porta real quando 0
+        self.lag_task = asyncio.create_task(self._measure_lag())
+        logger.info(f"Métricas disponíveis em http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.lag_task:
+            self.lag_task.cancel()
+            await asyncio.gather(self.lag_task, return_exceptions=True)
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _measure_lag(self, interval: float = EVENT_LOOP_LAG_INTERVAL):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            event_loop_lag.set(max(0.0, time.monotonic() - started - interval))
+
+    def _response(self, path: str) -> Tuple[str, str, str]:
+        """(status, content-type, corpo) para o caminho pedido"""
+        if path == '/metrics':
+            return '200 OK', 'text/plain; version=0.0.4; charset=utf-8', registry.render()
+        if path == '/healthz':
+            return '200 OK', 'text/plain', 'ok\n'
+        if path == '/readyz':
+            try:
+                ready = self.ready()
+            except Exception as e:
+                logger.error(f"Erro na verificação de prontidão: {e}")
+                ready = False
+            return ('200 OK', 'text/plain', 'ready\n') if ready else \
+                ('503 Service Unavailable', 'text/plain', 'not ready\n')
+        return '404 Not Found', 'text/plain', 'not found\n'
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Cabeçalhos são ignorados, mas precisam ser consumidos
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?', 1)[0] if len(parts) >= 2 else '/'
+            status, content_type, body = self._response(path)
+            payload = body.encode('utf-8')
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Erro ao responder métricas: {e}")
+        finally:
+            writer.close()
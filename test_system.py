@@ -7,6 +7,8 @@ Verifica se todos os componentes estão funcionando corretamente
 import os
 import sys
 import json
+import asyncio
+import shutil
 import tempfile
 import pandas as pd
 from datetime import datetime
@@ -20,6 +22,7 @@ def test_imports():
         import utils
         import translations
         import handlers
+        import metrics
         print("✅ Todos os imports OK")
         return True
     except ImportError as e:
@@ -58,39 +61,566 @@ def test_translations():
         print(f"❌ Erro nas traduções: {e}")
         return False
 
-def test_backup_system():
-    """Testa sistema de backup"""
-    print("💾 Testando sistema de backup...")
+def test_campaign_store():
+    """Testa armazenamento das campanhas em SQLite"""
+    print("💾 Testando banco de campanhas...")
     
+    temp_dir = tempfile.mkdtemp()
     try:
-        from utils import BackupManager
+        from utils import CampaignStore, MessageQueue
         
-        # Dados de teste
-        test_data = {
-            'user_id': 'test_user',
-            'messages_queue': [
-                {'api_key': 'test', 'chat_id': 'test', 'mensagem': 'test'}
-            ],
-            'timestamp': datetime.now().isoformat()
-        }
+        db_path = os.path.join(temp_dir, 'campaigns.db')
+        store = CampaignStore(db_path)
+        assert store.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
         
-        # Testar salvamento
-        assert BackupManager.save_backup(test_data)
+        campaign_id = store.create_campaign('test_user')
+        other_id = store.create_campaign('other_user')
+        queue = MessageQueue(store, campaign_id)
+        queue.ingest([
+            {'api_key': '123:ABC' if i % 2 else '456:DEF', 'chat_id': f'-100{i}', 'mensagem': f'Teste {i}'}
+            for i in range(4)
+        ])
+        store.update_campaign(campaign_id, status='running', config={'language': 'en-US'})
         
-        # Testar carregamento
-        loaded_data = BackupManager.load_backup()
-        assert loaded_data is not None
-        assert loaded_data['user_id'] == 'test_user'
+        # Campanhas isoladas por usuário e filtradas por status
+        assert [c['id'] for c in store.list_campaigns('test_user', CampaignStore.RESUMABLE)] == [campaign_id]
+        assert store.list_campaigns('other_user', CampaignStore.RESUMABLE) == []
+        assert store.get_campaign(campaign_id)['config'] == {'language': 'en-US'}
         
-        # Testar limpeza
-        assert BackupManager.clear_backup()
+        # Linha 0 enviada, linha 1 devolvida ao fim da fila, linha 2 com erro
+        assert queue.take(3) == [0, 1, 2]
+        sent_at = datetime.now().isoformat()
+        queue.mark(0, '✅ Enviado', sent_at, latency_ms=12.5)
+        queue.requeue(1, 'Too Many Requests', 429)
+        queue.mark(2, '❌ Erro: teste', None, 'teste', 400)
+        queue.flush()
+        assert store.count_by_status(campaign_id) == {'✅ Enviado': 1, '❌ Erro: teste': 1, 'Pendente': 2}
+        assert store.errors_by_bot(campaign_id) == {'456:DEF': 1}
+        attempts = store.conn.execute(
+            'SELECT COUNT(*), SUM(success) FROM attempts WHERE campaign_id = ?', (campaign_id,)
+        ).fetchone()
+        assert tuple(attempts) == (3, 1)
+        
+        # Linha retirada e não gravada (queda) continua pendente ao reabrir
+        assert queue.take(1) == [3]
+        store.close()
+        store = CampaignStore(db_path)
+        restored = MessageQueue(store, campaign_id)
+        assert len(restored) == 2
+        assert [restored.row(i)['chat_id'] for i in restored.take(10)] == ['-1003', '-1001']
+        processed = list(restored.processed_rows())
+        assert [m['chat_id'] for m in processed] == ['-1000', '-1002']
+        assert processed[0]['status_envio'] == '✅ Enviado' and processed[0]['latencia_ms'] == 12.5
+        assert processed[1]['erro'] == 'teste' and processed[1]['codigo_erro'] == 400
+        
+        store.delete_campaign(other_id)
+        assert store.get_campaign(other_id) is None
+        store.close()
+        
+        print("✅ Banco de campanhas OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no banco de campanhas: {e}")
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_message_queue():
+    """Testa fila de mensagens paginada"""
+    print("📦 Testando fila de mensagens...")
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        from utils import CampaignStore, MessageQueue
+        
+        store = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        queue = MessageQueue(store, store.create_campaign('test_user'), page_size=2)
+        queue.ingest([
+            {'api_key': '123:ABC' if i % 2 else '456:DEF', 'chat_id': f'-100{i}', 'mensagem': f'Teste {i}'}
+            for i in range(5)
+        ])
+        assert queue.total == 5 and len(queue) == 5
+        assert store.conn.execute('SELECT COUNT(*) FROM bots').fetchone()[0] == 2  # tokens internados
+        
+        # Retirar, devolver ao início (pausa) e ao fim (limite de taxa)
+        batch = queue.take(3)
+        assert batch == [0, 1, 2]
+        queue.push_front([1, 2])
+        queue.mark(0, '✅ Enviado', '2024-01-01T00:00:00')
+        assert queue.take(1) == [1]
+        queue.requeue(1)
+        assert queue.take(10) == [2, 3, 4, 1]
+        assert len(queue) == 0
+        assert len(queue._rows) <= 4  # só a página atual e as linhas em envio ficam em memória
+        
+        processed = list(queue.processed_rows())
+        assert [m['chat_id'] for m in processed] == ['-1000']
+        assert processed[0]['api_key'] == '456:DEF' and processed[0]['status_envio'] == '✅ Enviado'
+        
+        # Linhas em envio numa falha voltam para o início da fila
+        queue.reset()
+        assert queue.take(2) == [0, 1]
+        queue.mark(0, '✅ Enviado')
+        queue.release_in_flight()
+        assert queue.take(1) == [1]
+        
+        # Loop infinito volta ao início
+        queue.reset()
+        assert len(queue) == 5 and queue.take(5) == [0, 1, 2, 3, 4]
+        store.close()
+        
+        print("✅ Fila de mensagens OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na fila de mensagens: {e}")
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_queue_deduplication():
+    """Testa políticas de linhas duplicadas na fila"""
+    print("🔁 Testando deduplicação da fila...")
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        import time
+        from utils import CampaignStore, MessageQueue
+        
+        store = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        
+        def new_queue(messages, dedup='off'):
+            queue = MessageQueue(store, store.create_campaign('test_user', dedup))
+            queue.ingest(messages)
+            return queue
+        
+        def chat_ids(queue):
+            return [queue.row(i)['chat_id'] for i in queue.take(10)]
+        
+        rows = [
+            {'api_key': '123:ABC', 'chat_id': '-1001', 'mensagem': 'Oi'},
+            {'api_key': '123:ABC', 'chat_id': '-1002', 'mensagem': 'Oi'},
+            {'api_key': '123:ABC', 'chat_id': '-1001', 'mensagem': 'Promo'},
+            {'api_key': '456:DEF', 'chat_id': '-1001', 'mensagem': 'Oi'},
+            {'api_key': '123:ABC', 'chat_id': '-1001', 'mensagem': 'Oi'}
+        ]
+        
+        queue = new_queue(rows)
+        assert queue.total == 5 and queue.collapsed == 0
+        
+        queue = new_queue(rows, 'first')
+        assert chat_ids(queue) == ['-1001', '-1002', '-1001'] and queue.collapsed == 2
+        
+        queue = new_queue(rows, 'merge')
+        assert queue.total == 3 and queue.take(1) and queue.row(0)['mensagem'] == 'Oi\n\nPromo'
+        
+        queue = new_queue(rows, 'drop')
+        assert chat_ids(queue) == ['-1002', '-1001']
+        assert queue.collapsed == 3 and len(queue) == 0
+        
+        # Linha já em envio não é alterada; o total agrupado fica na campanha
+        queue = new_queue(rows[:2], 'merge')
+        assert queue.take(1) == [0]
+        changes = queue.ingest(rows[2:])
+        assert changes == {'appended': 1, 'collapsed': 2}
+        
+        restored = MessageQueue(store, queue.campaign_id)
+        assert restored.collapsed == 2 and restored.dedup == 'merge'
+        assert restored.ingest(rows[:1])['collapsed'] == 1
+        
+        # Busca da primeira linha do destino pelo índice, não pela campanha inteira
+        plan = ' '.join(row[3] for row in store.conn.execute(
+            'EXPLAIN QUERY PLAN ' + MessageQueue.FIRST_ROW_SQL, ('c', 'c', 1, '-1001')
+        ))
+        assert 'idx_rows_destination' in plan, plan
+        
+        # Em escala, cada bloco custa o mesmo que o primeiro (antes crescia com a campanha)
+        queue = new_queue([], 'first')
+        timings = []
+        for chunk in range(4):
+            started = time.perf_counter()
+            queue.ingest([{'api_key': f'{i % 50}:ABC', 'chat_id': f'-{chunk * 5000 + i}', 'mensagem': 'Oi'}
+                          for i in range(5000)])
+            timings.append(time.perf_counter() - started)
+        assert queue.total == 20000 and timings[-1] < timings[0] * 4 + 0.1, timings
+        store.close()
+        
+        print("✅ Deduplicação da fila OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na deduplicação da fila: {e}")
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_retry_policy():
+    """Testa classificação de erros, reenvio agendado e fila de falhas"""
+    print("♻️ Testando reenvios e fila de falhas...")
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        import sqlite3
+        import time
+        from utils import CampaignStore, MessageQueue, MessageSender, RetryPolicy
+        
+        # Transitórias (rede, 5xx) x permanentes (recusa da API) x limite de taxa
+        classify = MessageSender.classify_error
+        assert classify({'success': True}) is None and classify(None) is None
+        assert classify({'success': False, 'error_code': 429}) == 'throttled'
+        assert classify({'success': False, 'error_code': 502}) == 'transient'
+        assert classify(MessageSender._error_result('Timeout na requisição', transient=True)) == 'transient'
+        assert classify({'success': False, 'error_code': 400, 'error': 'Bad Request: chat not found'}) == 'permanent'
+        assert classify(MessageSender._error_result('Foto do template não encontrada')) == 'permanent'
+        
+        # Backoff exponencial com jitter, limitado por tentativas e orçamento
+        policy = RetryPolicy(max_attempts=3, base_delay=2, max_delay=10, budget_ratio=0.5, budget_min=1)
+        for retries, (low, high) in enumerate([(1, 2), (2, 4), (4, 8)]):
+            assert all(low <= policy.delay(retries) <= high for _ in range(50))
+        assert 5 <= policy.delay(10) <= 10  # teto max_delay
+        assert policy.next_delay(3, 0, 100) is None  # tentativas esgotadas
+        assert policy.next_delay(0, 50, 100) is None and policy.next_delay(0, 49, 100) is not None
+        
+        path = os.path.join(temp_dir, 'campaigns.db')
+        store = CampaignStore(path)
+        campaign_id = store.create_campaign('test_user')
+        queue = MessageQueue(store, campaign_id, page_size=2)
+        queue.ingest([{'api_key': '123:ABC', 'chat_id': f'-100{i}', 'mensagem': f'Teste {i}'} for i in range(4)])
+        
+        # Reenvio agendado não segura a fila: as demais linhas passam na frente
+        assert queue.take(2) == [0, 1]
+        queue.schedule_retry(0, 60, 'Timeout na requisição')
+        queue.mark(1, '❌ Erro: chat not found', error='chat not found', error_code=400)
+        queue.flush()
+        assert len(queue) == 3 and queue.retries(0) == 1 and queue.retries_spent == 1
+        assert queue.take(5) == [2, 3] and 55 < queue.next_retry_in() <= 60
+        queue.mark(2, '✅ Enviado', '2024-01-01T00:00:00')
+        queue.requeue(3)
+        assert queue.take(5) == [3]
+        queue.mark(3, '✅ Enviado', '2024-01-01T00:00:00')
+        queue.flush()
+        
+        # Agendamento sobrevive a reinícios; vencido, volta à frente da fila
+        store.conn.execute('UPDATE rows SET retry_at = ? WHERE campaign_id = ? AND idx = 0',
+                           (time.time() - 1, campaign_id))
+        queue = MessageQueue(store, campaign_id)
+        assert len(queue) == 1 and queue.retries(0) == 1 and queue.retries_spent == 1
+        assert queue.next_retry_in() == 0 and queue.take(5) == [0]
+        queue.mark(0, '❌ Erro: Timeout na requisição', error='Timeout na requisição')
+        
+        # Fila de falhas: um reenvio devolve as linhas com erro ao fim da fila
+        assert queue.dead_letters() == 2
+        assert queue.redrive() == 2 and len(queue) == 2 and queue.dead_letters() == 0
+        assert queue.retries_spent == 0 and queue.take(5) == [0, 1]
+        assert store.count_by_status(campaign_id) == {'✅ Enviado': 2, 'Pendente': 2}
+        store.close()
+        
+        # Fila que esvazia sem devolver linhas (puladas na leitura): o loop conclui a campanha
+        from handlers import BotHandlers, user_sessions
+        from utils import CampaignControl, StageTimer
+        store = CampaignStore(os.path.join(temp_dir, 'drain.db'))
+        queue = MessageQueue(store, store.create_campaign('test_user'))
+        queue.ingest([{'api_key': '123:ABC', 'chat_id': '-1001', 'mensagem': 'Teste'}])
+        
+        def drain(count):
+            queue._pending = 0
+            return []
+        
+        queue.take = drain
+        finished = []
+        
+        async def finish(context, user_id, lang, campaign_id, messages_queue):
+            finished.append(user_id)
+        
+        async def no_progress(*args, **kwargs):
+            pass
         
-        print("✅ Sistema de backup OK")
+        original = BotHandlers._finish_sending, BotHandlers._update_progress
+        BotHandlers._finish_sending, BotHandlers._update_progress = staticmethod(finish), staticmethod(no_progress)
+        user_sessions.update_session('drain_user', {'campaign_id': queue.campaign_id,
+                                                    'current_config': {'interval': 0, 'batch_size': 10}})
+        try:
+            done = asyncio.run(asyncio.wait_for(BotHandlers._run_sending_loop(
+                None, 'drain_user', 'pt-BR', CampaignControl(), queue.campaign_id, queue, None, StageTimer()
+            ), timeout=5))
+        finally:
+            BotHandlers._finish_sending, BotHandlers._update_progress = original
+        assert done and finished == ['drain_user']
+        store.close()
+        
+        # Bancos antigos (sem retries/retry_at) ganham as colunas ao abrir
+        old_path = os.path.join(temp_dir, 'old.db')
+        conn = sqlite3.connect(old_path)
+        conn.execute('CREATE TABLE rows (campaign_id TEXT NOT NULL, idx INTEGER NOT NULL, bot_id INTEGER NOT NULL, '
+                     'chat_id TEXT NOT NULL, mensagem TEXT NOT NULL, state INTEGER NOT NULL DEFAULT 0, '
+                     "seq INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'Pendente', sent_at TEXT, error TEXT, "
+                     'error_code INTEGER, latency_ms REAL, processed_seq INTEGER, PRIMARY KEY (campaign_id, idx))')
+        conn.close()
+        store = CampaignStore(old_path)
+        columns = {row['name'] for row in store.conn.execute('PRAGMA table_info(rows)')}
+        assert {'retries', 'retry_at'} <= columns
+        store.close()
+        
+        print("✅ Reenvios e fila de falhas OK")
         return True
         
     except Exception as e:
-        print(f"❌ Erro no backup: {e}")
+        print(f"❌ Erro nos reenvios: {e}")
         return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_dead_destinations():
+    """Testa cache persistente de destinos recusados"""
+    print("⏭️ Testando destinos recusados...")
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        from utils import CampaignStore, MessageQueue, MessageSender, ReportSummary
+        
+        # 403 (bloqueado/removido) e 400 de chat inexistente; outros 400 não
+        dead = MessageSender.is_dead_destination
+        assert dead({'success': False, 'error_code': 403, 'error': 'Forbidden: bot was blocked by the user'})
+        assert dead({'success': False, 'error_code': 400, 'error': 'Bad Request: chat not found'})
+        assert not dead({'success': False, 'error_code': 400, 'error': 'Bad Request: message text is empty'})
+        assert not dead({'success': False, 'error_code': 502}) and not dead({'success': True})
+        
+        store = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        rows = [{'api_key': '123:ABC', 'chat_id': f'-100{i}', 'mensagem': f'Teste {i}'} for i in range(4)]
+        rows.append({'api_key': '123:ABC', 'chat_id': '-1001', 'mensagem': 'De novo'})
+        
+        # Recusa durante o envio: linhas seguintes para o destino são puladas sem requisição
+        queue = MessageQueue(store, store.create_campaign('test_user'), page_size=2)
+        queue.ingest(rows)
+        assert queue.take(2) == [0, 1]
+        queue.remember_dead(1, 403, 'Forbidden: bot was blocked by the user')
+        queue.mark(1, '❌ Erro: Forbidden', error='Forbidden: bot was blocked by the user', error_code=403)
+        queue.mark(0, '✅ Enviado', '2024-01-01T00:00:00')
+        assert queue.take(10) == [2, 3] and len(queue) == 0 and queue.dead_skipped == 1
+        for index in (2, 3):
+            queue.mark(index, '✅ Enviado', '2024-01-01T00:00:00')
+        queue.flush()
+        assert store.count_by_status(queue.campaign_id)[MessageQueue.DEAD_STATUS] == 1
+        first_id = queue.campaign_id
+        
+        # Nova campanha: o destino já entra pulado (cache persistente)
+        queue = MessageQueue(store, store.create_campaign('test_user'))
+        queue.ingest(rows[:3])
+        assert queue.dead_skipped == 1 and len(queue) == 2 and queue.take(10) == [0, 2]
+        
+        # Loop infinito: linhas puladas são conferidas de novo a cada ciclo
+        queue.reset()
+        assert queue.take(10) == [0, 2] and queue.dead_skipped == 1
+        
+        summary = ReportSummary()
+        for row in queue.processed_rows():
+            summary.add(row)
+        assert summary.dead == 1 and summary.errors == 0
+        
+        # Sem validade (0), o cache não é consultado nem alimentado
+        queue = MessageQueue(store, store.create_campaign('test_user'), dead_ttl=0)
+        queue.ingest(rows[:3])
+        assert queue.dead_skipped == 0 and queue.take(10) == [0, 1, 2]
+        
+        # Destino expirado volta a ser tentado
+        store.conn.execute('UPDATE dead_destinations SET expires_at = 0')
+        queue = MessageQueue(store, store.create_campaign('test_user'))
+        queue.ingest(rows[:3])
+        assert queue.dead_skipped == 0 and queue.take(10) == [0, 1, 2]
+        
+        # Reenviar a fila de falhas esquece o destino recusado
+        store.conn.execute('UPDATE dead_destinations SET expires_at = 1e12')
+        first = MessageQueue(store, first_id)
+        assert first.redrive() == 1 and first.take(10) == [1]
+        assert store.conn.execute('SELECT COUNT(*) FROM dead_destinations').fetchone()[0] == 0
+        store.close()
+        
+        print("✅ Destinos recusados OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro nos destinos recusados: {e}")
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_bot_preflight():
+    """Testa conferência dos tokens com getMe antes do envio"""
+    print("🚫 Testando conferência de tokens...")
+    
+    temp_dir = tempfile.mkdtemp()
+    saved = None
+    try:
+        import time
+        import httpx
+        from utils import BotPreflight, CampaignStore, MessageQueue, MessageSender, ReportSummary
+        
+        calls = {}
+        gates = {}
+        
+        async def handler(request):
+            token = request.url.path.split('/bot')[1].rsplit('/', 1)[0]
+            calls[token] = calls.get(token, 0) + 1
+            if token.startswith('777:'):
+                await asyncio.sleep(5)  # getMe travado
+            if token.startswith('888:'):
+                await asyncio.sleep(0.05)
+            if token in gates:
+                await gates[token].wait()
+            if token.startswith('999:'):
+                return httpx.Response(401, json={'ok': False, 'error_code': 401, 'description': 'Unauthorized'})
+            if token.startswith('555:'):
+                return httpx.Response(502, json={'ok': False, 'error_code': 502, 'description': 'Bad Gateway'})
+            return httpx.Response(200, json={'ok': True, 'result': {'id': 1, 'is_bot': True}})
+        
+        def mock_client():
+            MessageSender._async_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            MessageSender._async_client_loop = asyncio.get_running_loop()
+        
+        async def check(preflight, api_keys):
+            mock_client()
+            try:
+                return await preflight.check(api_keys)
+            finally:
+                await MessageSender.close()
+        
+        # Um getMe por token distinto; só 401/404 invalidam (502 não decide nada)
+        preflight = BotPreflight(ttl=60, max_in_flight=2)
+        keys = ['123:ABC', '999:BAD', '123:ABC', '555:FLAKY', '999:BAD']
+        assert asyncio.run(check(preflight, keys)) == {'999:BAD': (401, 'Unauthorized')}
+        assert calls == {'123:ABC': 1, '999:BAD': 1, '555:FLAKY': 1}
+        
+        # Cache: válidos e inválidos não são conferidos de novo; o sem veredito é
+        assert asyncio.run(check(preflight, keys)) == {'999:BAD': (401, 'Unauthorized')}
+        assert calls == {'123:ABC': 1, '999:BAD': 1, '555:FLAKY': 2}
+        
+        # Token recusado durante o envio entra no cache sem nova requisição
+        preflight.mark_invalid('123:ABC', 401, 'Unauthorized')
+        assert '123:ABC' in asyncio.run(check(preflight, ['123:ABC'])) and calls['123:ABC'] == 1
+        
+        # Validade vencida: o token é conferido de novo
+        preflight.ttl = 0
+        asyncio.run(check(preflight, ['123:ABC']))
+        assert calls['123:ABC'] == 2
+        
+        # getMe travado: timeout próprio, sem veredito (não espera o HTTP_TIMEOUT dos envios)
+        preflight = BotPreflight(ttl=60, timeout=0.1)
+        started = time.perf_counter()
+        assert asyncio.run(check(preflight, ['777:SLOW', '999:BAD'])) == {'999:BAD': (401, 'Unauthorized')}
+        assert time.perf_counter() - started < 2
+        assert preflight.known_invalid(['777:SLOW', '999:BAD', '123:ABC']) == {'999:BAD': (401, 'Unauthorized')}
+        
+        # Conferências simultâneas do mesmo token (blocos da planilha) compartilham o getMe
+        async def concurrent():
+            mock_client()
+            try:
+                return await asyncio.gather(preflight.check(['888:SHARED']), preflight.check(['888:SHARED']))
+            finally:
+                await MessageSender.close()
+        
+        assert asyncio.run(concurrent()) == [{}, {}] and calls['888:SHARED'] == 1
+        
+        # Tokens já recusados entram separados direto na leitura
+        store = CampaignStore(os.path.join(temp_dir, 'known.db'))
+        queue = MessageQueue(store, store.create_campaign('test_user'))
+        queue.ingest([{'api_key': '999:BAD' if i % 2 else '123:ABC', 'chat_id': f'-100{i}', 'mensagem': 'Teste'}
+                      for i in range(4)], invalid_bots=preflight.known_invalid(['999:BAD']))
+        assert len(queue) == 2 and queue.take(10) == [0, 2]
+        assert queue.invalid_bots == {store.bot_id('999:BAD'): 2}
+        assert store.count_by_status(queue.campaign_id)[MessageQueue.INVALID_BOT_STATUS] == 2
+        store.close()
+        
+        # Linhas do bot inválido ficam separadas antes do envio (também as já carregadas)
+        store = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        rows = [{'api_key': '999:BAD' if i % 2 else '123:ABC', 'chat_id': f'-100{i}', 'mensagem': f'Teste {i}'}
+                for i in range(6)]
+        queue = MessageQueue(store, store.create_campaign('test_user'), page_size=4)
+        queue.ingest(rows)
+        assert queue.take(1) == [0]
+        assert queue.set_aside_bots({'999:BAD': (401, 'Unauthorized')}) == 3
+        assert len(queue) == 2 and queue.take(10) == [2, 4]
+        assert queue.invalid_bots == {store.bot_id('999:BAD'): 3}
+        for index in (0, 2, 4):
+            queue.mark(index, '✅ Enviado', '2024-01-01T00:00:00')
+        queue.flush()
+        
+        # Persistente: contagem restaurada do banco e linhas fora do loop infinito
+        queue = MessageQueue(store, queue.campaign_id)
+        assert queue.invalid_bots == {store.bot_id('999:BAD'): 3}
+        queue.reset()
+        assert queue.take(10) == [0, 2, 4]
+        
+        summary = ReportSummary()
+        for row in queue.processed_rows():
+            summary.add(row)
+        assert summary.invalid_bot == 3 and summary.errors == 0
+        store.close()
+        
+        # Upload respondido antes do getMe; as linhas do token recusado saem da fila em seguida
+        import handlers
+        from types import SimpleNamespace
+        from translations import get_text
+        
+        saved = CampaignStore._default, handlers.bot_preflight
+        CampaignStore._default = CampaignStore(os.path.join(temp_dir, 'upload.db'))
+        handlers.bot_preflight = BotPreflight(ttl=60)
+        sheet = pd.DataFrame({
+            'api_key': ['123:ABC', '999:GATED'] * 3,
+            'chat_id': [f'-300{i}' for i in range(6)],
+            'mensagem': ['Teste'] * 6
+        })
+        replies = []
+        
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+        
+        async def download_to_drive(path):
+            sheet.to_csv(path, index=False)
+        
+        async def get_file(file_id):
+            return SimpleNamespace(download_to_drive=download_to_drive)
+        
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id='preflight_user'),
+            message=SimpleNamespace(document=SimpleNamespace(file_name='tokens.csv', file_id='f1'),
+                                    reply_text=reply_text)
+        )
+        context = SimpleNamespace(bot=SimpleNamespace(get_file=get_file))
+        
+        async def upload():
+            mock_client()
+            gates['999:GATED'] = asyncio.Event()
+            try:
+                handlers.user_sessions.update_session('preflight_user', {'authenticated': True})
+                await asyncio.wait_for(handlers.BotHandlers.handle_document(update, context), 2)
+                session = handlers.user_sessions.get_session('preflight_user')
+                queue = session['messages_queue']
+                assert get_text('upload_success', 'pt-BR') in replies and len(queue) == 6
+                
+                gates['999:GATED'].set()
+                for _ in range(200):
+                    if queue.invalid_bots and not session.get('ingesting'):
+                        break
+                    await asyncio.sleep(0.01)
+                return queue
+            finally:
+                await MessageSender.close()
+        
+        queue = asyncio.run(upload())
+        assert len(queue) == 3 and queue.invalid_bots == {CampaignStore._default.bot_id('999:GATED'): 3}
+        
+        print("✅ Conferência de tokens OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na conferência de tokens: {e}")
+        return False
+    finally:
+        if saved:
+            CampaignStore._default.close()
+            CampaignStore._default, handlers.bot_preflight = saved
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 def test_spreadsheet_processor():
     """Testa processador de planilhas"""
@@ -138,6 +668,245 @@ def test_spreadsheet_processor():
         print(f"❌ Erro no processador: {e}")
         return False
 
+def test_streaming_ingestion():
+    """Testa leitura da planilha em blocos"""
+    print("🌊 Testando leitura em blocos...")
+    
+    try:
+        from utils import SpreadsheetProcessor
+        
+        df = pd.DataFrame({
+            'api_key': ['123:ABC'] * 5,
+            'chat_id': ['-1001', '-1002', '-1003', '-1004', '-1005'],
+            'mensagem': ['Teste', 'Teste', None, 'Teste', 'Teste']
+        })
+        
+        for suffix in ('.csv', '.xlsx'):
+            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+                path = f.name
+            if suffix == '.csv':
+                df.to_csv(path, index=False)
+            else:
+                df.to_excel(path, index=False)
+            
+            chunks = list(SpreadsheetProcessor.iter_file(path, chunk_size=2))
+            rows = [m for chunk in chunks for m in chunk]
+            assert all(len(chunk) <= 2 for chunk in chunks)
+            assert [m['chat_id'] for m in rows] == ['-1001', '-1002', '-1004', '-1005']
+            assert rows[0]['status_envio'] == 'Pendente'
+            os.unlink(path)
+        
+        # Colunas ausentes são rejeitadas no primeiro bloco
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as f:
+            f.write('api_key,mensagem\n123:ABC,Teste\n')
+            path = f.name
+        try:
+            SpreadsheetProcessor.next_chunk(SpreadsheetProcessor.iter_file(path))
+            assert False, "colunas ausentes não detectadas"
+        except ValueError:
+            pass
+        os.unlink(path)
+        
+        # Gravação numa thread com o envio em andamento: o event loop segue
+        # respondendo e cada linha sai da fila uma única vez
+        from utils import CampaignStore, MessageQueue
+        temp_dir = tempfile.mkdtemp()
+        store = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        queue = MessageQueue(store, store.create_campaign('test_user'), page_size=50)
+        rows = [{'api_key': f'{i % 7}:ABC', 'chat_id': f'-100{i}', 'mensagem': 'Teste'} for i in range(6000)]
+        
+        async def scenario():
+            ingest = asyncio.ensure_future(asyncio.to_thread(queue.ingest, rows, 200))
+            taken, ticks = [], 0
+            while not ingest.done() or len(queue):
+                for index in queue.take(20):
+                    queue.mark(index, '✅ Enviado', '2024-01-01T00:00:00')
+                    taken.append(index)
+                queue.flush()
+                ticks += 1
+                await asyncio.sleep(0)
+            await ingest
+            return taken, ticks
+        
+        taken, ticks = asyncio.run(scenario())
+        assert sorted(taken) == list(range(6000)) and len(queue) == 0 and ticks > 1
+        store.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        print("✅ Leitura em blocos OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na leitura em blocos: {e}")
+        return False
+
+def test_vectorized_validation():
+    """Testa validação vetorizada das colunas da planilha"""
+    print("🧮 Testando validação vetorizada...")
+    
+    try:
+        from utils import SpreadsheetProcessor
+        
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as f:
+            f.write(
+                'api_key,chat_id,mensagem\n'
+                ' 123:ABC ,-1001234567890, Olá \n'
+                'abc,-1002,Teste\n'
+                '123:ABC,grupo,Teste\n'
+                '123:ABC,,Teste\n'
+                '123:ABC,@meucanal,Teste\n'
+                '123:ABC,-1009876543210.0,Teste\n'
+            )
+            csv_file = f.name
+        
+        rejected = {}
+        messages = [m for chunk in SpreadsheetProcessor.iter_file(csv_file, rejected=rejected) for m in chunk]
+        os.unlink(csv_file)
+        
+        # chat_id numérico preservado como texto e espaços removidos
+        assert messages[0]['chat_id'] == '-1001234567890'
+        assert messages[0]['api_key'] == '123:ABC'
+        assert messages[0]['mensagem'] == 'Olá'
+        assert messages[1]['chat_id'] == '@meucanal'
+        assert messages[2]['chat_id'] == '-1009876543210'  # float inteiro perde o ".0"
+        assert len(messages) == 3
+        assert rejected == {'campos_vazios': 1, 'api_key_invalida': 1, 'chat_id_invalido': 1}
+        
+        # Coluna lida como float pelo pandas
+        df = pd.DataFrame({'api_key': ['123:ABC'], 'chat_id': [-1001234567890.0], 'mensagem': ['Teste']})
+        assert SpreadsheetProcessor.validate_frame(df)[0]['chat_id'] == '-1001234567890'
+        
+        # XLSX com chat_id numérico não vira notação científica
+        df = pd.DataFrame({'api_key': ['123:ABC'], 'chat_id': [-1001234567890], 'mensagem': ['Teste']})
+        with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as f:
+            xlsx_file = f.name
+        df.to_excel(xlsx_file, index=False)
+        messages = SpreadsheetProcessor.process_file(xlsx_file)
+        os.unlink(xlsx_file)
+        assert messages[0]['chat_id'] == '-1001234567890'
+        
+        print("✅ Validação vetorizada OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na validação vetorizada: {e}")
+        return False
+
+def test_template_cache():
+    """Testa cache de templates e payload montado por lote"""
+    print("🗂️ Testando cache de templates...")
+    
+    try:
+        from utils import MessageTemplate, MessageSender
+        
+        original_file = MessageTemplate.TEMPLATES_FILE
+        temp_dir = tempfile.mkdtemp()
+        MessageTemplate.TEMPLATES_FILE = os.path.join(temp_dir, 'message_templates.json')
+        MessageTemplate.invalidate_cache()
+        
+        try:
+            assert MessageTemplate.create_template('promo', {
+                'text': 'Oferta', 'buttons': [{'text': 'Ver', 'url': 'https://example.com'}]
+            })
+            # Leituras seguintes vêm do cache, sem reabrir o arquivo
+            cached = MessageTemplate.get_template('promo')
+            assert MessageTemplate.get_template('promo') is cached
+            assert MessageTemplate.list_templates() == ['promo']
+            
+            # Cópias de load_templates não alteram o cache
+            MessageTemplate.load_templates()['promo']['text'] = 'Alterado'
+            assert MessageTemplate.get_template('promo')['text'] == 'Oferta'
+            
+            # Alteração externa do arquivo invalida o cache (mtime/tamanho)
+            with open(MessageTemplate.TEMPLATES_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'outro': {'text': 'Novo texto'}}, f)
+            assert MessageTemplate.list_templates() == ['outro']
+            
+            # Payload montado uma vez e reaproveitado por linha
+            method, payload = MessageSender.prepare_template_request(cached)
+            assert method == 'sendMessage' and 'chat_id' not in payload
+            _, row_payload = MessageSender._build_template_request('-1001', cached, (method, payload))
+            assert row_payload['chat_id'] == '-1001'
+            assert row_payload['reply_markup'] is payload['reply_markup']
+            assert 'chat_id' not in payload
+        finally:
+            MessageTemplate.TEMPLATES_FILE = original_file
+            MessageTemplate.invalidate_cache()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        print("✅ Cache de templates OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no cache de templates: {e}")
+        return False
+
+def test_media_store():
+    """Testa upload único de fotos por bot e cache de file_id"""
+    print("🖼️ Testando cache de mídia por bot...")
+    
+    try:
+        import httpx
+        import utils
+        from utils import MediaStore, MessageSender
+        
+        original_dir = utils.MEDIA_DIR
+        temp_dir = tempfile.mkdtemp()
+        utils.MEDIA_DIR = temp_dir
+        MediaStore._file_ids = None
+        calls = {'uploads': 0, 'by_id': 0}
+        
+        def handler(request):
+            bot_id = request.url.path.split('/bot')[1].split(':')[0]
+            if request.headers['content-type'].startswith('multipart/'):
+                calls['uploads'] += 1
+            else:
+                assert json.loads(request.content)['photo'] == f'fid-{bot_id}'
+                calls['by_id'] += 1
+            return httpx.Response(200, json={'ok': True, 'result': {
+                'message_id': 1, 'photo': [{'file_id': 'thumb'}, {'file_id': f'fid-{bot_id}'}]
+            }})
+        
+        async def send_batch(messages, template):
+            MessageSender._async_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            MessageSender._async_client_loop = asyncio.get_running_loop()
+            try:
+                return await MessageSender.send_batch_async(messages, template)
+            finally:
+                await MessageSender.close()
+        
+        try:
+            photo_ref = MediaStore.save(b'fake-jpeg-bytes')
+            assert MediaStore.save(b'fake-jpeg-bytes') == photo_ref  # bytes guardados uma vez
+            template = {'text': 'Oferta', 'photo': photo_ref}
+            messages = [
+                {'api_key': f'{bot}:TOKEN', 'chat_id': f'-100{i}', 'mensagem': ''}
+                for i, bot in enumerate(['111', '222', '111', '222', '111'])
+            ]
+            
+            results = asyncio.run(send_batch(messages, template))
+            assert all(result['success'] for result in results)
+            assert calls == {'uploads': 2, 'by_id': 3}  # um upload por bot
+            assert MediaStore._locks == {}  # locks removidos após os uploads
+            
+            # Cache persistido: após reinício, só file_id
+            MediaStore._file_ids = None
+            results = asyncio.run(send_batch(messages[:2], template))
+            assert all(result['success'] for result in results)
+            assert calls == {'uploads': 2, 'by_id': 5}
+        finally:
+            utils.MEDIA_DIR = original_dir
+            MediaStore._file_ids = None
+            MediaStore._locks.clear()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        print("✅ Cache de mídia OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no cache de mídia: {e}")
+        return False
+
 def test_message_sender():
     """Testa simulação de envio de mensagens"""
     print("📤 Testando simulação de envio...")
@@ -155,6 +924,21 @@ def test_message_sender():
         assert not result['success']
         assert 'error' in result
         
+        # Testar versão assíncrona (cliente HTTP compartilhado)
+        async def send_async():
+            try:
+                return await MessageSender.send_message_async(
+                    'invalid_key',
+                    'invalid_chat',
+                    'Mensagem de teste'
+                )
+            finally:
+                await MessageSender.close()
+        
+        result = asyncio.run(send_async())
+        assert not result['success']
+        assert 'error' in result
+        
         print("✅ Simulação de envio OK")
         return True
         
@@ -162,6 +946,696 @@ def test_message_sender():
         print(f"❌ Erro no envio: {e}")
         return False
 
+def test_batch_dispatch():
+    """Testa envio concorrente de lote com janela limitada"""
+    print("🚚 Testando envio concorrente de lote...")
+    
+    try:
+        from utils import MessageSender
+        
+        original_send_row = MessageSender.send_row_async
+        in_flight = {'current': 0, 'max': 0}
+        
+        async def fake_send_row(message_data, template=None, prepared=None):
+            in_flight['current'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+            await asyncio.sleep(0.01 * (5 - int(message_data['chat_id']) % 5))
+            in_flight['current'] -= 1
+            return {'success': True, 'chat_id': message_data['chat_id']}
+        
+        rows = [{'api_key': '123:ABC', 'chat_id': str(i), 'mensagem': 'Teste'} for i in range(10)]
+        
+        MessageSender.send_row_async = staticmethod(fake_send_row)
+        try:
+            results = asyncio.run(MessageSender.send_batch_async(rows, max_in_flight=3))
+            
+            # Ordem preservada e janela respeitada
+            assert [r['chat_id'] for r in results] == [row['chat_id'] for row in rows]
+            assert in_flight['max'] == 3
+            
+            # Linhas não iniciadas após pausa retornam None
+            results = asyncio.run(MessageSender.send_batch_async(
+                rows, max_in_flight=1, should_continue=lambda: False
+            ))
+            assert results == [None] * len(rows)
+        finally:
+            MessageSender.send_row_async = original_send_row
+        
+        print("✅ Envio concorrente de lote OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no envio concorrente: {e}")
+        return False
+
+def test_benchmark():
+    """Testa servidor falso da API e campanha sintética do benchmark"""
+    print("🏁 Testando benchmark de envio...")
+    
+    try:
+        from benchmark import FakeBotAPI, run_campaign
+        from utils import MessageSender
+        
+        async def run():
+            api = FakeBotAPI(latency_ms=1, rate_429=0.05, rate_5xx=0.05, seed=1)
+            await api.start()
+            try:
+                # getMe e sendPhoto (file_id devolvido para o cache de mídia)
+                saved_url = MessageSender.API_URL
+                MessageSender.API_URL = api.url
+                try:
+                    api.rate_429 = api.rate_5xx = 0
+                    me = await MessageSender._post_async('1:A', 'getMe', {})
+                    photo = await MessageSender._post_async('1:A', 'sendPhoto', {'chat_id': '-1', 'photo': 'x'})
+                    assert me['success'] and photo['file_id'].startswith('bench-photo-')
+                    api.rate_429 = api.rate_5xx = 0.05
+                finally:
+                    MessageSender.API_URL = saved_url
+                    await MessageSender.close()
+                
+                # 429 voltam para a fila; 5xx são reenviados com backoff
+                result = await run_campaign(300, api, bots=5, batch_size=50, rate_limit=False)
+                assert result['sent'] + result['errors'] == 300
+                assert 0 < result['retries'] <= api.responses[502] and result['errors'] < api.responses[502]
+                assert result['attempts'] == api.requests['sendMessage'] > 300
+                assert result['messages_per_second'] > 0 and result['latency_p99_ms'] >= result['latency_p50_ms']
+                assert result['disk_bytes'] > 0
+            finally:
+                await api.stop()
+        
+        asyncio.run(run())
+        
+        print("✅ Benchmark de envio OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no benchmark: {e}")
+        return False
+
+def test_update_processing():
+    """Testa processamento concorrente de updates e configuração do webhook"""
+    print("📬 Testando recebimento de updates...")
+    
+    try:
+        import importlib.util
+        import main
+        from telegram import Update, CallbackQuery, User
+        
+        def update(update_id, user_id):
+            user = User(id=user_id, first_name='Teste', is_bot=False)
+            return Update(update_id, callback_query=CallbackQuery(str(update_id), user, 'chat'))
+        
+        async def run():
+            processor = main.UserOrderedUpdateProcessor(2)
+            events, active = [], {'current': 0, 'max': 0}
+            
+            async def handle(update_id, user_id):
+                active['current'] += 1
+                active['max'] = max(active['max'], active['current'])
+                events.append(('start', user_id, update_id))
+                await asyncio.sleep(0.01)
+                events.append(('end', user_id, update_id))
+                active['current'] -= 1
+            
+            updates = [(1, 10), (2, 10), (3, 20), (4, 10), (5, 30)]
+            await asyncio.gather(*(
+                processor.process_update(update(uid, user), handle(uid, user)) for uid, user in updates
+            ))
+            return events, active, processor
+        
+        events, active, processor = asyncio.run(run())
+        # Limite global respeitado, usuários diferentes em paralelo
+        assert active['max'] == 2 and not processor.users
+        # Mesmo usuário: um de cada vez, na ordem de chegada
+        user_events = [event for event in events if event[1] == 10]
+        assert [event[2] for event in user_events] == [1, 1, 2, 2, 4, 4]
+        assert [event[0] for event in user_events] == ['start', 'end'] * 3
+        
+        # Só os tipos tratados pelos handlers; webhook apenas com URL e extra instalado
+        assert main.ALLOWED_UPDATES == [Update.MESSAGE, Update.CALLBACK_QUERY]
+        application = main.build_application('123:ABC')
+        assert application.update_processor.max_concurrent_updates == main.MAX_CONCURRENT_UPDATES
+        
+        # Webhook pedido mas mal configurado: encerra em vez de cair para polling
+        # (run_polling apagaria o webhook das demais instâncias)
+        def assert_exits(function):
+            try:
+                function()
+            except SystemExit as e:
+                assert e.code == 1
+            else:
+                assert False, "webhook mal configurado não encerrou"
+        
+        saved = (main.WEBHOOK_URL, main.WEBHOOK_SECRET_TOKEN, importlib.util.find_spec)
+        try:
+            main.WEBHOOK_URL = ''
+            assert main.webhook_settings() is None
+            main.WEBHOOK_URL = 'https://bot.example.com/telegram/hook'
+            importlib.util.find_spec = lambda name, *args: None if name == 'tornado' else saved[2](name, *args)
+            assert_exits(main.webhook_settings)
+            importlib.util.find_spec = lambda name, *args: object()
+            main.WEBHOOK_SECRET_TOKEN = ''  # cada instância geraria o próprio segredo
+            assert_exits(main.webhook_settings)
+            main.WEBHOOK_SECRET_TOKEN = 'segredo inválido'
+            assert_exits(main.webhook_settings)
+            main.WEBHOOK_SECRET_TOKEN = 'segredo-compartilhado_1'
+            settings = main.webhook_settings()
+            assert settings['url_path'] == 'telegram/hook' and settings['allowed_updates'] == main.ALLOWED_UPDATES
+            assert settings['secret_token'] == 'segredo-compartilhado_1'
+        finally:
+            main.WEBHOOK_URL, main.WEBHOOK_SECRET_TOKEN, importlib.util.find_spec = saved
+        
+        print("✅ Recebimento de updates OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no recebimento de updates: {e}")
+        return False
+
+def test_rate_limiter():
+    """Testa limitador de taxa por bot e tratamento de 429"""
+    print("🚦 Testando limitador de taxa...")
+    
+    try:
+        from utils import MessageSender, RateLimiter
+        
+        class FakeResponse:
+            status_code = 429
+            text = ''
+            
+            def json(self):
+                return {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': 'Too Many Requests: retry after 30',
+                    'parameters': {'retry_after': 30}
+                }
+        
+        # Resposta 429 traz error_code e retry_after
+        result = MessageSender._parse_response(FakeResponse())
+        assert MessageSender.is_throttled(result)
+        assert result['retry_after'] == 30
+        
+        # Pausa afeta apenas o bot limitado
+        limiter = RateLimiter(bot_rate=1000, chat_interval=0.05)
+        limiter.penalize('111:AAA', 30)
+        assert limiter.pause_remaining('111:AAA') > 25
+        assert limiter.pause_remaining('222:BBB') == 0
+        
+        original_send_row = MessageSender.send_row_async
+        sent = []
+        
+        async def fake_send_row(message_data, template=None, prepared=None):
+            sent.append(message_data['api_key'])
+            return {'success': True, 'timestamp': datetime.now().isoformat()}
+        
+        rows = [
+            {'api_key': '111:AAA', 'chat_id': '-1001', 'mensagem': 'Teste'},
+            {'api_key': '222:BBB', 'chat_id': '-1002', 'mensagem': 'Teste'},
+            {'api_key': '222:BBB', 'chat_id': '-1002', 'mensagem': 'Teste'}
+        ]
+        
+        MessageSender.send_row_async = staticmethod(fake_send_row)
+        try:
+            started = datetime.now()
+            results = asyncio.run(MessageSender.send_batch_async(rows, rate_limiter=limiter))
+            elapsed = (datetime.now() - started).total_seconds()
+        finally:
+            MessageSender.send_row_async = original_send_row
+        
+        # Linha do bot pausado volta como 429 sem chamar a API
+        assert MessageSender.is_throttled(results[0])
+        assert results[1]['success'] and results[2]['success']
+        assert sent == ['222:BBB', '222:BBB']
+        
+        # Mesmo chat respeita o intervalo mínimo
+        assert elapsed >= 0.05
+        
+        print("✅ Limitador de taxa OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no limitador de taxa: {e}")
+        return False
+
+def test_campaign_control():
+    """Testa sinais de controle que interrompem esperas longas"""
+    print("🎛️ Testando controle da campanha...")
+    
+    try:
+        import time
+        from utils import CampaignControl
+        
+        async def scenario():
+            control = CampaignControl()
+            
+            # Cancelamento interrompe espera de uma hora
+            started = time.monotonic()
+            asyncio.get_running_loop().call_later(0.05, control.cancel)
+            assert not await control.sleep(3600)
+            assert time.monotonic() - started < 1
+            
+            # Reconfiguração recalcula a espera sem interromper
+            control = CampaignControl()
+            config = {'interval': 3600}
+            def reconfigure():
+                config['interval'] = 0.1
+                control.reconfigure()
+            asyncio.get_running_loop().call_later(0.05, reconfigure)
+            assert await control.sleep(lambda: config['interval'])
+            
+            # Pausa bloqueia até a retomada, sem polling
+            control.pause()
+            assert not control.should_continue()
+            asyncio.get_running_loop().call_later(0.05, control.resume)
+            await asyncio.wait_for(control.wait_resumed(), 1)
+            assert control.should_continue()
+        
+        asyncio.run(scenario())
+        
+        print("✅ Controle da campanha OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no controle da campanha: {e}")
+        return False
+
+def test_campaign_supervisor():
+    """Testa reinício de loops com falha e desligamento ordenado"""
+    print("🛡️ Testando supervisor de campanhas...")
+    
+    try:
+        from handlers import BotHandlers, CampaignSupervisor, user_sessions
+        from utils import CampaignControl
+        
+        original_loop = BotHandlers._sending_loop
+        runs = []
+        
+        async def fake_loop(context, user_id, lang, control, campaign_id, messages_queue):
+            runs.append((user_id, campaign_id, messages_queue))
+            if len(runs) == 1:
+                raise RuntimeError('falha simulada')
+            await control.wait_resumed()
+            await control.sleep(3600)
+        
+        async def scenario():
+            supervisor = CampaignSupervisor(max_restarts=2, restart_delay=0.01)
+            control = CampaignControl()
+            user_sessions.update_session('test_supervisor', {'control': control})
+            supervisor.start(None, 'test_supervisor', 'test_campaign', 'pt-BR', control, 'queue')
+            
+            # Primeira execução falha e é reiniciada
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if len(runs) == 2:
+                    break
+            assert len(runs) == 2 and supervisor.restarts['test_campaign'] == 1
+            assert runs[1] == ('test_supervisor', 'test_campaign', 'queue')  # mesma campanha e fila
+            assert supervisor.running() == ['test_campaign']
+            
+            # Tasks de apoio ficam referenciadas até terminar (falhas só vão para o log)
+            async def failing():
+                raise RuntimeError('falha simulada')
+            supervisor.spawn(failing(), 'failing')
+            ingest = supervisor.spawn(asyncio.sleep(3600), 'ingest-test')
+            await asyncio.sleep(0.01)
+            assert supervisor.background == {ingest}
+            
+            # Desligamento interrompe a espera e marca a campanha como parada
+            await asyncio.wait_for(supervisor.shutdown(timeout=0.1), 2)
+            assert supervisor.running() == [] and control.status == 'stopped'
+            assert ingest.cancelled() and not supervisor.background
+        
+        async def slow_cancel_loop(context, user_id, lang, control, campaign_id, messages_queue):
+            runs.append((user_id, campaign_id, messages_queue))
+            await control.sleep(3600)
+            await asyncio.sleep(0.05)  # lote em andamento ao cancelar
+        
+        async def restart_after_cancel():
+            from types import SimpleNamespace
+            from handlers import supervisor
+            
+            async def edit_message_text(text, **kwargs):
+                pass
+            
+            query = SimpleNamespace(from_user=SimpleNamespace(id='test_supervisor'),
+                                    edit_message_text=edit_message_text)
+            user_sessions.update_session('test_supervisor', {
+                'campaign_id': 'test_restart', 'messages_queue': 'queue', 'control': None
+            })
+            await BotHandlers._start_sending_process(query, None, 'pt-BR')
+            first = user_sessions.get_session('test_supervisor')['control']
+            
+            # Novo início enquanto o loop cancelado termina o lote: outro loop com controle novo
+            BotHandlers._signal('test_supervisor', 'cancel')
+            await asyncio.wait_for(BotHandlers._start_sending_process(query, None, 'pt-BR'), 1)
+            second = user_sessions.get_session('test_supervisor')['control']
+            assert second is not first and not second.cancelled
+            assert supervisor.is_running('test_restart') and len(runs) == 4
+            second.cancel()
+            await supervisor.wait_stopped('test_restart')
+        
+        BotHandlers._sending_loop = staticmethod(fake_loop)
+        try:
+            asyncio.run(scenario())
+            BotHandlers._sending_loop = staticmethod(slow_cancel_loop)
+            asyncio.run(restart_after_cancel())
+        finally:
+            BotHandlers._sending_loop = original_loop
+            user_sessions.clear_session('test_supervisor')
+        
+        print("✅ Supervisor de campanhas OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no supervisor de campanhas: {e}")
+        return False
+
+def test_upload_during_send():
+    """Testa nova planilha durante um envio: a campanha em andamento não é trocada"""
+    print("📥 Testando planilha durante o envio...")
+    
+    temp_dir = tempfile.mkdtemp()
+    saved = None
+    try:
+        import utils
+        from types import SimpleNamespace
+        from handlers import BotHandlers, user_sessions, supervisor
+        from utils import CampaignStore, CampaignControl, MessageQueue, MessageSender
+        
+        saved = CampaignStore._default, utils.REPORTS_DIR, MessageSender.send_batch_async
+        store = CampaignStore._default = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        utils.REPORTS_DIR = temp_dir
+        
+        async def fake_batch(batch, template=None, **kwargs):
+            await asyncio.sleep(0.01)
+            return [{'success': True, 'timestamp': '2024-01-01T00:00:00', 'latency_ms': 1} for _ in batch]
+        
+        MessageSender.send_batch_async = staticmethod(fake_batch)
+        
+        class FakeBot:
+            def __init__(self):
+                self.sent, self.files = [], []
+            async def send_message(self, user_id, text, **kwargs):
+                self.sent.append(text)
+                return SimpleNamespace(message_id=1)
+            async def edit_message_text(self, *args, **kwargs):
+                pass
+            async def send_document(self, *args, **kwargs):
+                pass
+            async def get_file(self, file_id):
+                self.files.append(file_id)
+        
+        context = SimpleNamespace(bot=FakeBot())
+        replies = []
+        
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+        
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id='upload_user'),
+            message=SimpleNamespace(document=SimpleNamespace(file_name='nova.csv', file_id='f1'),
+                                    reply_text=reply_text)
+        )
+        
+        campaign_id = store.create_campaign('upload_user')
+        queue = MessageQueue(store, campaign_id)
+        queue.ingest([{'api_key': '123:ABC', 'chat_id': f'-100{i}', 'mensagem': 'Teste'} for i in range(6)])
+        
+        async def scenario():
+            control = CampaignControl()
+            user_sessions.update_session('upload_user', {
+                'authenticated': True, 'campaign_id': campaign_id, 'messages_queue': queue,
+                'current_config': {'interval': 0, 'batch_size': 2}, 'sending_active': True, 'control': control
+            })
+            supervisor.start(context, 'upload_user', campaign_id, 'pt-BR', control, queue)
+            await asyncio.sleep(0.015)
+            
+            # Planilha recusada enquanto o envio está ativo (nada é baixado)
+            await BotHandlers.handle_document(update, context)
+            assert context.bot.files == [] and len(replies) == 1
+            
+            # Mesmo com a sessão trocada por outro rascunho, o loop conclui a própria campanha
+            draft_id = store.create_campaign('upload_user')
+            draft = MessageQueue(store, draft_id)
+            draft.ingest([{'api_key': '123:ABC', 'chat_id': '-2001', 'mensagem': 'Nova'}])
+            user_sessions.update_session('upload_user', {'campaign_id': draft_id, 'messages_queue': draft})
+            await asyncio.wait_for(supervisor.tasks[campaign_id], 5)
+            return draft_id
+        
+        draft_id = asyncio.run(scenario())
+        assert store.get_campaign(campaign_id)['status'] == 'completed'
+        assert store.count_by_status(campaign_id) == {'✅ Enviado': 6}
+        assert store.get_campaign(draft_id)['status'] == 'draft'
+        assert user_sessions.get_session('upload_user')['campaign_id'] == draft_id
+        
+        print("✅ Planilha durante o envio OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na planilha durante o envio: {e}")
+        return False
+    finally:
+        if saved:
+            CampaignStore._default.close()
+            CampaignStore._default, utils.REPORTS_DIR, MessageSender.send_batch_async = saved
+        user_sessions.clear_session('upload_user')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_campaign_progress():
+    """Testa contadores e limite de frequência da mensagem de progresso"""
+    print("📊 Testando progresso da campanha...")
+    
+    try:
+        from utils import CampaignProgress
+        
+        progress = CampaignProgress(min_interval=60, max_errors=2)
+        assert progress.eta_seconds(10) is None
+        
+        progress.record(True, '-1001')
+        for i in range(3):
+            progress.record(False, f'-100{i}', f'erro {i}')
+        progress.record_requeued()
+        assert (progress.sent, progress.errors, progress.requeued) == (1, 3, 1)
+        assert list(progress.recent_errors) == [('-1001', 'erro 1'), ('-1002', 'erro 2')]
+        assert progress.rate_per_minute() > 0
+        assert progress.eta_seconds(0) == 0
+        
+        # Primeira atualização sempre; depois só após o intervalo (ou forçada)
+        assert progress.should_update()
+        progress.mark_updated()
+        assert not progress.should_update()
+        assert progress.should_update(force=True)
+        
+        print("✅ Progresso da campanha OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no progresso da campanha: {e}")
+        return False
+
+def test_stage_timer():
+    """Testa tempo por etapa do envio (acumulado, persistido e no relatório)"""
+    print("⏱️ Testando tempo por etapa...")
+    
+    try:
+        from utils import StageTimer, MessageSender, ReportGenerator
+        
+        timer = StageTimer()
+        timer.record('http', 0.2)
+        timer.record('http', 0.1)
+        with timer.measure('store_flush'):
+            pass
+        assert timer.stages['http'][0] == 2 and abs(timer.stages['http'][2] - 0.2) < 1e-9
+        assert timer.rows()[0][:2] == ('http', 2) and timer.rows()[0][3] == 150.0
+        assert 'store_flush' in timer.format_text()
+        
+        # Persistido na configuração da campanha (JSON) e retomado
+        restored = StageTimer.from_dict(json.loads(json.dumps(timer.to_dict())))
+        restored.record('http', 0.3)
+        assert restored.stages['http'][0] == 3 and restored.stages['http'][2] == 0.3
+        assert StageTimer.from_dict({'ruim': 'x'}).stages == {}
+        
+        # Etapas por linha medidas pelo envio do lote
+        original_send_row = MessageSender.send_row_async
+        
+        async def fake_send_row(message_data, template=None, prepared=None):
+            await asyncio.sleep(0.01)
+            return {'success': True}
+        
+        rows = [{'api_key': '123:ABC', 'chat_id': str(i), 'mensagem': 'Teste'} for i in range(4)]
+        MessageSender.send_row_async = staticmethod(fake_send_row)
+        try:
+            batch_timer = StageTimer()
+            asyncio.run(MessageSender.send_batch_async(rows, max_in_flight=2, timer=batch_timer))
+        finally:
+            MessageSender.send_row_async = original_send_row
+        assert batch_timer.stages['http'][0] == 4 and batch_timer.stages['http'][1] >= 0.04
+        assert batch_timer.stages['in_flight_wait'][0] == 4 and batch_timer.stages['in_flight_wait'][2] >= 0.009
+        
+        # Seção própria no resumo do relatório
+        report_path, summary = ReportGenerator.write_report(
+            iter([{'api_key': '1:A', 'chat_id': '1', 'status_envio': '✅ Enviado'}]),
+            'test_user', 'csv', timer
+        )
+        with open(report_path, encoding='utf-8-sig') as f:
+            content = f.read()
+        os.unlink(report_path)
+        assert 'Tempo por etapa,contagem' in content and 'http,2,0.3,150.0,200.0' in content
+        
+        # /timings sem ADMIN_USER_ID: cada usuário vê só as próprias campanhas
+        import handlers
+        from types import SimpleNamespace
+        
+        def timings(user_id, *args):
+            replies = []
+            async def reply_text(text, **kwargs):
+                replies.append(text)
+            update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id),
+                                     message=SimpleNamespace(reply_text=reply_text))
+            asyncio.run(handlers.BotHandlers.timings_command(update, SimpleNamespace(args=list(args))))
+            return '\n'.join(replies)
+        
+        saved_admin = handlers.ADMIN_USER_ID
+        handlers.ADMIN_USER_ID = None
+        try:
+            for user_id in ('timings_a', 'timings_b'):
+                handlers.user_sessions.update_session(user_id, {
+                    'authenticated': True, 'campaign_id': f'campanha_{user_id}', 'stage_timer': timer
+                })
+            assert 'campanha_timings_a' in timings('timings_a')
+            assert 'campanha_timings_b' not in timings('timings_a')
+            assert 'campanha_timings_b' not in timings('timings_a', 'campanha_timings_b')
+        finally:
+            handlers.ADMIN_USER_ID = saved_admin
+            for user_id in ('timings_a', 'timings_b'):
+                handlers.user_sessions.clear_session(user_id)
+        
+        print("✅ Tempo por etapa OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no tempo por etapa: {e}")
+        return False
+
+def test_callback_router():
+    """Testa roteamento dos botões inline por tabela"""
+    print("🧭 Testando roteamento de callbacks...")
+    
+    try:
+        import metrics
+        import handlers
+        from utils import CallbackRouter, MessageBuilder, LoopManager
+        
+        calls = []
+        
+        async def handler(*args):
+            calls.append(args)
+        
+        router = CallbackRouter()
+        router.add('start_sending', handler)
+        router.add_prefix('edit_', handler, name='edit_action')
+        router.add_prefix('edit_template_', handler, handlers._template_name)  # registrado depois
+        router.add_prefix('page_', handler, int)
+        
+        # Chave exata, prefixo mais longo e parâmetro tipado
+        assert router.resolve('start_sending')[0] == 'start_sending'
+        assert router.resolve('edit_template_promo')[0::2] == ('edit_template_*', 'promo')
+        assert router.resolve('edit_text')[0::2] == ('edit_action', 'text')
+        assert router.resolve('page_3')[2] == 3
+        assert router.resolve('page_x') is None and router.resolve('edit_template_') is None
+        assert router.resolve('desconhecido') is None and router.resolve('') is None
+        try:
+            router.add_prefix('page_', handler)
+            assert False, "prefixo duplicado aceito"
+        except ValueError:
+            pass
+        
+        unknown = metrics.callbacks_unknown.get()
+        assert asyncio.run(router.dispatch('page_7', 'query', 'context'))
+        assert not asyncio.run(router.dispatch('page_', 'query', 'context'))
+        assert calls == [('query', 'context', 7)]
+        assert metrics.callbacks.get('page_*') == 1 and metrics.callbacks_unknown.get() == unknown + 1
+        assert metrics.callback_routing_seconds.count() >= 2
+        
+        # Todo botão gerado pelos teclados tem rota
+        keyboards = [
+            MessageBuilder.create_edit_keyboard(), MessageBuilder.create_edit_keyboard('promo'),
+            MessageBuilder.create_button_edit_keyboard(), LoopManager.create_loop_keyboard()
+        ]
+        emitted = [button.callback_data for keyboard in keyboards
+                   for row in keyboard.inline_keyboard for button in row]
+        emitted += ['select_template_promo', 'edit_template_promo', 'delete_template_promo', 'back_to_main',
+                    'backup_resume', 'backup_cancel', 'upload_file', 'no_template', 'lang_en-US']
+        missing = [data for data in emitted if handlers.callback_router.resolve(data) is None]
+        assert not missing, missing
+        assert handlers.callback_router.resolve('delete_template_promo')[0] == 'delete_template_*'
+        assert handlers.callback_router.resolve('lang_xx') is None
+        
+        print("✅ Roteamento de callbacks OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro no roteamento de callbacks: {e}")
+        return False
+
+def test_metrics():
+    """Testa métricas no formato Prometheus e verificações de saúde"""
+    print("📈 Testando métricas...")
+    
+    try:
+        import metrics
+        from metrics import MetricsServer, Counter, Histogram
+        
+        counter = Counter('test_total', 'Teste', ('bot', 'error_code'))
+        counter.inc('123', 400)
+        counter.inc('123', 400)
+        assert counter.render() == ['test_total{bot="123",error_code="400"} 2']
+        
+        histogram = Histogram('test_seconds', 'Teste', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 2):
+            histogram.observe(value)
+        lines = histogram.render()
+        assert 'test_seconds_bucket{le="0.1"} 1' in lines and 'test_seconds_bucket{le="+Inf"} 3' in lines
+        assert 'test_seconds_count 3' in lines
+        
+        # O token nunca vira label, só o id do bot
+        metrics.record_send('777:SECRET', {'success': False, 'error_code': 403})
+        assert metrics.messages_failed.get('777', 403) == 1
+        
+        async def fetch(port, path):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = (await reader.read()).decode()
+            writer.close()
+            return response
+        
+        async def run():
+            ready = {'value': False}
+            server = MetricsServer('127.0.0.1', 0, ready=lambda: ready['value'])
+            await server.start()
+            try:
+                body = await fetch(server.port, '/metrics')
+                assert body.startswith('HTTP/1.1 200')
+                assert 'botgerenciador_messages_failed_total{bot="777",error_code="403"} 1' in body
+                assert 'SECRET' not in body and '# TYPE botgerenciador_api_request_duration_seconds histogram' in body
+                assert (await fetch(server.port, '/healthz')).startswith('HTTP/1.1 200')
+                assert (await fetch(server.port, '/readyz')).startswith('HTTP/1.1 503')
+                ready['value'] = True
+                assert (await fetch(server.port, '/readyz')).startswith('HTTP/1.1 200')
+                assert (await fetch(server.port, '/outro')).startswith('HTTP/1.1 404')
+            finally:
+                await server.stop()
+        
+        asyncio.run(run())
+        
+        print("✅ Métricas OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro nas métricas: {e}")
+        return False
+
 def test_report_generator():
     """Testa gerador de relatórios"""
     print("📋 Testando gerador de relatórios...")
@@ -190,19 +1664,38 @@ def test_report_generator():
         ]
         
         # Gerar relatório
-        report_path = ReportGenerator.generate_report(test_messages, 'test_user')
+        report_path = ReportGenerator.generate_report(test_messages, 'test_user', 'csv')
         
         assert report_path is not None
         assert os.path.exists(report_path)
         
-        # Verificar conteúdo
-        df = pd.read_csv(report_path)
+        # Verificar conteúdo (linhas e, após uma linha em branco, o resumo)
+        df = pd.read_csv(report_path, nrows=2)
         assert len(df) == 2
         assert 'api_key' in df.columns
+        with open(report_path, encoding='utf-8-sig') as f:
+            content = f.read()
+        assert 'Resumo' in content and 'Taxa de sucesso (%),50.0' in content
         
         # Limpar arquivo de teste
         os.unlink(report_path)
         
+        # Resumo: erros por código e por bot, percentis de latência
+        rows = [
+            dict(test_messages[0], latencia_ms=float(ms)) for ms in range(1, 101)
+        ] + [dict(test_messages[1], codigo_erro=403)]
+        report_path, summary = ReportGenerator.write_report(iter(rows), 'test_user', 'csv.gz')
+        assert summary.total == 101 and summary.sent == 100 and summary.errors == 1
+        assert summary.errors_by_code == {403: 1} and summary.errors_by_bot == {'456:DEF': 1}
+        assert summary.percentile(50) == 50.0 and summary.percentile(99) == 99.0
+        assert len(pd.read_csv(report_path, nrows=101)) == 101
+        os.unlink(report_path)
+        
+        report_path = ReportGenerator.generate_report(test_messages, 'test_user', 'xlsx')
+        sheets = pd.read_excel(report_path, sheet_name=None)
+        assert list(sheets) == ['Envios', 'Resumo'] and len(sheets['Envios']) == 2
+        os.unlink(report_path)
+        
         print("✅ Gerador de relatórios OK")
         return True
         
@@ -214,31 +1707,149 @@ def test_user_session():
     """Testa sistema de sessões"""
     print("👤 Testando sistema de sessões...")
     
+    temp_dir = tempfile.mkdtemp()
     try:
-        from utils import UserSession
+        from utils import UserSession, Session, CampaignStore, MessageQueue, CampaignControl
         
-        session_manager = UserSession()
+        session_manager = UserSession(persist=False)
         
         # Testar criação de sessão
         session = session_manager.get_session('test_user')
         assert session is not None
         assert not session['authenticated']
+        assert isinstance(session, Session) and not hasattr(session, '__dict__')
         
         # Testar atualização
         session_manager.update_session('test_user', {'authenticated': True})
         updated_session = session_manager.get_session('test_user')
         assert updated_session['authenticated']
+        assert session.get('temp_template', {}) == {} and 'campaign_id' not in session
         
         # Testar limpeza
         session_manager.clear_session('test_user')
         assert 'test_user' not in session_manager.sessions
         
+        # Não autenticadas: expiram sem atividade e saem primeiro acima do limite
+        session_manager = UserSession(persist=False, ttl=60, max_entries=3)
+        session_manager.update_session('admin', {'authenticated': True})
+        for user_id in ('a', 'b', 'c', 'd'):
+            session_manager.get_session(user_id)
+        assert list(session_manager.sessions) == ['admin', 'c', 'd']
+        session_manager.sessions['c'].touched -= 120
+        session_manager.get_session('e')
+        assert list(session_manager.sessions) == ['admin', 'd', 'e']
+        
+        # Mapa cheio de autenticadas: a sessão nova não é descartada (nem suas escritas)
+        session_manager = UserSession(persist=False, ttl=60, max_entries=2)
+        for user_id in ('x', 'y'):
+            session_manager.update_session(user_id, {'authenticated': True})
+        session_manager.update_session('novo', {'login_attempts': 1})
+        assert session_manager.get_session('novo')['login_attempts'] == 1
+        assert list(session_manager.sessions) == ['x', 'y', 'novo']
+        
+        # Autenticadas gravadas no banco e carregadas no primeiro acesso
+        saved_store = CampaignStore._default
+        store = CampaignStore._default = CampaignStore(os.path.join(temp_dir, 'campaigns.db'))
+        try:
+            campaign_id = store.create_campaign('admin')
+            MessageQueue(store, campaign_id).ingest([{'api_key': '123:ABC', 'chat_id': '-1001', 'mensagem': 'Teste'}])
+            store.update_campaign(campaign_id, config={'ingested': True})
+            
+            before = UserSession()
+            before.get_session('visitante')
+            before.update_session('admin', {
+                'authenticated': True,
+                'language': 'en-US',
+                'campaign_id': campaign_id,
+                'current_config': {'interval': 5, 'batch_size': 10},
+                'state': 'config_summary',
+                'control': CampaignControl()
+            })
+            assert store.load_session('visitante') is None and 'control' not in store.load_session('admin')
+            assert store.session_campaigns() == {campaign_id}
+            
+            after = UserSession()  # reinício
+            assert not after.sessions
+            restored = after.get_session('admin')
+            assert restored['authenticated'] and restored['language'] == 'en-US'
+            assert restored['state'] == 'config_summary' and len(restored['messages_queue']) == 1
+            assert restored.get('control') is None
+            
+            # Sem o rascunho, estados que dependem da fila voltam ao menu
+            store.delete_campaign(campaign_id)
+            restored = UserSession().get_session('admin')
+            assert restored['campaign_id'] is None and restored['state'] == 'main_menu'
+            
+            after.clear_session('admin')
+            assert store.load_session('admin') is None
+        finally:
+            store.close()
+            CampaignStore._default = saved_store
+        
         print("✅ Sistema de sessões OK")
         return True
         
     except Exception as e:
         print(f"❌ Erro nas sessões: {e}")
         return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_loop_configuration():
+    """Testa intervalo do loop configurado e depois o loop ativado"""
+    print("🔁 Testando configuração do loop...")
+    
+    temp_dir = tempfile.mkdtemp()
+    saved = None
+    try:
+        from types import SimpleNamespace
+        from handlers import BotHandlers, user_sessions
+        from utils import LoopManager
+        
+        saved = LoopManager.LOOP_CONFIG_FILE, asyncio.sleep
+        LoopManager.LOOP_CONFIG_FILE = os.path.join(temp_dir, 'loop_config.json')
+        real_sleep = asyncio.sleep
+        
+        async def no_wait(delay, *args, **kwargs):
+            await real_sleep(0)
+        
+        asyncio.sleep = no_wait
+        replies = []
+        
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+        
+        user = SimpleNamespace(id='loop_user')
+        message = SimpleNamespace(text=' 30 ', reply_text=reply_text)
+        update = SimpleNamespace(effective_user=user, message=message)
+        query = SimpleNamespace(from_user=user, effective_user=user, message=message, edit_message_text=reply_text)
+        context = SimpleNamespace(bot=None)
+        
+        user_sessions.update_session('loop_user', {
+            'authenticated': True, 'selected_template': 'promo', 'state': 'configuring_loop_interval'
+        })
+        session = user_sessions.get_session('loop_user')
+        asyncio.run(BotHandlers._handle_loop_interval_input(update, context, session, 'pt-BR'))
+        assert session['state'] == 'authenticated' and session['interval_minutes'] == 30
+        assert any('30' in reply for reply in replies)
+        
+        # Ativar o loop mantém o intervalo escolhido
+        asyncio.run(BotHandlers._handle_loop_enable(query, context))
+        config = LoopManager.load_loop_config('loop_user')
+        assert config['enabled'] and config['interval_minutes'] == 30
+        assert config['template_name'] == 'promo'
+        
+        print("✅ Configuração do loop OK")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Erro na configuração do loop: {e}")
+        return False
+    finally:
+        if saved:
+            LoopManager.LOOP_CONFIG_FILE, asyncio.sleep = saved
+        user_sessions.clear_session('loop_user')
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 def test_utilities():
     """Testa funções utilitárias"""
@@ -276,11 +1887,32 @@ def run_all_tests():
     tests = [
         test_imports,
         test_translations,
-        test_backup_system,
+        test_campaign_store,
+        test_message_queue,
+        test_queue_deduplication,
+        test_retry_policy,
+        test_dead_destinations,
+        test_bot_preflight,
         test_spreadsheet_processor,
+        test_streaming_ingestion,
+        test_vectorized_validation,
+        test_template_cache,
+        test_media_store,
         test_message_sender,
+        test_batch_dispatch,
+        test_benchmark,
+        test_update_processing,
+        test_rate_limiter,
+        test_campaign_control,
+        test_campaign_supervisor,
+        test_upload_during_send,
+        test_campaign_progress,
+        test_stage_timer,
+        test_callback_router,
+        test_metrics,
         test_report_generator,
         test_user_session,
+        test_loop_configuration,
         test_utilities
     ]
     
@@ -19,6 +19,7 @@ TRANSLATIONS = {
         'upload_cancel': '❌ Cancelar',
         'upload_success': '✅ Planilha carregada com sucesso!',
         'upload_error': '❌ Erro ao processar planilha. Verifique o formato.',
+        'upload_busy': '⏳ Há um envio em andamento. Aguarde a conclusão ou cancele-o antes de enviar uma nova planilha.',
         
         # Configuração
         'config_interval': '⏱️ Informe o intervalo de envio (em minutos):',
@@ -27,6 +28,14 @@ TRANSLATIONS = {
         'config_start': '▶️ Iniciar envio',
         'config_reconfigure': '⚙️ Reconfigurar',
         'config_cancel': '❌ Cancelar',
+        'config_ingesting': '⏳ Planilha ainda em leitura; as novas mensagens entram na fila durante o envio.',
+        'config_rejected': '🚫 Linhas ignoradas: {details}',
+        'config_duplicates': '🔁 Linhas duplicadas (mesmo bot e chat) agrupadas: {count} (política: {policy})',
+        'config_dead_destinations': '⏭️ Linhas para destinos que recusaram mensagens (bot bloqueado, chat inexistente), puladas: {count}',
+        'config_invalid_bots': '🚫 Bots com token inválido (getMe recusou), linhas separadas: {count} ({details})',
+        'reject_campos_vazios': 'campos vazios',
+        'reject_api_key_invalida': 'api_key inválida',
+        'reject_chat_id_invalido': 'chat_id inválido',
         
         # Envio
         'send_success': '✅ Mensagem enviada com sucesso para: {chat_id}',
@@ -34,6 +43,7 @@ TRANSLATIONS = {
         'send_paused': '⏸️ Envio pausado.',
         'send_resumed': '▶️ Envio retomado.',
         'send_cancelled': '❌ Envio cancelado.',
+        'campaign_auto_resumed': '🔄 O bot foi reiniciado e sua campanha interrompida foi retomada automaticamente.',
         
         # Backup
         'backup_detected': '🚀 Sistema detectou envio anterior inacabado.\nDeseja:',
@@ -43,6 +53,13 @@ TRANSLATIONS = {
         # Finalização
         'completion_success': '✅ Todas as mensagens foram enviadas com sucesso! 🎯',
         'completion_report': '📥 Aqui está o relatório final.',
+        'report_summary': '📊 Resumo: {total} linhas, {sent} enviadas, {errors} erros, {skipped} duplicadas\n✅ Taxa de sucesso: {rate}%\n⏱️ Latência p50/p95/p99: {latency} ms',
+        'report_errors_by_code': '⚠️ Erros por código:',
+        'report_dead_destinations': '⏭️ Destinos inválidos pulados (sem requisição): {count}',
+        'report_invalid_bots': '🚫 Linhas de bots com token inválido (não enviadas): {count}',
+        'timings_title': '⏱️ Tempo por etapa — campanha {campaign_id} ({status})',
+        'timings_empty': 'ℹ️ Nenhuma campanha com tempos medidos.',
+        'admin_only': '🚫 Comando restrito ao administrador.',
         'completion_new_sheet': '📢 Por favor, envie uma nova planilha para atualizar a fila de mensagens.',
         
         # Botões
@@ -62,6 +79,14 @@ TRANSLATIONS = {
         # Status
         'status_processing': '⏳ Processando...',
         'status_waiting': '⏳ Aguardando próximo ciclo...',
+        'progress_message': '📊 Progresso do envio\n✅ Enviadas: {sent}\n❌ Erros: {errors}\n📋 Pendentes: {pending}\n⚡ Ritmo: {rate} msg/min\n🕒 Tempo restante: {eta}',
+        'progress_recent_errors': '⚠️ Últimos erros:',
+        'progress_retries': '🔁 Reenvios agendados: {count}',
+        'redrive_prompt': '⚠️ {count} linhas falharam e estão na fila de falhas.',
+        'btn_redrive': '🔁 Reenviar falhas ({count})',
+        'redrive_started': '🔁 {count} linhas da fila de falhas voltaram para o envio.',
+        'redrive_empty': 'ℹ️ Nenhuma linha na fila de falhas desta campanha.',
+        'redrive_busy': '⏳ Há um envio em andamento. Reenvie as falhas quando ele terminar.',
         'status_queue_empty': '📭 Fila vazia. Envie uma nova planilha.',
         
         # Sistema de Templates de Mensagem
@@ -106,6 +131,7 @@ TRANSLATIONS = {
         'upload_cancel': '❌ Cancel',
         'upload_success': '✅ Spreadsheet loaded successfully!',
         'upload_error': '❌ Error processing spreadsheet. Check the format.',
+        'upload_busy': '⏳ A send is in progress. Wait for it to finish or cancel it before uploading a new spreadsheet.',
         
         # Configuration
         'config_interval': '⏱️ Enter the sending interval (in minutes):',
@@ -114,6 +140,14 @@ TRANSLATIONS = {
         'config_start': '▶️ Start sending',
         'config_reconfigure': '⚙️ Reconfigure',
         'config_cancel': '❌ Cancel',
+        'config_ingesting': '⏳ Spreadsheet still loading; new messages join the queue while sending.',
+        'config_rejected': '🚫 Skipped rows: {details}',
+        'config_duplicates': '🔁 Duplicate rows (same bot and chat) collapsed: {count} (policy: {policy})',
+        'config_dead_destinations': '⏭️ Rows for destinations that refused messages (bot blocked, chat not found), skipped: {count}',
+        'config_invalid_bots': '🚫 Bots with an invalid token (rejected by getMe), rows set aside: {count} ({details})',
+        'reject_campos_vazios': 'empty fields',
+        'reject_api_key_invalida': 'invalid api_key',
+        'reject_chat_id_invalido': 'invalid chat_id',
         
         # Sending
         'send_success': '✅ Message sent successfully to: {chat_id}',
@@ -121,6 +155,7 @@ TRANSLATIONS = {
         'send_paused': '⏸️ Sending paused.',
         'send_resumed': '▶️ Sending resumed.',
         'send_cancelled': '❌ Sending cancelled.',
+        'campaign_auto_resumed': '🔄 The bot restarted and your interrupted campaign was resumed automatically.',
         
         # Backup
         'backup_detected': '🚀 System detected unfinished previous sending.\nDo you want to:',
@@ -130,6 +165,13 @@ TRANSLATIONS = {
         # Completion
         'completion_success': '✅ All messages sent successfully! 🎯',
         'completion_report': '📥 Here is the final report.',
+        'report_summary': '📊 Summary: {total} rows, {sent} sent, {errors} errors, {skipped} duplicates\n✅ Success rate: {rate}%\n⏱️ Latency p50/p95/p99: {latency} ms',
+        'report_errors_by_code': '⚠️ Errors by code:',
+        'report_dead_destinations': '⏭️ Dead destinations skipped (no request): {count}',
+        'report_invalid_bots': '🚫 Rows of bots with an invalid token (not sent): {count}',
+        'timings_title': '⏱️ Time per stage — campaign {campaign_id} ({status})',
+        'timings_empty': 'ℹ️ No campaign with measured timings.',
+        'admin_only': '🚫 This command is restricted to the administrator.',
         'completion_new_sheet': '📢 Please send a new spreadsheet to update the message queue.',
         
         # Buttons
@@ -149,6 +191,14 @@ TRANSLATIONS = {
         # Status
         'status_processing': '⏳ Processing...',
         'status_waiting': '⏳ Waiting for next cycle...',
+        'progress_message': '📊 Sending progress\n✅ Sent: {sent}\n❌ Errors: {errors}\n📋 Pending: {pending}\n⚡ Rate: {rate} msg/min\n🕒 Time remaining: {eta}',
+        'progress_recent_errors': '⚠️ Latest errors:',
+        'progress_retries': '🔁 Retries scheduled: {count}',
+        'redrive_prompt': '⚠️ {count} rows failed and are in the dead-letter queue.',
+        'btn_redrive': '🔁 Resend failures ({count})',
+        'redrive_started': '🔁 {count} rows from the dead-letter queue are being sent again.',
+        'redrive_empty': 'ℹ️ This campaign has no rows in the dead-letter queue.',
+        'redrive_busy': '⏳ A sending is in progress. Resend the failures when it finishes.',
         'status_queue_empty': '📭 Queue empty. Send a new spreadsheet.',
         
         # Message Templates
@@ -193,6 +243,7 @@ TRANSLATIONS = {
         'upload_cancel': '❌ 取消',
         'upload_success': '✅ 电子表格加载成功！',
         'upload_error': '❌ 处理电子表格时出错。请检查格式。',
+        'upload_busy': '⏳ 正在发送中。请等待完成或先取消，再上传新的电子表格。',
         
         # Configuration
         'config_interval': '⏱️ 输入发送间隔（分钟）：',
@@ -201,6 +252,14 @@ TRANSLATIONS = {
         'config_start': '▶️ 开始发送',
         'config_reconfigure': '⚙️ 重新配置',
         'config_cancel': '❌ 取消',
+        'config_ingesting': '⏳ 电子表格仍在读取中；新消息将在发送期间加入队列。',
+        'config_rejected': '🚫 已跳过的行：{details}',
+        'config_duplicates': '🔁 已合并的重复行（相同机器人和聊天）：{count}（策略：{policy}）',
+        'config_dead_destinations': '⏭️ 已跳过发往拒收目标（机器人被屏蔽、聊天不存在）的行：{count}',
+        'config_invalid_bots': '🚫 令牌无效的机器人（getMe 拒绝），已搁置的行：{count}（{details}）',
+        'reject_campos_vazios': '空字段',
+        'reject_api_key_invalida': '无效的 api_key',
+        'reject_chat_id_invalido': '无效的 chat_id',
         
         # Sending
         'send_success': '✅ 消息成功发送至：{chat_id}',
@@ -208,6 +267,7 @@ TRANSLATIONS = {
         'send_paused': '⏸️ 发送已暂停。',
         'send_resumed': '▶️ 发送已恢复。',
         'send_cancelled': '❌ 发送已取消。',
+        'campaign_auto_resumed': '🔄 机器人已重启，您中断的活动已自动恢复。',
         
         # Backup
         'backup_detected': '🚀 系统检测到未完成的先前发送。\n您想要：',
@@ -217,6 +277,13 @@ TRANSLATIONS = {
         # Completion
         'completion_success': '✅ 所有消息发送成功！🎯',
         'completion_report': '📥 这是最终报告。',
+        'report_summary': '📊 摘要：共 {total} 行，成功 {sent}，错误 {errors}，重复 {skipped}\n✅ 成功率：{rate}%\n⏱️ 延迟 p50/p95/p99：{latency} 毫秒',
+        'report_errors_by_code': '⚠️ 按错误代码统计：',
+        'report_dead_destinations': '⏭️ 已跳过的无效目标（未发送请求）：{count}',
+        'report_invalid_bots': '🚫 令牌无效机器人的行（未发送）：{count}',
+        'timings_title': '⏱️ 各阶段耗时 — 活动 {campaign_id}（{status}）',
+        'timings_empty': 'ℹ️ 没有已测量耗时的活动。',
+        'admin_only': '🚫 此命令仅限管理员使用。',
         'completion_new_sheet': '📢 请发送新的电子表格以更新消息队列。',
         
         # Buttons
@@ -236,6 +303,14 @@ TRANSLATIONS = {
         # Status
         'status_processing': '⏳ 处理中...',
         'status_waiting': '⏳ 等待下一个周期...',
+        'progress_message': '📊 发送进度\n✅ 已发送：{sent}\n❌ 错误：{errors}\n📋 待发送：{pending}\n⚡ 速度：{rate} 条/分钟\n🕒 剩余时间：{eta}',
+        'progress_recent_errors': '⚠️ 最近的错误：',
+        'progress_retries': '🔁 已安排重试：{count}',
+        'redrive_prompt': '⚠️ {count} 行发送失败，已进入失败队列。',
+        'btn_redrive': '🔁 重新发送失败项（{count}）',
+        'redrive_started': '🔁 失败队列中的 {count} 行已重新开始发送。',
+        'redrive_empty': 'ℹ️ 此活动的失败队列中没有行。',
+        'redrive_busy': '⏳ 正在发送中。请在发送完成后再重新发送失败项。',
         'status_queue_empty': '📭 队列为空。发送新的电子表格。',
         
         # 消息模板系统
@@ -1,13 +1,41 @@
+import copy
+import functools
+import csv
+import gzip
 import json
+import hashlib
+import heapq
+import asyncio
 import pandas as pd
 import os
+import random
+import re
+import time
 import logging
+import sqlite3
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable, Tuple, Iterator, Iterable
+import httpx
+import openpyxl
 import requests
-from config import BACKUP_FILE, REPORTS_DIR
+from config import (
+    DATABASE_FILE, QUEUE_PAGE_SIZE, REPORTS_DIR, REPORT_FORMAT,
+    MEDIA_DIR, MEDIA_FILE_IDS_FILE,
+    TELEGRAM_API_URL, HTTP_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    DEFAULT_MAX_IN_FLIGHT, INGEST_CHUNK_SIZE, INGEST_TRANSACTION_ROWS, DEDUP_POLICY, TELEGRAM_MAX_MESSAGE_LENGTH,
+    BOT_RATE_LIMIT, CHAT_MIN_INTERVAL, CHAT_LIMITER_MAX_ENTRIES, RATE_LIMIT_MAX_WAIT,
+    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN,
+    DEAD_DESTINATION_TTL, BOT_PREFLIGHT_TTL, BOT_PREFLIGHT_MAX_IN_FLIGHT, BOT_PREFLIGHT_TIMEOUT,
+    PROGRESS_UPDATE_INTERVAL, PROGRESS_MAX_ERRORS, SESSION_PERSIST, SESSION_TTL, SESSION_MAX_ENTRIES
+)
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+import metrics
+
 # Configurar logging
 logging.basicConfig(
     level=logging.INFO,
@@ -17,55 +45,877 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
+# httpx registra cada requisição em INFO, com o token do bot na URL
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-class BackupManager:
-    """Gerencia backup e recuperação do estado do bot"""
-    
+class CampaignStore:
+    """
+    Armazena campanhas, linhas e tentativas de envio em SQLite (modo WAL)
+    Substitui o backup em JSON: cada lote grava os status em uma única
+    transação e relatórios/contagens viram consultas indexadas por
+    campanha, status e bot (api_key)
+
+    Estados das linhas: 0 pendente, 1 processada, 2 descartada (duplicada),
+    3 pulada (destino que recusou mensagens antes, em dead_destinations),
+    4 separada (token do bot recusado pelo getMe ou com 401 no envio)
+    Linhas processadas com erro formam a fila de falhas (dead letter) da
+    campanha, que pode ser reenviada com MessageQueue.redrive()
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            dedup TEXT NOT NULL DEFAULT 'off',
+            collapsed INTEGER NOT NULL DEFAULT 0,
+            config TEXT NOT NULL DEFAULT '{}',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_campaigns_user ON campaigns (user_id, status);
+
+        CREATE TABLE IF NOT EXISTS bots (
+            id INTEGER PRIMARY KEY,
+            api_key TEXT NOT NULL UNIQUE
+        );
+
+        CREATE TABLE IF NOT EXISTS rows (
+            campaign_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            bot_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            mensagem TEXT NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'Pendente',
+            sent_at TEXT,
+            error TEXT,
+            error_code INTEGER,
+            latency_ms REAL,
+            processed_seq INTEGER,
+            retries INTEGER NOT NULL DEFAULT 0,
+            retry_at REAL,
+            PRIMARY KEY (campaign_id, idx)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_rows_pending ON rows (campaign_id, state, seq);
+        CREATE INDEX IF NOT EXISTS idx_rows_status ON rows (campaign_id, status);
+        CREATE INDEX IF NOT EXISTS idx_rows_bot ON rows (campaign_id, bot_id, state);
+        CREATE INDEX IF NOT EXISTS idx_rows_destination ON rows (campaign_id, bot_id, chat_id);
+
+        CREATE TABLE IF NOT EXISTS attempts (
+            id INTEGER PRIMARY KEY,
+            campaign_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            attempted_at TEXT NOT NULL,
+            success INTEGER NOT NULL,
+            error_code INTEGER,
+            error TEXT,
+            latency_ms REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_attempts_row ON attempts (campaign_id, idx);
+
+        CREATE TABLE IF NOT EXISTS dead_destinations (
+            bot_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            error_code INTEGER,
+            error TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (bot_id, chat_id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+    """
+
+    # Formato de new_campaign_id (validação de ids vindos de botões)
+    ID_PATTERN = re.compile(r'\d{8}_\d{6}_\d{6}')
+
+    # Colunas acrescentadas depois da primeira versão do banco (tabela, coluna, definição)
+    MIGRATIONS = (
+        ('rows', 'retries', 'INTEGER NOT NULL DEFAULT 0'),
+        ('rows', 'retry_at', 'REAL'),
+    )
+
+    # Campanhas que podem ser retomadas (interrompidas por queda, desligamento ou pelo usuário)
+    RESUMABLE = ('running', 'paused', 'stopped', 'cancelled')
+
+    _default: Optional['CampaignStore'] = None
+
+    def __init__(self, path: str = DATABASE_FILE):
+        self.path = path
+        # Uma conexão compartilhada; o lock permite uso a partir de threads (relatórios)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(CampaignStore.SCHEMA)
+        self._migrate()
+        self.conn.execute('DELETE FROM dead_destinations WHERE expires_at <= ?', (time.time(),))
+        self._bot_ids: Dict[str, int] = {}
+        self._api_keys: Dict[int, str] = {}
+
+    def _migrate(self):
+        """Acrescenta as colunas que faltam em bancos criados por versões anteriores"""
+        for table, column, definition in CampaignStore.MIGRATIONS:
+            columns = {row['name'] for row in self.conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
     @staticmethod
-    def save_backup(data: Dict[str, Any]) -> bool:
-        """Salva backup do estado atual"""
-        try:
-            backup_data = {
-                'timestamp': datetime.now().isoformat(),
-                'data': data
-            }
-            with open(BACKUP_FILE, 'w', encoding='utf-8') as f:
-                json.dump(backup_data, f, ensure_ascii=False, indent=2)
-            logger.info("Backup salvo com sucesso")
-            return True
-        except Exception as e:
-            logger.error(f"Erro ao salvar backup: {e}")
-            return False
-    
+    def default() -> 'CampaignStore':
+        """Store compartilhado do bot (DATABASE_FILE)"""
+        if CampaignStore._default is None:
+            CampaignStore._default = CampaignStore()
+        return CampaignStore._default
+
+    def close(self):
+        """Fecha a conexão (o store compartilhado é recriado no próximo default())"""
+        with self.lock:
+            self.conn.close()
+        if CampaignStore._default is self:
+            CampaignStore._default = None
+
+    @contextmanager
+    def transaction(self):
+        """Agrupa várias escritas em um único commit"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    # ---------- bots (api_key internada) ----------
+
+    def bot_id(self, api_key: str) -> int:
+        """Id numérico do bot; cada api_key é guardada uma única vez"""
+        bot_id = self._bot_ids.get(api_key)
+        if bot_id is None:
+            with self.lock:
+                self.conn.execute('INSERT OR IGNORE INTO bots (api_key) VALUES (?)', (api_key,))
+                bot_id = self.conn.execute('SELECT id FROM bots WHERE api_key = ?', (api_key,)).fetchone()[0]
+            self._bot_ids[api_key] = bot_id
+            self._api_keys[bot_id] = api_key
+        return bot_id
+
+    def api_key(self, bot_id: int) -> str:
+        """api_key a partir do id do bot"""
+        api_key = self._api_keys.get(bot_id)
+        if api_key is None:
+            with self.lock:
+                api_key = self.conn.execute('SELECT api_key FROM bots WHERE id = ?', (bot_id,)).fetchone()[0]
+            self._api_keys[bot_id] = api_key
+            self._bot_ids[api_key] = bot_id
+        return api_key
+
+    # ---------- campanhas ----------
+
     @staticmethod
-    def load_backup() -> Optional[Dict[str, Any]]:
-        """Carrega backup se existir"""
-        try:
-            if os.path.exists(BACKUP_FILE):
-                with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-                    backup_data = json.load(f)
-                logger.info("Backup carregado com sucesso")
-                return backup_data.get('data')
-        except Exception as e:
-            logger.error(f"Erro ao carregar backup: {e}")
-        return None
-    
+    def new_campaign_id() -> str:
+        """Gera identificador para uma nova campanha"""
+        return datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+
+    def create_campaign(self, user_id: str, dedup: str = 'off') -> str:
+        """Cria campanha em rascunho (planilha recebida, envio ainda não iniciado)"""
+        campaign_id = CampaignStore.new_campaign_id()
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO campaigns (id, user_id, status, dedup, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (campaign_id, str(user_id), 'draft', dedup, now, now)
+            )
+        return campaign_id
+
+    def update_campaign(self, campaign_id: str, status: Optional[str] = None,
+                        config: Optional[Dict[str, Any]] = None):
+        """Atualiza status e/ou configuração (config é mesclada à atual)"""
+        with self.lock:
+            if config is not None:
+                current = self.get_campaign(campaign_id)
+                merged = {**(current['config'] if current else {}), **config}
+                self.conn.execute('UPDATE campaigns SET config = ? WHERE id = ?',
+                                  (json.dumps(merged, ensure_ascii=False), campaign_id))
+            if status is not None:
+                self.conn.execute('UPDATE campaigns SET status = ? WHERE id = ?', (status, campaign_id))
+            self.conn.execute('UPDATE campaigns SET updated_at = ? WHERE id = ?',
+                              (datetime.now().isoformat(), campaign_id))
+
     @staticmethod
-    def clear_backup() -> bool:
-        """Remove arquivo de backup"""
+    def _campaign_dict(row) -> Dict[str, Any]:
+        campaign = dict(row)
+        campaign['config'] = json.loads(campaign['config'] or '{}')
+        return campaign
+
+    def get_campaign(self, campaign_id: str) -> Optional[Dict[str, Any]]:
+        """Dados da campanha (config já decodificada)"""
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM campaigns WHERE id = ?', (campaign_id,)).fetchone()
+        return CampaignStore._campaign_dict(row) if row else None
+
+    def list_campaigns(self, user_id: Optional[str] = None,
+                       statuses: Optional[Tuple[str, ...]] = None) -> List[Dict[str, Any]]:
+        """Lista campanhas (mais recente por último), filtrando por usuário e status"""
+        query = 'SELECT * FROM campaigns WHERE 1 = 1'
+        params: List[Any] = []
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(str(user_id))
+        if statuses:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            params.extend(statuses)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY updated_at, id', params).fetchall()
+        return [CampaignStore._campaign_dict(row) for row in rows]
+
+    def delete_campaign(self, campaign_id: str):
+        """Remove a campanha com suas linhas e tentativas"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM attempts WHERE campaign_id = ?', (campaign_id,))
+            conn.execute('DELETE FROM rows WHERE campaign_id = ?', (campaign_id,))
+            conn.execute('DELETE FROM campaigns WHERE id = ?', (campaign_id,))
+
+    # ---------- consultas ----------
+
+    def count_by_status(self, campaign_id: str) -> Dict[str, int]:
+        """Quantidade de linhas por status"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT status, COUNT(*) FROM rows WHERE campaign_id = ? GROUP BY status',
+                (campaign_id,)
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def errors_by_bot(self, campaign_id: str) -> Dict[str, int]:
+        """Quantidade de linhas com erro por bot (api_key)"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT b.api_key, COUNT(*) FROM rows r JOIN bots b ON b.id = r.bot_id '
+                'WHERE r.campaign_id = ? AND r.state = 1 AND r.error IS NOT NULL '
+                'GROUP BY r.bot_id',
+                (campaign_id,)
+            ).fetchall()
+        return {api_key: count for api_key, count in rows}
+
+    def dead_destination_bots(self) -> set:
+        """Bots com algum destino recusado ainda não expirado"""
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT bot_id FROM dead_destinations WHERE expires_at > ?',
+                                     (time.time(),)).fetchall()
+        return {bot_id for (bot_id,) in rows}
+
+    def count_dead_letters(self, campaign_id: str) -> int:
+        """Linhas processadas com erro (fila de falhas da campanha)"""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM rows WHERE campaign_id = ? AND state = 1 AND error IS NOT NULL',
+                (campaign_id,)
+            ).fetchone()[0]
+
+    def save_session(self, user_id: str, data: Dict[str, Any]):
+        """Grava (ou substitui) a sessão persistida do usuário"""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)',
+                (str(user_id), json.dumps(data, ensure_ascii=False), datetime.now().isoformat())
+            )
+
+    def load_session(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Sessão persistida do usuário (None se não houver)"""
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM sessions WHERE user_id = ?', (str(user_id),)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def delete_session(self, user_id: str):
+        with self.lock:
+            self.conn.execute('DELETE FROM sessions WHERE user_id = ?', (str(user_id),))
+
+    def session_campaigns(self) -> set:
+        """Campanhas referenciadas por sessões persistidas (rascunhos a preservar)"""
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM sessions').fetchall()
+        return {json.loads(row['data']).get('campaign_id') for row in rows} - {None}
+
+    def report_rows(self, campaign_id: str) -> Iterator[Dict[str, Any]]:
+        """
+        Linhas processadas na ordem de processamento (para relatórios)
+        Lidas aos poucos por uma conexão própria: o WAL permite ler em outra
+        thread sem bloquear as gravações do loop de envio
+        """
+        conn = sqlite3.connect(self.path)
         try:
-            if os.path.exists(BACKUP_FILE):
-                os.remove(BACKUP_FILE)
-                logger.info("Backup removido")
-            return True
-        except Exception as e:
-            logger.error(f"Erro ao remover backup: {e}")
-            return False
+            cursor = conn.execute(
+                'SELECT b.api_key, r.chat_id, r.mensagem, r.status, r.sent_at, r.error, r.error_code, r.latency_ms '
+                'FROM rows r JOIN bots b ON b.id = r.bot_id '
+                'WHERE r.campaign_id = ? AND r.state > 0 ORDER BY r.processed_seq',
+                (campaign_id,)
+            )
+            for api_key, chat_id, mensagem, status, sent_at, error, error_code, latency_ms in cursor:
+                yield {
+                    'api_key': api_key,
+                    'chat_id': chat_id,
+                    'mensagem': mensagem,
+                    'status_envio': status,
+                    'data_hora_envio': sent_at,
+                    'erro': error,
+                    'codigo_erro': error_code,
+                    'latencia_ms': latency_ms
+                }
+        finally:
+            conn.close()
+
+
+def _store_locked(method):
+    """
+    Executa o método da fila com o lock do banco: a leitura da planilha
+    roda numa thread (MessageQueue.ingest) e altera o mesmo estado em memória
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.store.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MessageQueue:
+    """
+    Fila de envio de uma campanha, persistida no CampaignStore
+    Só uma página de linhas pendentes fica em memória (page_size), de modo
+    que o consumo não cresce com a planilha; os resultados de cada lote
+    são gravados juntos em flush() (group commit)
+
+    Destinos repetidos (mesma api_key e chat_id) seguem a política dedup:
+    off - envia todas as linhas
+    first - mantém a primeira linha e descarta as repetidas
+    drop - descarta todas as linhas do destino (as ainda não enviadas)
+    merge - junta os textos na primeira linha, se ainda não enviada
+
+    ingest pode rodar numa thread enquanto o loop de envio usa a fila: os
+    métodos que alteram o estado em memória usam o lock do banco
+    """
+
+    DEDUP_POLICIES = ('off', 'first', 'drop', 'merge')
+    DUPLICATE_STATUS = '⏭️ Duplicada'
+    DEAD_STATUS = '⏭️ Destino inválido'
+    INVALID_BOT_STATUS = '🚫 Bot inválido'
+
+    # Primeira linha do destino (dedup): MIN(idx) sai de idx_rows_destination; com
+    # ORDER BY idx LIMIT 1 o SQLite percorria a chave primária da campanha inteira
+    FIRST_ROW_SQL = (
+        'SELECT idx, state, mensagem FROM rows WHERE campaign_id = ? AND idx = '
+        '(SELECT MIN(idx) FROM rows WHERE campaign_id = ? AND bot_id = ? AND chat_id = ?)'
+    )
+
+    def __init__(self, store: CampaignStore, campaign_id: str, page_size: int = QUEUE_PAGE_SIZE,
+                 dead_ttl: float = DEAD_DESTINATION_TTL):
+        campaign = store.get_campaign(campaign_id)
+        if campaign is None:
+            raise ValueError(f"Campanha não encontrada: {campaign_id}")
+        self.store = store
+        self.campaign_id = campaign_id
+        self.page_size = page_size
+        self.dead_ttl = dead_ttl  # validade de um destino recusado (0 desativa o cache)
+        self.dedup = campaign['dedup']
+        self.collapsed = campaign['collapsed']
+
+        with store.lock:
+            total, max_seq, max_processed, pending, retries, dead = store.conn.execute(
+                'SELECT COUNT(*), MAX(seq), MAX(processed_seq), SUM(state = 0), SUM(retries), SUM(state = 3) '
+                'FROM rows WHERE campaign_id = ?',
+                (campaign_id,)
+            ).fetchone()
+        self.total = total
+        self.dead_skipped = dead or 0  # linhas puladas por destino recusado
+        with store.lock:
+            invalid = store.conn.execute(
+                'SELECT bot_id, COUNT(*) FROM rows WHERE campaign_id = ? AND state = 4 GROUP BY bot_id',
+                (campaign_id,)
+            ).fetchall()
+        self.invalid_bots: Dict[int, int] = {bot_id: count for bot_id, count in invalid}  # bot -> linhas separadas
+        self.retries_spent = retries or 0  # reenvios já agendados (orçamento da campanha)
+        self._next_seq = (max_seq or 0) + 1
+        self._next_processed = (max_processed or 0) + 1
+        self._pending = pending or 0  # linhas pendentes fora de envio (inclui reenvios agendados)
+
+        self._page: deque = deque()  # próximas linhas a enviar (índices)
+        self._rows: Dict[int, Tuple[int, str, str]] = {}  # índice -> (bot_id, chat_id, mensagem)
+        self._last_seq = -1  # maior seq já carregado do banco
+        self._in_flight: set = set()  # retiradas e ainda sem resultado
+        self._retries: Dict[int, int] = {}  # índice -> reenvios já feitos (linhas em memória)
+        self._waiting: Dict[int, float] = {}  # índice -> horário (epoch) do reenvio agendado
+        self._delayed: List[Tuple[float, int]] = []  # heap (horário, índice) dos reenvios
+        self._dead: Dict[Tuple[int, str], Tuple[Optional[int], str]] = {}  # recusados nesta execução
+
+        # Escritas acumuladas até o próximo flush()
+        self._marks: List[Tuple] = []
+        self._moves: List[Tuple] = []
+        self._schedules: List[Tuple] = []
+        self._dead_skips: List[Tuple] = []
+        self._dead_writes: List[Tuple] = []
+        self._attempts: List[Tuple] = []
+
+        self._load_delayed()
+
+    def __len__(self) -> int:
+        """Linhas ainda pendentes"""
+        return self._pending
+
+    def ingest(self, messages: List[Dict[str, Any]],
+               transaction_rows: int = INGEST_TRANSACTION_ROWS,
+               invalid_bots: Optional[Dict[str, Tuple[Optional[int], str]]] = None) -> Dict[str, int]:
+        """
+        Acrescenta linhas (formato de SpreadsheetProcessor) aplicando a
+        política de duplicadas; devolve {'appended': n, 'collapsed': n}
+        Linhas para destinos recusados entram já puladas (dead_skipped) e as
+        de tokens já sabidamente inválidos ({api_key: (error_code, erro)}),
+        já separadas
+
+        Gravadas em transações de transaction_rows linhas: chamada numa thread
+        (asyncio.to_thread), o loop de envio espera pelo lock no máximo uma transação
+        """
+        appended = 0
+        set_aside = 0
+        collapsed = self.collapsed
+        dead = self.dead_skipped
+        # Só bots com destinos recusados precisam da consulta por linha
+        dead_bots = self.store.dead_destination_bots() if self.dead_ttl > 0 else set()
+        now = time.time()
+        transaction_rows = max(1, transaction_rows)
+
+        for start in range(0, len(messages), transaction_rows):
+            with self.store.transaction() as conn:
+                for message_data in messages[start:start + transaction_rows]:
+                    bot_id = self.store.bot_id(message_data['api_key'])
+                    chat_id = message_data['chat_id']
+                    mensagem = message_data['mensagem']
+
+                    first = None
+                    if self.dedup != 'off':
+                        first = conn.execute(
+                            MessageQueue.FIRST_ROW_SQL, (self.campaign_id, self.campaign_id, bot_id, chat_id)
+                        ).fetchone()
+
+                    if first is not None:
+                        index, state, first_text = first
+                        # Linha ainda não retirada da fila pode ser alterada
+                        pending = state == 0 and index not in self._in_flight
+                        if self.dedup == 'merge' and pending:
+                            merged = f"{first_text}\n\n{mensagem}"
+                            if mensagem in first_text.split('\n\n'):
+                                pass  # texto repetido não é duplicado na mensagem
+                            elif len(merged) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                                conn.execute('UPDATE rows SET mensagem = ? WHERE campaign_id = ? AND idx = ?',
+                                             (merged, self.campaign_id, index))
+                                if index in self._rows:
+                                    self._rows[index] = (bot_id, chat_id, merged)
+                            else:
+                                first = None  # Não cabe numa mensagem só: segue como linha separada
+                        elif self.dedup == 'drop' and pending:
+                            self._skip(conn, index)
+                            self.collapsed += 1
+                        if first is not None:
+                            self.collapsed += 1
+                            continue
+
+                    skipped = None  # (state, status, error_code, erro) de linha que já entra processada
+                    invalid = invalid_bots.get(message_data['api_key']) if invalid_bots else None
+                    if invalid is not None:
+                        skipped = (4, MessageQueue.INVALID_BOT_STATUS, *invalid)
+                        self.invalid_bots[bot_id] = self.invalid_bots.get(bot_id, 0) + 1
+                        set_aside += 1
+                    elif bot_id in dead_bots:
+                        refused = conn.execute(
+                            'SELECT error_code, error FROM dead_destinations '
+                            'WHERE bot_id = ? AND chat_id = ? AND expires_at > ?',
+                            (bot_id, chat_id, now)
+                        ).fetchone()
+                        if refused is not None:
+                            skipped = (3, MessageQueue.DEAD_STATUS, *refused)
+                            self.dead_skipped += 1
+                    if skipped is not None:
+                        # Token inválido ou destino recusado antes: entra sem ocupar a fila
+                        conn.execute(
+                            'INSERT INTO rows (campaign_id, idx, bot_id, chat_id, mensagem, seq, state, status, '
+                            'error_code, error, processed_seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.campaign_id, self.total, bot_id, chat_id, mensagem, self._next_seq,
+                             *skipped, self._next_processed)
+                        )
+                        self._next_processed += 1
+                    else:
+                        conn.execute(
+                            'INSERT INTO rows (campaign_id, idx, bot_id, chat_id, mensagem, seq) VALUES (?, ?, ?, ?, ?, ?)',
+                            (self.campaign_id, self.total, bot_id, chat_id, mensagem, self._next_seq)
+                        )
+                        self._pending += 1
+                        appended += 1
+                    self.total += 1
+                    self._next_seq += 1
+
+                if self.collapsed != collapsed:
+                    conn.execute('UPDATE campaigns SET collapsed = ? WHERE id = ?',
+                                 (self.collapsed, self.campaign_id))
+
+            time.sleep(0)  # cede o lock ao loop de envio entre as transações
+
+        if self.dead_skipped != dead:
+            metrics.dead_destinations_skipped.inc('ingest', amount=self.dead_skipped - dead)
+        if set_aside:
+            metrics.invalid_bot_rows.inc(amount=set_aside)
+        return {'appended': appended, 'collapsed': self.collapsed - collapsed}
+
+    def _skip(self, conn, index: int):
+        """Descarta uma linha pendente (duplicada)"""
+        conn.execute(
+            'UPDATE rows SET state = 2, status = ?, processed_seq = ? WHERE campaign_id = ? AND idx = ?',
+            (MessageQueue.DUPLICATE_STATUS, self._next_processed, self.campaign_id, index)
+        )
+        self._next_processed += 1
+        self._pending -= 1
+        self._retries.pop(index, None)
+        if index in self._rows:
+            # Reenvio agendado sai do heap na próxima retirada (entrada sem correspondência)
+            if self._waiting.pop(index, None) is None:
+                self._page.remove(index)
+            del self._rows[index]
+
+    def _load_page(self):
+        """Carrega a próxima página de linhas pendentes, na ordem da fila"""
+        self.flush()
+        # Destinos recusados (ainda válidos) vêm junto, para pular a linha antes do envio
+        expires_after = time.time() if self.dead_ttl > 0 else float('inf')
+        with self.store.lock:
+            rows = self.store.conn.execute(
+                'SELECT r.idx, r.bot_id, r.chat_id, r.mensagem, r.seq, r.retries, d.error_code, d.error FROM rows r '
+                'LEFT JOIN dead_destinations d ON d.bot_id = r.bot_id AND d.chat_id = r.chat_id AND d.expires_at > ? '
+                'WHERE r.campaign_id = ? AND r.state = 0 AND r.seq > ? AND r.retry_at IS NULL ORDER BY r.seq LIMIT ?',
+                (expires_after, self.campaign_id, self._last_seq, self.page_size)
+            ).fetchall()
+        for index, bot_id, chat_id, mensagem, seq, retries, error_code, error in rows:
+            self._last_seq = seq
+            if index in self._rows:
+                continue
+            if error is not None:
+                self._skip_dead(index, error_code, error)
+                continue
+            self._page.append(index)
+            self._rows[index] = (bot_id, chat_id, mensagem)
+            if retries:
+                self._retries[index] = retries
+
+    def _skip_dead(self, index: int, error_code: Optional[int], error: str):
+        """Pula linha pendente cujo destino já recusou mensagens (sem requisição)"""
+        self._rows.pop(index, None)
+        self._retries.pop(index, None)
+        self._dead_skips.append((
+            MessageQueue.DEAD_STATUS, error, error_code, self._next_processed, self.campaign_id, index
+        ))
+        self._next_processed += 1
+        self._pending -= 1
+        self.dead_skipped += 1
+        metrics.dead_destinations_skipped.inc('dequeue')
+
+    @_store_locked
+    def remember_dead(self, index: int, error_code: Optional[int], error: str):
+        """
+        Guarda o destino da linha como recusado por dead_ttl segundos: as
+        linhas seguintes para ele (nesta e em outras campanhas) são puladas
+        """
+        if self.dead_ttl <= 0 or index not in self._rows:
+            return
+        bot_id, chat_id, _ = self._rows[index]
+        self._dead[(bot_id, chat_id)] = (error_code, error)
+        self._dead_writes.append((bot_id, chat_id, error_code, error, time.time() + self.dead_ttl))
+
+    def _load_delayed(self):
+        """Reenvios agendados antes de um reinício voltam para o heap"""
+        with self.store.lock:
+            rows = self.store.conn.execute(
+                'SELECT idx, bot_id, chat_id, mensagem, retries, retry_at FROM rows '
+                'WHERE campaign_id = ? AND state = 0 AND retry_at IS NOT NULL',
+                (self.campaign_id,)
+            ).fetchall()
+        for index, bot_id, chat_id, mensagem, retries, retry_at in rows:
+            self._rows[index] = (bot_id, chat_id, mensagem)
+            self._retries[index] = retries
+            self._waiting[index] = retry_at
+            heapq.heappush(self._delayed, (retry_at, index))
+
+    @_store_locked
+    def take(self, count: int) -> List[int]:
+        """Retira até count linhas da fila (reenvios já vencidos primeiro)"""
+        taken = []
+        now = time.time()
+        while self._delayed and len(taken) < count and self._delayed[0][0] <= now:
+            retry_at, index = heapq.heappop(self._delayed)
+            if self._waiting.get(index) == retry_at:
+                del self._waiting[index]
+                taken.append(index)
+        while len(taken) < count:
+            if not self._page:
+                self._load_page()
+                if not self._page:
+                    break
+            index = self._page.popleft()
+            refused = self._dead.get(self._rows[index][:2]) if self._dead else None
+            if refused is not None:
+                self._skip_dead(index, *refused)
+                continue
+            taken.append(index)
+        self._in_flight.update(taken)
+        self._pending -= len(taken)
+        return taken
+
+    @_store_locked
+    def push_front(self, indexes: List[int]):
+        """Devolve linhas não enviadas ao início da fila, na mesma ordem"""
+        self._in_flight.difference_update(indexes)
+        self._page.extendleft(reversed(indexes))
+        self._pending += len(indexes)
+
+    @_store_locked
+    def requeue(self, index: int, error: Optional[str] = None, error_code: Optional[int] = None,
+                latency_ms: Optional[float] = None):
+        """Devolve linha para o fim da fila (tentativa registrada se houver erro)"""
+        self._in_flight.discard(index)
+        self._rows.pop(index, None)
+        self._moves.append((self._next_seq, self.campaign_id, index))
+        self._next_seq += 1
+        self._pending += 1
+        if error is not None:
+            self._attempts.append((
+                self.campaign_id, index, datetime.now().isoformat(), 0, error_code, error, latency_ms
+            ))
+
+    def retries(self, index: int) -> int:
+        """Reenvios já feitos da linha"""
+        return self._retries.get(index, 0)
+
+    @_store_locked
+    def schedule_retry(self, index: int, delay: float, error: Optional[str] = None,
+                       error_code: Optional[int] = None, latency_ms: Optional[float] = None):
+        """
+        Agenda novo envio da linha daqui a delay segundos; até lá as demais
+        linhas seguem na ordem da fila (o reenvio não atrasa a campanha)
+        """
+        self._in_flight.discard(index)
+        retry_at = time.time() + delay
+        retries = self._retries.get(index, 0) + 1
+        self._retries[index] = retries
+        self._waiting[index] = retry_at
+        heapq.heappush(self._delayed, (retry_at, index))
+        self.retries_spent += 1
+        self._pending += 1
+        self._schedules.append((retries, retry_at, self.campaign_id, index))
+        self._attempts.append((
+            self.campaign_id, index, datetime.now().isoformat(), 0, error_code, error, latency_ms
+        ))
+
+    @_store_locked
+    def next_retry_in(self) -> Optional[float]:
+        """Segundos até o próximo reenvio agendado (None se não houver)"""
+        while self._delayed and self._waiting.get(self._delayed[0][1]) != self._delayed[0][0]:
+            heapq.heappop(self._delayed)
+        if not self._delayed:
+            return None
+        return max(0.0, self._delayed[0][0] - time.time())
+
+    @_store_locked
+    def mark(self, index: int, status: str, sent_at: Optional[str] = None, error: Optional[str] = None,
+             error_code: Optional[int] = None, latency_ms: Optional[float] = None):
+        """Registra o resultado do envio de uma linha (gravado no próximo flush)"""
+        self._in_flight.discard(index)
+        self._rows.pop(index, None)
+        self._retries.pop(index, None)
+        self._marks.append((
+            status, sent_at, error, error_code, latency_ms, self._next_processed, self.campaign_id, index
+        ))
+        self._next_processed += 1
+        self._attempts.append((
+            self.campaign_id, index, sent_at or datetime.now().isoformat(),
+            int(error is None), error_code, error, latency_ms
+        ))
+
+    @_store_locked
+    def flush(self):
+        """Grava marcações, reenfileiramentos, reenvios e tentativas em uma única transação"""
+        if not (self._marks or self._moves or self._schedules or self._dead_skips or self._dead_writes
+                or self._attempts):
+            return
+        started = time.monotonic()
+        with self.store.transaction() as conn:
+            conn.executemany(
+                'UPDATE rows SET state = 1, status = ?, sent_at = ?, error = ?, error_code = ?, latency_ms = ?, '
+                'processed_seq = ? WHERE campaign_id = ? AND idx = ?',
+                self._marks
+            )
+            conn.executemany('UPDATE rows SET seq = ?, retry_at = NULL WHERE campaign_id = ? AND idx = ?',
+                             self._moves)
+            conn.executemany('UPDATE rows SET retries = ?, retry_at = ? WHERE campaign_id = ? AND idx = ?',
+                             self._schedules)
+            conn.executemany(
+                'UPDATE rows SET state = 3, status = ?, error = ?, error_code = ?, processed_seq = ? '
+                'WHERE campaign_id = ? AND idx = ?',
+                self._dead_skips
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO dead_destinations (bot_id, chat_id, error_code, error, expires_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                self._dead_writes
+            )
+            conn.executemany(
+                'INSERT INTO attempts (campaign_id, idx, attempted_at, success, error_code, error, latency_ms) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self._attempts
+            )
+        self._marks, self._moves, self._schedules, self._attempts = [], [], [], []
+        self._dead_skips, self._dead_writes = [], []
+        metrics.store_write_seconds.observe(time.monotonic() - started)
+
+    @_store_locked
+    def reset(self):
+        """Reinicia a fila para um novo ciclo do loop infinito (com novo orçamento de reenvios)"""
+        self.flush()
+        with self.store.transaction() as conn:
+            # Todas as linhas (exceto duplicadas e de bots inválidos) voltam na ordem original
+            # da planilha; destinos recusados são conferidos de novo na leitura (o cache pode ter expirado)
+            conn.execute('UPDATE rows SET state = 0, seq = idx, retries = 0, retry_at = NULL '
+                         'WHERE campaign_id = ? AND state NOT IN (2, 4)',
+                         (self.campaign_id,))
+            self._pending = conn.execute('SELECT COUNT(*) FROM rows WHERE campaign_id = ? AND state = 0',
+                                         (self.campaign_id,)).fetchone()[0]
+        self._page.clear()
+        self._rows.clear()
+        self._in_flight.clear()
+        self._retries.clear()
+        self._waiting.clear()
+        self._delayed.clear()
+        self.retries_spent = 0
+        self.dead_skipped = 0
+        self._last_seq = -1
+        self._next_seq = self.total + 1
+
+    @_store_locked
+    def set_aside_bots(self, invalid: Dict[str, Tuple[Optional[int], str]]) -> int:
+        """
+        Separa as linhas pendentes dos bots com token inválido ({api_key:
+        (error_code, erro)}), que não chegam a ser enviadas; linhas já em
+        envio ficam de fora. Retorna quantas linhas foram separadas
+        """
+        if not invalid:
+            return 0
+        self.flush()
+        bot_ids = set()
+        moved = 0
+        in_flight = sorted(self._in_flight)
+        with self.store.transaction() as conn:
+            for api_key, (error_code, error) in invalid.items():
+                bot_id = self.store.bot_id(api_key)
+                bot_ids.add(bot_id)
+                count = conn.execute(
+                    'UPDATE rows SET state = 4, status = ?, error = ?, error_code = ?, processed_seq = ? + idx '
+                    f"WHERE campaign_id = ? AND bot_id = ? AND state = 0 AND idx NOT IN ({', '.join('?' * len(in_flight))})",
+                    (MessageQueue.INVALID_BOT_STATUS, error, error_code, self._next_processed,
+                     self.campaign_id, bot_id, *in_flight)
+                ).rowcount
+                self._next_processed += self.total
+                if count:
+                    self.invalid_bots[bot_id] = self.invalid_bots.get(bot_id, 0) + count
+                    moved += count
+        self._pending -= moved
+
+        # Linhas do bot já carregadas (página ou reenvio agendado) saem da memória,
+        # junto com os contadores de reenvio e as entradas do heap
+        removed = set()
+        for index in [index for index in self._page if self._rows[index][0] in bot_ids]:
+            self._page.remove(index)
+            removed.add(index)
+        for index in [index for index in self._waiting if self._rows[index][0] in bot_ids]:
+            del self._waiting[index]
+            removed.add(index)
+        if removed:
+            for index in removed:
+                del self._rows[index]
+                self._retries.pop(index, None)
+            self._delayed = [entry for entry in self._delayed if entry[1] not in removed]
+            heapq.heapify(self._delayed)
+        metrics.invalid_bot_rows.inc(amount=moved)
+        return moved
+
+    def dead_letters(self) -> int:
+        """Linhas na fila de falhas (processadas com erro)"""
+        self.flush()
+        return self.store.count_dead_letters(self.campaign_id)
+
+    @_store_locked
+    def redrive(self) -> int:
+        """
+        Devolve as linhas da fila de falhas ao fim da fila, com reenvios
+        zerados; retorna quantas linhas voltaram
+        Os destinos delas saem do cache de recusados: o reenvio é pedido
+        explicitamente (ex.: depois que o usuário desbloqueou o bot)
+        """
+        self.flush()
+        self._dead.clear()
+        with self.store.transaction() as conn:
+            conn.execute(
+                'DELETE FROM dead_destinations WHERE EXISTS (SELECT 1 FROM rows r '
+                'WHERE r.campaign_id = ? AND r.state = 1 AND r.error IS NOT NULL '
+                'AND r.bot_id = dead_destinations.bot_id AND r.chat_id = dead_destinations.chat_id)',
+                (self.campaign_id,)
+            )
+            count = conn.execute(
+                "UPDATE rows SET state = 0, seq = ? + idx, status = 'Pendente', sent_at = NULL, error = NULL, "
+                'error_code = NULL, latency_ms = NULL, processed_seq = NULL, retries = 0, retry_at = NULL '
+                'WHERE campaign_id = ? AND state = 1 AND error IS NOT NULL',
+                (self._next_seq, self.campaign_id)
+            ).rowcount
+            self.retries_spent = conn.execute('SELECT COALESCE(SUM(retries), 0) FROM rows WHERE campaign_id = ?',
+                                              (self.campaign_id,)).fetchone()[0]
+        self._next_seq += self.total
+        self._pending += count
+        return count
+
+    @_store_locked
+    def release_in_flight(self):
+        """Linhas retiradas sem resultado (falha ou desligamento) voltam ao início da fila"""
+        self.push_front(sorted(self._in_flight))
+
+    def row(self, index: int) -> Dict[str, Any]:
+        """Linha pendente no formato de dicionário (api_key, chat_id, mensagem, status...)"""
+        bot_id, chat_id, mensagem = self._rows[index]
+        return {
+            'api_key': self.store.api_key(bot_id),
+            'chat_id': chat_id,
+            'mensagem': mensagem,
+            'status_envio': 'Pendente',
+            'data_hora_envio': None,
+            'erro': None
+        }
+
+    def processed_rows(self) -> Iterator[Dict[str, Any]]:
+        """Linhas processadas, na ordem de processamento (para relatórios)"""
+        self.flush()
+        return self.store.report_rows(self.campaign_id)
+
+
+# Formatos aceitos na planilha
+BOT_TOKEN_PATTERN = re.compile(r'\d+:[\w-]+')
+CHAT_ID_PATTERN = re.compile(r'-?\d+|@[A-Za-z]\w{3,}')
+INTEGRAL_FLOAT_PATTERN = re.compile(r'(-?\d+)\.0+')  # chat_id numérico lido como float (-100123.0)
 
 class SpreadsheetProcessor:
     """Processa planilhas CSV e XLSX"""
     
+    REQUIRED_COLUMNS = ['api_key', 'chat_id', 'mensagem']
+    
     @staticmethod
     def process_file(file_path: str) -> Optional[List[Dict[str, str]]]:
         """
@@ -73,255 +923,1493 @@ class SpreadsheetProcessor:
         Formato esperado: api_key, chat_id, mensagem
         """
         try:
-            # Detectar tipo de arquivo
-            if file_path.endswith('.csv'):
-                df = pd.read_csv(file_path)
-            elif file_path.endswith(('.xlsx', '.xls')):
-                df = pd.read_excel(file_path)
-            else:
-                logger.error("Formato de arquivo não suportado")
-                return None
-            
-            # Verificar colunas obrigatórias
-            required_columns = ['api_key', 'chat_id', 'mensagem']
-            if not all(col in df.columns for col in required_columns):
-                logger.error(f"Colunas obrigatórias não encontradas: {required_columns}")
-                return None
-            
-            # Converter para lista de dicionários
             messages = []
-            for _, row in df.iterrows():
-                if pd.notna(row['api_key']) and pd.notna(row['chat_id']) and pd.notna(row['mensagem']):
-                    messages.append({
-                        'api_key': str(row['api_key']).strip(),
-                        'chat_id': str(row['chat_id']).strip(),
-                        'mensagem': str(row['mensagem']).strip(),
-                        'status_envio': 'Pendente',
-                        'data_hora_envio': None,
-                        'erro': None
-                    })
+            rejected = {}
+            for chunk in SpreadsheetProcessor.iter_file(file_path, rejected=rejected):
+                messages.extend(chunk)
             
             logger.info(f"Processadas {len(messages)} mensagens da planilha")
+            if rejected:
+                logger.info(f"Linhas rejeitadas: {rejected}")
             return messages
             
         except Exception as e:
             logger.error(f"Erro ao processar planilha: {e}")
             return None
+    
+    @staticmethod
+    def iter_file(file_path: str, chunk_size: int = INGEST_CHUNK_SIZE,
+                  rejected: Optional[Dict[str, int]] = None) -> Iterator[List[Dict[str, str]]]:
+        """
+        Lê a planilha em blocos de até chunk_size linhas e devolve cada bloco
+        já validado, sem carregar o arquivo inteiro em memória
+        CSV é lido em chunks pelo pandas e XLSX em modo somente leitura
+        Linhas rejeitadas são contadas por motivo em rejected (se informado)
+        Levanta ValueError para formato ou colunas inválidos
+        """
+        if rejected is None:
+            rejected = {}
+        
+        if file_path.endswith('.csv'):
+            # Ler como texto evita chat_id convertido para float (-1.00123e+12)
+            for df in pd.read_csv(file_path, chunksize=chunk_size, dtype=str):
+                SpreadsheetProcessor._check_columns(df.columns)
+                yield SpreadsheetProcessor.validate_frame(df, rejected)
+        elif file_path.endswith('.xlsx'):
+            for df in SpreadsheetProcessor._iter_xlsx(file_path, chunk_size):
+                yield SpreadsheetProcessor.validate_frame(df, rejected)
+        elif file_path.endswith('.xls'):
+            # Formato antigo não tem leitor em streaming
+            df = pd.read_excel(file_path, dtype=str)
+            SpreadsheetProcessor._check_columns(df.columns)
+            for start in range(0, len(df), chunk_size):
+                yield SpreadsheetProcessor.validate_frame(df.iloc[start:start + chunk_size], rejected)
+        else:
+            raise ValueError("Formato de arquivo não suportado")
+    
+    @staticmethod
+    def next_chunk(chunks: Iterator[List[Dict[str, str]]]) -> Optional[List[Dict[str, str]]]:
+        """Avança até o próximo bloco com mensagens (None quando a planilha acabou)"""
+        for chunk in chunks:
+            if chunk:
+                return chunk
+        return None
+    
+    @staticmethod
+    def _check_columns(columns):
+        """Verificar colunas obrigatórias"""
+        if not all(col in columns for col in SpreadsheetProcessor.REQUIRED_COLUMNS):
+            raise ValueError(f"Colunas obrigatórias não encontradas: {SpreadsheetProcessor.REQUIRED_COLUMNS}")
+    
+    @staticmethod
+    def validate_frame(df: pd.DataFrame, rejected: Optional[Dict[str, int]] = None) -> List[Dict[str, str]]:
+        """
+        Valida e normaliza um bloco da planilha coluna a coluna (vetorizado)
+        Colunas numéricas viram texto e chat_id lido como float inteiro
+        (-1001234567890.0) perde o ".0"; soma em rejected as linhas
+        descartadas por motivo
+        """
+        frame = df[SpreadsheetProcessor.REQUIRED_COLUMNS].apply(lambda col: col.astype('string').str.strip())
+        frame['chat_id'] = frame['chat_id'].str.replace(
+            f'^{INTEGRAL_FLOAT_PATTERN.pattern}$', r'\1', regex=True
+        )
+        
+        empty = (frame.isna() | (frame == '')).any(axis=1)
+        invalid_key = ~empty & ~frame['api_key'].str.fullmatch(BOT_TOKEN_PATTERN, na=False)
+        invalid_chat = ~empty & ~invalid_key & ~frame['chat_id'].str.fullmatch(CHAT_ID_PATTERN, na=False)
+        
+        if rejected is not None:
+            for reason, mask in (('campos_vazios', empty), ('api_key_invalida', invalid_key),
+                                 ('chat_id_invalido', invalid_chat)):
+                count = int(mask.sum())
+                if count:
+                    rejected[reason] = rejected.get(reason, 0) + count
+        
+        frame = frame[~(empty | invalid_key | invalid_chat)]
+        return [
+            {
+                'api_key': api_key,
+                'chat_id': chat_id,
+                'mensagem': mensagem,
+                'status_envio': 'Pendente',
+                'data_hora_envio': None,
+                'erro': None
+            }
+            for api_key, chat_id, mensagem in zip(frame['api_key'], frame['chat_id'], frame['mensagem'])
+        ]
+    
+    @staticmethod
+    def _cell_to_str(value) -> Optional[str]:
+        """Converte célula do XLSX em texto (números inteiros sem notação científica)"""
+        if value is None:
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+    
+    @staticmethod
+    def _iter_xlsx(file_path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+        """Lê XLSX linha a linha (openpyxl em modo somente leitura) em blocos de texto"""
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            columns = [str(col).strip() if col is not None else '' for col in header]
+            SpreadsheetProcessor._check_columns(columns)
+            indexes = [columns.index(col) for col in SpreadsheetProcessor.REQUIRED_COLUMNS]
+            
+            block = []
+            for row in rows:
+                block.append([SpreadsheetProcessor._cell_to_str(row[i]) if i < len(row) else None for i in indexes])
+                if len(block) >= chunk_size:
+                    yield pd.DataFrame(block, columns=SpreadsheetProcessor.REQUIRED_COLUMNS, dtype=object)
+                    block = []
+            if block:
+                yield pd.DataFrame(block, columns=SpreadsheetProcessor.REQUIRED_COLUMNS, dtype=object)
+        finally:
+            workbook.close()
+
+class MediaStore:
+    """
+    Fotos de templates guardadas uma vez (bytes originais, por sha256)
+    file_id só vale para o bot que recebeu o arquivo: no primeiro envio por
+    um bot a foto é enviada via multipart e o file_id devolvido fica em
+    cache por bot (persistido em disco); os envios seguintes usam só o id
+    
+    Templates referenciam a foto como "media:<sha256>"
+    """
+    
+    PREFIX = 'media:'
+    
+    _file_ids: Optional[Dict[str, Dict[str, str]]] = None  # media_id -> {bot_id: file_id}
+    _locks: Dict[Tuple[str, str], List] = {}  # (media_id, bot_id) -> [lock, envios usando o lock]
+    
+    @staticmethod
+    def _media_path(media_id: str) -> str:
+        return os.path.join(MEDIA_DIR, media_id)
+    
+    @staticmethod
+    def _file_ids_path() -> str:
+        return os.path.join(MEDIA_DIR, MEDIA_FILE_IDS_FILE)
+    
+    @staticmethod
+    def bot_id(api_key: str) -> str:
+        """Identificador do bot (parte pública do token)"""
+        return api_key.split(':', 1)[0]
+    
+    @staticmethod
+    def media_id(photo: Optional[str]) -> Optional[str]:
+        """Extrai o media_id de uma referência "media:<sha256>" (None se for file_id/URL)"""
+        if isinstance(photo, str) and photo.startswith(MediaStore.PREFIX):
+            return photo[len(MediaStore.PREFIX):]
+        return None
+    
+    @staticmethod
+    def save(content: bytes) -> str:
+        """Guarda os bytes (uma vez por conteúdo) e devolve a referência para o template"""
+        media_id = hashlib.sha256(content).hexdigest()
+        path = MediaStore._media_path(media_id)
+        if not os.path.exists(path):
+            os.makedirs(MEDIA_DIR, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+        return MediaStore.PREFIX + media_id
+    
+    @staticmethod
+    def load(media_id: str) -> Optional[bytes]:
+        """Lê os bytes originais da foto"""
+        try:
+            with open(MediaStore._media_path(media_id), 'rb') as f:
+                return f.read()
+        except OSError as e:
+            logger.error(f"Erro ao carregar mídia {media_id}: {e}")
+            return None
+    
+    @staticmethod
+    def _cache() -> Dict[str, Dict[str, str]]:
+        if MediaStore._file_ids is None:
+            try:
+                with open(MediaStore._file_ids_path(), 'r', encoding='utf-8') as f:
+                    MediaStore._file_ids = json.load(f)
+            except FileNotFoundError:
+                MediaStore._file_ids = {}
+            except Exception as e:
+                logger.error(f"Erro ao carregar cache de mídia: {e}")
+                MediaStore._file_ids = {}
+        return MediaStore._file_ids
+    
+    @staticmethod
+    def _persist():
+        try:
+            atomic_write(MediaStore._file_ids_path(), json.dumps(MediaStore._cache()))
+        except Exception as e:
+            logger.error(f"Erro ao salvar cache de mídia: {e}")
+    
+    @staticmethod
+    def get_file_id(media_id: str, api_key: str) -> Optional[str]:
+        """file_id da foto para o bot, se já enviada por ele"""
+        return MediaStore._cache().get(media_id, {}).get(MediaStore.bot_id(api_key))
+    
+    @staticmethod
+    def remember(media_id: str, api_key: str, file_id: str):
+        """Guarda o file_id devolvido pela API para o bot"""
+        bot_files = MediaStore._cache().setdefault(media_id, {})
+        if bot_files.get(MediaStore.bot_id(api_key)) != file_id:
+            bot_files[MediaStore.bot_id(api_key)] = file_id
+            MediaStore._persist()
+    
+    @staticmethod
+    def forget(media_id: str, api_key: str):
+        """Descarta file_id recusado pela API (o próximo envio refaz o upload)"""
+        if MediaStore._cache().get(media_id, {}).pop(MediaStore.bot_id(api_key), None) is not None:
+            MediaStore._persist()
+    
+    @staticmethod
+    @asynccontextmanager
+    async def upload_lock(media_id: str, api_key: str):
+        """
+        Lock por foto e bot, para que envios simultâneos façam um só upload
+        Removido quando o último envio que o usava sai (o dict não cresce)
+        """
+        key = (media_id, MediaStore.bot_id(api_key))
+        entry = MediaStore._locks.get(key)
+        if entry is None:
+            entry = MediaStore._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del MediaStore._locks[key]
+    
+    @staticmethod
+    def is_stale(result: Dict[str, Any]) -> bool:
+        """Indica se a API recusou o file_id (precisa reenviar os bytes)"""
+        return (not result.get('success') and result.get('error_code') == 400
+                and 'file' in str(result.get('error', '')).lower())
+
 
 class MessageSender:
     """Envia mensagens via API do Telegram"""
     
+    API_URL = TELEGRAM_API_URL
+    
+    # Descrições de erro 400 que indicam destino inexistente (em minúsculas)
+    DEAD_DESTINATION_ERRORS = ('chat not found', 'user not found', 'peer_id_invalid', 'group chat was upgraded')
+    
+    # Clientes HTTP compartilhados (pool de conexões keep-alive)
+    _session: Optional[requests.Session] = None
+    _async_client: Optional[httpx.AsyncClient] = None
+    _async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+    
     @staticmethod
-    def send_message(api_key: str, chat_id: str, message: str) -> Dict[str, Any]:
+    def get_session() -> requests.Session:
+        """Obtém sessão HTTP síncrona compartilhada (uso em scripts)"""
+        if MessageSender._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                pool_maxsize=HTTP_MAX_CONNECTIONS
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            MessageSender._session = session
+        return MessageSender._session
+    
+    @staticmethod
+    def get_async_client() -> httpx.AsyncClient:
         """
-        Envia mensagem via API do Telegram
-        Retorna dict com status e informações do envio
+        Obtém cliente HTTP assíncrono compartilhado
+        O cliente fica preso ao event loop em que foi criado
         """
-        try:
-            url = f"https://api.telegram.org/bot{api_key}/sendMessage"
-            
+        loop = asyncio.get_running_loop()
+        client = MessageSender._async_client
+        if client is None or client.is_closed or MessageSender._async_client_loop is not loop:
+            MessageSender._async_client = httpx.AsyncClient(
+                timeout=HTTP_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+                )
+            )
+            MessageSender._async_client_loop = loop
+        return MessageSender._async_client
+    
+    @staticmethod
+    async def close():
+        """Fecha os clientes HTTP compartilhados"""
+        if MessageSender._async_client is not None:
+            await MessageSender._async_client.aclose()
+            MessageSender._async_client = None
+            MessageSender._async_client_loop = None
+        if MessageSender._session is not None:
+            MessageSender._session.close()
+            MessageSender._session = None
+    
+    @staticmethod
+    def _build_url(api_key: str, method: str) -> str:
+        """Monta URL de um método da API do Telegram"""
+        return f"{MessageSender.API_URL}/bot{api_key}/{method}"
+    
+    @staticmethod
+    def _build_message_request(chat_id: str, message: str):
+        """Monta método e payload para mensagem de texto simples"""
+        payload = {
+            'chat_id': chat_id,
+            'text': message,
+            'parse_mode': 'HTML'
+        }
+        return 'sendMessage', payload
+    
+    @staticmethod
+    def prepare_template_request(template: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Monta método e payload de template (foto, texto e botões) sem chat_id
+        Feito uma vez por lote e reaproveitado em todas as linhas
+        """
+        # Se há foto, usar sendPhoto
+        if template.get('photo'):
+            method = 'sendPhoto'
             payload = {
-                'chat_id': chat_id,
-                'text': message,
+                'photo': template['photo'],
+                'caption': template.get('text', ''),
                 'parse_mode': 'HTML'
             }
+        else:
+            # Apenas texto e botões
+            method = 'sendMessage'
+            payload = {
+                'text': template.get('text', 'Mensagem sem texto'),
+                'parse_mode': 'HTML'
+            }
+        
+        # Adicionar botões se existirem
+        if template.get('buttons'):
+            keyboard = []
+            for button in template['buttons']:
+                keyboard.append([{
+                    'text': button['text'],
+                    'url': button['url']
+                }])
             
-            response = requests.post(url, json=payload, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('ok'):
-                    return {
-                        'success': True,
-                        'message_id': result.get('result', {}).get('message_id'),
-                        'timestamp': datetime.now().isoformat()
-                    }
-                else:
-                    return {
-                        'success': False,
-                        'error': result.get('description', 'Erro desconhecido'),
-                        'error_code': result.get('error_code'),
-                        'timestamp': datetime.now().isoformat()
-                    }
-            else:
-                return {
-                    'success': False,
-                    'error': f'HTTP {response.status_code}: {response.text}',
-                    'timestamp': datetime.now().isoformat()
-                }
-                
-        except requests.exceptions.Timeout:
+            payload['reply_markup'] = {
+                'inline_keyboard': keyboard
+            }
+        
+        return method, payload
+    
+    @staticmethod
+    def _build_template_request(chat_id: str, template: Dict[str, Any],
+                                prepared: Optional[Tuple[str, Dict[str, Any]]] = None):
+        """Monta método e payload para mensagem de template (foto, texto e botões)"""
+        method, payload = prepared or MessageSender.prepare_template_request(template)
+        return method, {'chat_id': chat_id, **payload}
+    
+    @staticmethod
+    def _parse_response(response) -> Dict[str, Any]:
+        """Converte resposta HTTP (requests ou httpx) no resultado do envio"""
+        # A API do Telegram devolve JSON também nos erros (400, 403, 429...)
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        
+        if not isinstance(result, dict):
+            # Resposta sem JSON (ex.: 502 de um proxy): o código HTTP classifica o erro
             return {
                 'success': False,
-                'error': 'Timeout na requisição',
+                'error': f'HTTP {response.status_code}: {response.text}',
+                'error_code': response.status_code,
                 'timestamp': datetime.now().isoformat()
             }
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e),
+        
+        if response.status_code == 200 and result.get('ok'):
+            message = result.get('result') or {}
+            success = {
+                'success': True,
+                'message_id': message.get('message_id'),
                 'timestamp': datetime.now().isoformat()
             }
+            # Foto enviada: file_id para reuso pelo mesmo bot (maior resolução)
+            if message.get('photo'):
+                success['file_id'] = message['photo'][-1].get('file_id')
+            return success
+        
+        error = {
+            'success': False,
+            'error': result.get('description', f'HTTP {response.status_code}'),
+            'error_code': result.get('error_code', response.status_code),
+            'timestamp': datetime.now().isoformat()
+        }
+        retry_after = (result.get('parameters') or {}).get('retry_after')
+        if retry_after is not None:
+            error['retry_after'] = retry_after
+        return error
     
     @staticmethod
-    def send_template_message(api_key: str, chat_id: str, template: Dict[str, Any]) -> Dict[str, Any]:
+    def is_throttled(result: Optional[Dict[str, Any]]) -> bool:
+        """Indica se o envio foi recusado por limite de taxa (429)"""
+        return bool(result) and result.get('error_code') == 429
+    
+    @staticmethod
+    def classify_error(result: Optional[Dict[str, Any]]) -> Optional[str]:
         """
-        Envia mensagem usando template (com foto, texto e botões)
+        Tipo da falha de um envio (None se não houve falha):
+        throttled - limite de taxa (429), a linha volta para a fila
+        transient - timeout, conexão perdida ou erro 5xx, vale reenviar
+        permanent - recusa da API (chat não encontrado, bot bloqueado...)
         """
+        if not result or result.get('success'):
+            return None
+        error_code = result.get('error_code')
+        if error_code == 429:
+            return 'throttled'
+        if result.get('transient') or (error_code is not None and error_code >= 500):
+            return 'transient'
+        return 'permanent'
+    
+    @staticmethod
+    def is_dead_destination(result: Optional[Dict[str, Any]]) -> bool:
+        """
+        Indica recusa ligada ao destino, que não muda reenviando: bot
+        bloqueado ou removido do chat (403) ou chat inexistente (400)
+        """
+        if not result or result.get('success'):
+            return False
+        error_code = result.get('error_code')
+        if error_code == 403:
+            return True
+        error = str(result.get('error', '')).lower()
+        return error_code == 400 and any(marker in error for marker in MessageSender.DEAD_DESTINATION_ERRORS)
+    
+    @staticmethod
+    def _error_result(error: str, transient: bool = False) -> Dict[str, Any]:
+        """Resultado de falha sem resposta da API (transient: falha de rede, vale reenviar)"""
+        result = {
+            'success': False,
+            'error': error,
+            'timestamp': datetime.now().isoformat()
+        }
+        if transient:
+            result['transient'] = True
+        return result
+    
+    @staticmethod
+    def _multipart_fields(payload: Dict[str, Any]) -> Dict[str, str]:
+        """Campos do payload para envio multipart (objetos viram JSON)"""
+        return {
+            key: json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+            for key, value in payload.items()
+        }
+    
+    @staticmethod
+    def _post(api_key: str, method: str, payload: Dict[str, Any],
+              files: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Executa chamada síncrona à API do Telegram (multipart quando há files)"""
         try:
-            # Se há foto, usar sendPhoto
-            if template.get('photo'):
-                url = f"https://api.telegram.org/bot{api_key}/sendPhoto"
-                
-                payload = {
-                    'chat_id': chat_id,
-                    'photo': template['photo'],
-                    'caption': template.get('text', ''),
-                    'parse_mode': 'HTML'
-                }
-                
-                # Adicionar botões se existirem
-                if template.get('buttons'):
-                    keyboard = []
-                    for button in template['buttons']:
-                        keyboard.append([{
-                            'text': button['text'],
-                            'url': button['url']
-                        }])
-                    
-                    payload['reply_markup'] = {
-                        'inline_keyboard': keyboard
-                    }
-                
-                response = requests.post(url, json=payload, timeout=30)
-            
+            if files:
+                request = {'data': MessageSender._multipart_fields(payload), 'files': files}
             else:
-                # Apenas texto e botões
-                url = f"https://api.telegram.org/bot{api_key}/sendMessage"
-                
-                payload = {
-                    'chat_id': chat_id,
-                    'text': template.get('text', 'Mensagem sem texto'),
-                    'parse_mode': 'HTML'
-                }
-                
-                # Adicionar botões se existirem
-                if template.get('buttons'):
-                    keyboard = []
-                    for button in template['buttons']:
-                        keyboard.append([{
-                            'text': button['text'],
-                            'url': button['url']
-                        }])
-                    
-                    payload['reply_markup'] = {
-                        'inline_keyboard': keyboard
-                    }
-                
-                response = requests.post(url, json=payload, timeout=30)
+                request = {'json': payload}
+            response = MessageSender.get_session().post(
+                MessageSender._build_url(api_key, method),
+                timeout=HTTP_TIMEOUT,
+                **request
+            )
+            return MessageSender._parse_response(response)
+        except requests.exceptions.Timeout:
+            return MessageSender._error_result('Timeout na requisição', transient=True)
+        except requests.exceptions.ConnectionError as e:
+            return MessageSender._error_result(str(e), transient=True)
+        except Exception as e:
+            return MessageSender._error_result(str(e))
+    
+    @staticmethod
+    async def _post_async(api_key: str, method: str, payload: Dict[str, Any],
+                          files: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Executa chamada assíncrona à API do Telegram (não bloqueia o event loop)"""
+        try:
+            if files:
+                request = {'data': MessageSender._multipart_fields(payload), 'files': files}
+            else:
+                request = {'json': payload}
+            started = time.monotonic()
+            try:
+                response = await MessageSender.get_async_client().post(
+                    MessageSender._build_url(api_key, method),
+                    **request
+                )
+            finally:
+                metrics.api_latency.observe(time.monotonic() - started, method)
+            return MessageSender._parse_response(response)
+        except httpx.TimeoutException:
+            return MessageSender._error_result('Timeout na requisição', transient=True)
+        except httpx.TransportError as e:
+            # Conexão recusada ou encerrada no meio da resposta
+            return MessageSender._error_result(str(e) or type(e).__name__, transient=True)
+        except Exception as e:
+            return MessageSender._error_result(str(e))
+    
+    @staticmethod
+    def send_message(api_key: str, chat_id: str, message: str) -> Dict[str, Any]:
+        """
+        Envia mensagem via API do Telegram
+        Retorna dict com status e informações do envio
+        """
+        method, payload = MessageSender._build_message_request(chat_id, message)
+        return MessageSender._post(api_key, method, payload)
+    
+    @staticmethod
+    def send_template_message(api_key: str, chat_id: str, template: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Envia mensagem usando template (com foto, texto e botões)
+        """
+        method, payload = MessageSender._build_template_request(chat_id, template)
+        media_id = MediaStore.media_id(payload.get('photo'))
+        if not media_id:
+            return MessageSender._post(api_key, method, payload)
+        
+        # Foto guardada: usar o file_id deste bot ou enviar os bytes uma vez
+        file_id = MediaStore.get_file_id(media_id, api_key)
+        if file_id:
+            result = MessageSender._post(api_key, method, {**payload, 'photo': file_id})
+            if not MediaStore.is_stale(result):
+                return result
+            MediaStore.forget(media_id, api_key)
+        
+        upload = MessageSender._media_upload(media_id, payload)
+        if upload is None:
+            return MessageSender._error_result('Foto do template não encontrada')
+        result = MessageSender._post(api_key, method, *upload)
+        if result.get('file_id'):
+            MediaStore.remember(media_id, api_key, result['file_id'])
+        return result
+    
+    @staticmethod
+    async def send_message_async(api_key: str, chat_id: str, message: str) -> Dict[str, Any]:
+        """Versão assíncrona de send_message, usando o cliente compartilhado"""
+        method, payload = MessageSender._build_message_request(chat_id, message)
+        return await MessageSender._post_async(api_key, method, payload)
+    
+    @staticmethod
+    async def send_template_message_async(api_key: str, chat_id: str, template: Dict[str, Any],
+                                          prepared: Optional[Tuple[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Versão assíncrona de send_template_message, usando o cliente compartilhado
+        prepared (de prepare_template_request) evita remontar o payload a cada linha
+        """
+        method, payload = MessageSender._build_template_request(chat_id, template, prepared)
+        media_id = MediaStore.media_id(payload.get('photo'))
+        if not media_id:
+            return await MessageSender._post_async(api_key, method, payload)
+        
+        # Foto guardada: usar o file_id deste bot ou enviar os bytes uma vez
+        file_id = MediaStore.get_file_id(media_id, api_key)
+        if file_id:
+            result = await MessageSender._post_async(api_key, method, {**payload, 'photo': file_id})
+            if not MediaStore.is_stale(result):
+                return result
+            MediaStore.forget(media_id, api_key)
+        
+        async with MediaStore.upload_lock(media_id, api_key):
+            # Outro envio do mesmo bot pode ter feito o upload enquanto esperávamos
+            file_id = MediaStore.get_file_id(media_id, api_key)
+            if not file_id:
+                upload = MessageSender._media_upload(media_id, payload)
+                if upload is None:
+                    return MessageSender._error_result('Foto do template não encontrada')
+                result = await MessageSender._post_async(api_key, method, *upload)
+                if result.get('file_id'):
+                    MediaStore.remember(media_id, api_key, result['file_id'])
+                return result
+        
+        return await MessageSender._post_async(api_key, method, {**payload, 'photo': file_id})
+    
+    @staticmethod
+    def _media_upload(media_id: str, payload: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Payload e arquivos para enviar os bytes da foto via multipart"""
+        content = MediaStore.load(media_id)
+        if content is None:
+            return None
+        fields = {key: value for key, value in payload.items() if key != 'photo'}
+        return fields, {'photo': ('photo.jpg', content, 'image/jpeg')}
+
+    @staticmethod
+    async def send_row_async(message_data: Dict[str, Any], template: Optional[Dict[str, Any]] = None,
+                             prepared: Optional[Tuple[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Envia uma linha da fila, usando o template quando informado"""
+        if template:
+            return await MessageSender.send_template_message_async(
+                message_data['api_key'],
+                message_data['chat_id'],
+                template,
+                prepared
+            )
+        return await MessageSender.send_message_async(
+            message_data['api_key'],
+            message_data['chat_id'],
+            message_data['mensagem']
+        )
+    
+    @staticmethod
+    async def send_batch_async(messages: List[Dict[str, Any]], template: Optional[Dict[str, Any]] = None,
+                               max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                               should_continue: Optional[Callable[[], bool]] = None,
+                               rate_limiter: Optional['RateLimiter'] = None,
+                               timer: Optional['StageTimer'] = None) -> List[Optional[Dict[str, Any]]]:
+        """
+        Envia um lote com até max_in_flight requisições simultâneas
+        Retorna os resultados na mesma ordem das mensagens; None indica
+        linha não enviada porque should_continue() retornou False
+        
+        Com rate_limiter, cada envio aguarda o limite do seu bot/chat fora
+        da janela, de modo que um bot limitado não ocupa vagas dos demais
+        
+        timer acumula as etapas de cada linha: rate_limit_wait (limitador),
+        in_flight_wait (vaga na janela) e http (requisição, com upload de foto)
+        """
+        timer = timer or StageTimer()
+        semaphore = asyncio.Semaphore(max(1, max_in_flight))
+        # Payload do template montado uma vez para o lote inteiro
+        with timer.measure('prepare_template'):
+            prepared = MessageSender.prepare_template_request(template) if template else None
+        
+        async def send_one(message_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            api_key = message_data['api_key']
             
-            # Processar resposta
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('ok'):
-                    return {
-                        'success': True,
-                        'message_id': result.get('result', {}).get('message_id'),
-                        'timestamp': datetime.now().isoformat()
-                    }
-                else:
+            if rate_limiter:
+                # Bot pausado por muito tempo: devolver a linha para a fila
+                remaining = rate_limiter.pause_remaining(api_key)
+                if remaining > RATE_LIMIT_MAX_WAIT:
                     return {
                         'success': False,
-                        'error': result.get('description', 'Erro desconhecido'),
-                        'error_code': result.get('error_code'),
+                        'error': 'Limite de taxa do bot',
+                        'error_code': 429,
+                        'retry_after': remaining,
                         'timestamp': datetime.now().isoformat()
                     }
+                with timer.measure('rate_limit_wait'):
+                    await rate_limiter.acquire(api_key, message_data['chat_id'])
+            
+            waiting = time.perf_counter()
+            async with semaphore:
+                started = time.perf_counter()
+                timer.record('in_flight_wait', started - waiting)
+                if should_continue and not should_continue():
+                    return None
+                result = await MessageSender.send_row_async(message_data, template, prepared)
+                # Latência da requisição (sem a espera do limitador), para o resumo do relatório
+                elapsed = time.perf_counter() - started
+                timer.record('http', elapsed)
+                result['latency_ms'] = round(elapsed * 1000, 1)
+                metrics.record_send(api_key, result)
+            
+            if rate_limiter and MessageSender.is_throttled(result):
+                rate_limiter.penalize(api_key, result.get('retry_after'))
+            return result
+        
+        return await asyncio.gather(*(send_one(message_data) for message_data in messages))
+
+
+class RateLimiter:
+    """
+    Limitador de taxa por bot (token bucket por api_key) e por chat
+    Respeita o retry_after devolvido pela API pausando apenas o bot afetado
+    """
+    
+    def __init__(self, bot_rate: float = BOT_RATE_LIMIT, bot_burst: Optional[float] = None,
+                 chat_interval: float = CHAT_MIN_INTERVAL):
+        self.bot_rate = bot_rate
+        self.bot_burst = bot_burst if bot_burst is not None else bot_rate
+        self.chat_interval = chat_interval
+        self._buckets: Dict[str, List[float]] = {}  # api_key -> [tokens, último reabastecimento]
+        self._paused_until: Dict[str, float] = {}
+        self._chat_last_send: Dict[Tuple[str, str], float] = {}
+    
+    def pause_remaining(self, api_key: str) -> float:
+        """Segundos restantes de pausa do bot (0 se não estiver pausado)"""
+        return max(self._paused_until.get(api_key, 0) - time.monotonic(), 0)
+    
+    def penalize(self, api_key: str, retry_after: Optional[float] = None):
+        """Pausa o bot pelo tempo pedido pela API (retry_after)"""
+        delay = float(retry_after) if retry_after else 1.0
+        until = time.monotonic() + delay
+        if until > self._paused_until.get(api_key, 0):
+            self._paused_until[api_key] = until
+            logger.warning(f"Bot {api_key.split(':')[0]} limitado pela API, pausado por {delay:.0f}s")
+        # Zerar tokens para não disparar rajada ao fim da pausa
+        bucket = self._buckets.get(api_key)
+        if bucket:
+            bucket[0] = 0
+    
+    def _wait_time(self, api_key: str, chat_id: str, now: float) -> float:
+        """Calcula quanto o envio precisa esperar (0 = pode enviar agora)"""
+        wait = self._paused_until.get(api_key, 0) - now
+        
+        bucket = self._buckets.setdefault(api_key, [self.bot_burst, now])
+        bucket[0] = min(self.bot_burst, bucket[0] + (now - bucket[1]) * self.bot_rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            wait = max(wait, (1 - bucket[0]) / self.bot_rate)
+        
+        last_send = self._chat_last_send.get((api_key, chat_id))
+        if last_send is not None:
+            wait = max(wait, last_send + self.chat_interval - now)
+        
+        return wait
+    
+    async def acquire(self, api_key: str, chat_id: str):
+        """Aguarda até que o bot e o chat possam receber mais um envio"""
+        while True:
+            now = time.monotonic()
+            wait = self._wait_time(api_key, chat_id, now)
+            if wait <= 0:
+                self._buckets[api_key][0] -= 1
+                self._chat_last_send[(api_key, chat_id)] = now
+                self._prune_chats(now)
+                return
+            await asyncio.sleep(wait)
+    
+    def _prune_chats(self, now: float):
+        """Descarta registros de chats que já não limitam envios"""
+        if len(self._chat_last_send) < CHAT_LIMITER_MAX_ENTRIES:
+            return
+        expired = [key for key, last_send in self._chat_last_send.items()
+                   if now - last_send >= self.chat_interval]
+        for key in expired:
+            del self._chat_last_send[key]
+
+class RetryPolicy:
+    """
+    Reenvio agendado de falhas transitórias (MessageSender.classify_error)
+    A espera dobra a cada reenvio da linha, com jitter para espalhar os
+    reenvios de um lote que falhou junto; o orçamento limita os reenvios
+    da campanha inteira, de modo que uma API fora do ar não segura a fila:
+    sem tentativas ou sem orçamento, a linha vai para a fila de falhas
+    """
+    
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, budget_ratio: float = RETRY_BUDGET_RATIO,
+                 budget_min: int = RETRY_BUDGET_MIN):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_min = budget_min
+    
+    def budget(self, total: int) -> int:
+        """Reenvios permitidos para uma campanha de total linhas"""
+        return max(self.budget_min, int(total * self.budget_ratio))
+    
+    def delay(self, retries: int) -> float:
+        """Espera antes do próximo reenvio: metade fixa, metade sorteada"""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** retries)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+    
+    def next_delay(self, retries: int, spent: int, total: int) -> Optional[float]:
+        """Espera até reenviar a linha, ou None se ela esgotou as tentativas ou a campanha o orçamento"""
+        if retries >= self.max_attempts or spent >= self.budget(total):
+            return None
+        return self.delay(retries)
+
+
+class BotPreflight:
+    """
+    Confere os tokens (api_key) da planilha com getMe, em paralelo e em
+    segundo plano; o resultado fica em cache por ttl segundos, de modo que
+    um token revogado ou digitado errado custa uma requisição por bot em vez
+    de uma falha (401) por linha
+    """
+    
+    # Respostas do getMe que invalidam o token (revogado ou inexistente)
+    INVALID_CODES = (401, 404)
+    
+    def __init__(self, ttl: float = BOT_PREFLIGHT_TTL, max_in_flight: int = BOT_PREFLIGHT_MAX_IN_FLIGHT,
+                 timeout: float = BOT_PREFLIGHT_TIMEOUT):
+        self.ttl = ttl
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        # api_key -> (verificado em, None se válido ou (error_code, erro))
+        self._cache: Dict[str, Tuple[float, Optional[Tuple[Optional[int], str]]]] = {}
+        # api_key -> getMe em andamento (blocos simultâneos compartilham a requisição)
+        self._checking: Dict[str, asyncio.Future] = {}
+    
+    def _cached(self, api_key: str, now: float):
+        """Entrada do cache ainda dentro do ttl (ou None)"""
+        cached = self._cache.get(api_key)
+        if cached and now - cached[0] < self.ttl:
+            return cached
+        return None
+    
+    def mark_invalid(self, api_key: str, error_code: Optional[int], error: str):
+        """Registra token recusado fora da conferência (ex.: 401 durante o envio)"""
+        self._cache[api_key] = (time.monotonic(), (error_code, error))
+    
+    def known_invalid(self, api_keys: Iterable[str]) -> Dict[str, Tuple[Optional[int], str]]:
+        """Tokens já recusados em cache, sem nenhuma requisição"""
+        now = time.monotonic()
+        invalid = {}
+        for api_key in set(api_keys):
+            cached = self._cached(api_key, now)
+            if cached and cached[1] is not None:
+                invalid[api_key] = cached[1]
+        return invalid
+    
+    async def check(self, api_keys: Iterable[str]) -> Dict[str, Tuple[Optional[int], str]]:
+        """
+        Confere os tokens sem resultado em cache e devolve os inválidos
+        ({api_key: (error_code, erro)}); timeout, 5xx e 429 não decidem
+        nada (as linhas seguem e o token é conferido de novo depois)
+        """
+        now = time.monotonic()
+        invalid, checking = {}, {}
+        semaphore = None
+        for api_key in set(api_keys):
+            cached = self._cached(api_key, now)
+            if cached:
+                if cached[1] is not None:
+                    invalid[api_key] = cached[1]
+            elif api_key in self._checking:
+                checking[api_key] = self._checking[api_key]
             else:
-                return {
-                    'success': False,
-                    'error': f'HTTP {response.status_code}: {response.text}',
-                    'timestamp': datetime.now().isoformat()
-                }
-                
-        except requests.exceptions.Timeout:
-            return {
-                'success': False,
-                'error': 'Timeout na requisição',
-                'timestamp': datetime.now().isoformat()
-            }
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e),
-                'timestamp': datetime.now().isoformat()
-            }
+                if semaphore is None:
+                    semaphore = asyncio.Semaphore(max(1, self.max_in_flight))
+                task = asyncio.ensure_future(self._get_me(api_key, semaphore))
+                self._checking[api_key] = task
+                task.add_done_callback(
+                    lambda done, api_key=api_key: self._checking.pop(api_key, None)
+                    if self._checking.get(api_key) is done else None
+                )
+                checking[api_key] = task
+        if not checking:
+            return invalid
+        
+        # shield: cancelar uma conferência não derruba a requisição compartilhada
+        verdicts = await asyncio.gather(*(asyncio.shield(task) for task in checking.values()))
+        for api_key, verdict in zip(checking, verdicts):
+            if verdict is not None:
+                invalid[api_key] = verdict
+        return invalid
+    
+    async def _get_me(self, api_key: str, semaphore: asyncio.Semaphore):
+        """getMe de um token com timeout próprio; grava e devolve o veredito (None se válido ou indefinido)"""
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    MessageSender._post_async(api_key, 'getMe', {}), self.timeout
+                )
+            except asyncio.TimeoutError:
+                result = {'success': False, 'error': 'Timeout', 'error_code': None}
+        if result.get('success'):
+            self._cache[api_key] = (time.monotonic(), None)
+            metrics.bot_preflight.inc('valid')
+            return None
+        if result.get('error_code') in BotPreflight.INVALID_CODES:
+            verdict = (result.get('error_code'), result.get('error'))
+            self._cache[api_key] = (time.monotonic(), verdict)
+            metrics.bot_preflight.inc('invalid')
+            return verdict
+        metrics.bot_preflight.inc('unknown')
+        return None
+
+
+class CampaignControl:
+    """
+    Sinais de controle de uma campanha (pausar, retomar, cancelar, reconfigurar)
+    Cada sinal acorda imediatamente o loop de envio, inclusive durante a
+    espera entre lotes ou entre ciclos do loop infinito
+    """
+    
+    def __init__(self):
+        self.paused = False
+        self.cancelled = False
+        self.stopping = False  # desligamento do bot: encerra sem cancelar a campanha
+        self._signal = asyncio.Event()
+    
+    @property
+    def status(self) -> str:
+        """Estado gravado no backup (running, paused, cancelled ou stopped)"""
+        if self.stopping:
+            return 'stopped'
+        if self.cancelled:
+            return 'cancelled'
+        return 'paused' if self.paused else 'running'
+    
+    def pause(self):
+        self.paused = True
+        self._signal.set()
+    
+    def resume(self):
+        self.paused = False
+        self._signal.set()
+    
+    def cancel(self):
+        self.cancelled = True
+        self._signal.set()
+    
+    def stop(self):
+        """Encerra o loop para desligamento; a campanha é retomada no próximo início"""
+        self.stopping = True
+        self.cancel()
+    
+    def reconfigure(self):
+        """Configuração alterada: o loop recalcula a espera atual"""
+        self._signal.set()
+    
+    def should_continue(self) -> bool:
+        """Indica se novos envios podem começar"""
+        return not self.cancelled and not self.paused
+    
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Espera até timeout segundos (None = sem limite) ou até um sinal
+        Retorna True se acordou por um sinal
+        """
+        try:
+            await asyncio.wait_for(self._signal.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._signal.clear()
+        return True
+    
+    async def wait_resumed(self):
+        """Bloqueia enquanto a campanha estiver pausada (sem polling)"""
+        while self.paused and not self.cancelled:
+            await self.wait()
+    
+    async def sleep(self, duration) -> bool:
+        """
+        Espera duration segundos (número ou função, reavaliada a cada
+        reconfiguração); pausa ou cancelamento interrompem a espera
+        Retorna True se a espera terminou normalmente
+        """
+        started = time.monotonic()
+        while not self.cancelled and not self.paused:
+            total = duration() if callable(duration) else duration
+            remaining = total - (time.monotonic() - started)
+            if remaining <= 0:
+                return True
+            await self.wait(remaining)
+        return False
+
+
+class CampaignProgress:
+    """
+    Contadores da campanha para a mensagem de progresso única
+    A mensagem é editada no máximo a cada min_interval segundos, de modo que
+    o tráfego do bot administrador não cresce com o tamanho da planilha
+    """
+    
+    def __init__(self, min_interval: float = PROGRESS_UPDATE_INTERVAL,
+                 max_errors: int = PROGRESS_MAX_ERRORS):
+        self.min_interval = min_interval
+        self.sent = 0
+        self.errors = 0
+        self.requeued = 0
+        self.retried = 0
+        self.recent_errors: deque = deque(maxlen=max_errors)  # (chat_id, erro)
+        self.message_id: Optional[int] = None  # mensagem editada a cada atualização
+        self.started_at = time.monotonic()
+        self._last_update: Optional[float] = None
+    
+    def record(self, success: bool, chat_id: str, error: Optional[str] = None):
+        """Registra uma linha processada"""
+        if success:
+            self.sent += 1
+        else:
+            self.errors += 1
+            self.recent_errors.append((chat_id, error))
+    
+    def record_requeued(self):
+        """Registra linha devolvida à fila por limite de taxa"""
+        self.requeued += 1
+    
+    def record_retry(self):
+        """Registra reenvio agendado após falha transitória"""
+        self.retried += 1
+    
+    @property
+    def processed(self) -> int:
+        return self.sent + self.errors
+    
+    def rate_per_minute(self) -> float:
+        """Mensagens processadas por minuto desde o início (inclui as esperas entre lotes)"""
+        elapsed = time.monotonic() - self.started_at
+        return self.processed * 60 / elapsed if elapsed > 0 else 0.0
+    
+    def eta_seconds(self, pending: int) -> Optional[int]:
+        """Tempo estimado para as linhas pendentes (None sem dados suficientes)"""
+        rate = self.rate_per_minute()
+        if not rate:
+            return None
+        return int(pending * 60 / rate)
+    
+    def should_update(self, force: bool = False) -> bool:
+        """Indica se a mensagem de progresso pode ser editada agora"""
+        if force or self._last_update is None:
+            return True
+        return time.monotonic() - self._last_update >= self.min_interval
+    
+    def mark_updated(self):
+        self._last_update = time.monotonic()
+
+
+class StageTimer:
+    """
+    Tempo gasto em cada etapa do envio, acumulado por campanha
+    Cada etapa guarda [contagem, total, máximo] em segundos; medir custa
+    um perf_counter e uma soma, sem alocar nada por linha
+    Etapas por linha correm em paralelo: o total soma o tempo de todas as
+    linhas e pode passar do tempo de relógio do lote (send_batch)
+    """
+    
+    def __init__(self):
+        self.stages: Dict[str, List[float]] = {}
+    
+    def record(self, stage: str, seconds: float):
+        """Acumula uma medição da etapa"""
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+    
+    @contextmanager
+    def measure(self, stage: str):
+        """Mede o bloco (inclusive os awaits dentro dele)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+    
+    def to_dict(self) -> Dict[str, List[float]]:
+        """Formato gravado na configuração da campanha (JSON)"""
+        return {stage: list(entry) for stage, entry in self.stages.items()}
+    
+    @staticmethod
+    def from_dict(data: Optional[Dict[str, List[float]]]) -> 'StageTimer':
+        """Recria o acumulado de uma execução anterior (campanha retomada)"""
+        timer = StageTimer()
+        for stage, entry in (data or {}).items():
+            try:
+                count, total, longest = entry
+                timer.stages[stage] = [int(count), float(total), float(longest)]
+            except (TypeError, ValueError):
+                logger.error(f"Tempo de etapa inválido ignorado: {stage}")
+        return timer
+    
+    def rows(self) -> List[Tuple[str, int, float, float, float]]:
+        """(etapa, contagem, total s, média ms, máximo ms), maior total primeiro"""
+        rows = []
+        for stage, (count, total, longest) in self.stages.items():
+            average = total / count * 1000 if count else 0.0
+            rows.append((stage, int(count), round(total, 3), round(average, 2), round(longest * 1000, 2)))
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+    
+    def format_text(self) -> str:
+        """Tabela em texto monoespaçado (comando de administração)"""
+        lines = [f"{'etapa':<16}{'n':>8}{'total s':>10}{'média ms':>10}{'máx ms':>10}"]
+        for stage, count, total, average, longest in self.rows():
+            lines.append(f"{stage:<16}{count:>8}{total:>10.2f}{average:>10.2f}{longest:>10.1f}")
+        return '\n'.join(lines)
+
+
+class CallbackRouter:
+    """
+    Despacho de callback_data por tabela: chaves exatas em um dict e
+    prefixos em uma trie, onde vence o prefixo mais longo (independente da
+    ordem de registro); o restante do texto é convertido pelo tipo da rota
+    e passado ao handler como último argumento
+    """
+    
+    def __init__(self):
+        self.exact: Dict[str, Tuple[str, Callable]] = {}
+        self.trie: Dict[Any, Any] = {}  # caractere -> nó; None -> (nome, handler, tipo)
+    
+    def add(self, key: str, handler: Callable, name: Optional[str] = None):
+        """Rota para uma chave exata"""
+        if key in self.exact:
+            raise ValueError(f"Rota duplicada: {key}")
+        self.exact[key] = (name or key, handler)
+    
+    def add_prefix(self, prefix: str, handler: Callable, param: Callable[[str], Any] = str,
+                   name: Optional[str] = None):
+        """Rota para um prefixo; param converte o restante (ValueError = rota inválida)"""
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if None in node:
+            raise ValueError(f"Prefixo duplicado: {prefix}")
+        node[None] = (name or f"{prefix}*", handler, param)
+    
+    def resolve(self, data: str) -> Optional[Tuple[str, Callable, Any]]:
+        """(nome da rota, handler, parâmetro) ou None se não houver rota"""
+        route = self.exact.get(data)
+        if route is not None:
+            return route[0], route[1], None
+        
+        # callback_data tem no máximo 64 bytes: a busca na trie é limitada
+        node, match, end = self.trie, None, 0
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match, end = node[None], i + 1
+        if match is None:
+            return None
+        name, handler, param = match
+        try:
+            return name, handler, param(data[end:])
+        except (TypeError, ValueError):
+            return None
+    
+    async def dispatch(self, data: str, *args) -> bool:
+        """Chama handler(*args, parâmetro); False se o callback não tem rota"""
+        started = time.perf_counter()
+        route = self.resolve(data)
+        metrics.callback_routing_seconds.observe(time.perf_counter() - started)
+        if route is None:
+            metrics.callbacks_unknown.inc()
+            return False
+        name, handler, param = route
+        metrics.callbacks.inc(name)
+        await handler(*args, param)
+        return True
+
+
+class ReportSummary:
+    """Estatísticas do relatório, acumuladas linha a linha"""
+    
+    SENT_STATUS = '✅ Enviado'
+    
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.errors = 0
+        self.skipped = 0
+        self.dead = 0
+        self.invalid_bot = 0
+        self.errors_by_code: Counter = Counter()
+        self.errors_by_bot: Counter = Counter()
+        self.latencies: List[float] = []
+        self.timer: Optional['StageTimer'] = None  # tempo por etapa do envio (opcional)
+    
+    def add(self, row: Dict[str, Any]):
+        """Contabiliza uma linha do relatório"""
+        self.total += 1
+        status = row.get('status_envio')
+        if status == ReportSummary.SENT_STATUS:
+            self.sent += 1
+        elif status == MessageQueue.DUPLICATE_STATUS:
+            self.skipped += 1
+        elif status == MessageQueue.DEAD_STATUS:
+            self.dead += 1
+        elif status == MessageQueue.INVALID_BOT_STATUS:
+            self.invalid_bot += 1
+        else:
+            self.errors += 1
+            self.errors_by_code[row.get('codigo_erro') or '—'] += 1
+            self.errors_by_bot[row.get('api_key')] += 1
+        if row.get('latencia_ms') is not None:
+            self.latencies.append(row['latencia_ms'])
+    
+    @property
+    def success_rate(self) -> float:
+        """Percentual de linhas enviadas entre as tentadas (sem duplicadas, destinos nem bots inválidos)"""
+        attempted = self.sent + self.errors
+        return self.sent / attempted * 100 if attempted else 0.0
+    
+    def percentile(self, p: float) -> Optional[float]:
+        """Percentil da latência de envio em ms (nearest-rank)"""
+        if not self.latencies:
+            return None
+        self.latencies.sort()
+        rank = max(1, -(-len(self.latencies) * p // 100))
+        return self.latencies[int(rank) - 1]
+    
+    def rows(self) -> List[Tuple[Any, ...]]:
+        """Seção de resumo do relatório (rótulo/valor; tempo por etapa em cinco colunas)"""
+        rows = [
+            ('Total de linhas', self.total),
+            ('Enviadas', self.sent),
+            ('Erros', self.errors),
+            ('Duplicadas', self.skipped),
+            ('Destinos inválidos', self.dead),
+            ('Linhas de bots inválidos', self.invalid_bot),
+            ('Taxa de sucesso (%)', round(self.success_rate, 1))
+        ]
+        for p in (50, 95, 99):
+            rows.append((f'Latência p{p} (ms)', self.percentile(p)))
+        if self.errors_by_code:
+            rows.append(('Erros por código', ''))
+            rows.extend(self.errors_by_code.most_common())
+        if self.errors_by_bot:
+            rows.append(('Erros por bot (api_key)', ''))
+            rows.extend(self.errors_by_bot.most_common())
+        if self.timer and self.timer.stages:
+            rows.append(('Tempo por etapa', 'contagem', 'total (s)', 'média (ms)', 'máximo (ms)'))
+            rows.extend(self.timer.rows())
+        return rows
+
 
 class ReportGenerator:
-    """Gera relatórios de envio"""
+    """Gera relatórios de envio (CSV, CSV compactado ou XLSX)"""
+    
+    COLUMNS = [
+        'api_key', 'chat_id', 'mensagem', 'status_envio', 'data_hora_envio',
+        'erro', 'codigo_erro', 'latencia_ms'
+    ]
+    FORMATS = ('csv', 'csv.gz', 'xlsx')
     
     @staticmethod
-    def generate_report(messages: List[Dict[str, Any]], user_id: str) -> str:
+    def generate_report(messages: Iterable[Dict[str, Any]], user_id: str,
+                        fmt: str = REPORT_FORMAT) -> str:
         """
-        Gera relatório CSV com resultados do envio
+        Gera relatório com resultados do envio
         Retorna caminho do arquivo gerado
         """
+        return ReportGenerator.write_report(messages, user_id, fmt)[0]
+    
+    @staticmethod
+    def write_report(messages: Iterable[Dict[str, Any]], user_id: str,
+                     fmt: str = REPORT_FORMAT,
+                     timer: Optional['StageTimer'] = None) -> Tuple[Optional[str], Optional[ReportSummary]]:
+        """
+        Grava as linhas à medida que são lidas (sem montar DataFrame) e
+        acrescenta a seção de resumo (com o tempo por etapa, se informado);
+        retorna (caminho, resumo)
+        """
         try:
+            if fmt not in ReportGenerator.FORMATS:
+                raise ValueError(f"Formato de relatório inválido: {fmt}")
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"relatorio_envio_{user_id}_{timestamp}.csv"
+            filename = f"relatorio_envio_{user_id}_{timestamp}.{fmt}"
             filepath = os.path.join(REPORTS_DIR, filename)
             
-            # Criar DataFrame
-            df = pd.DataFrame(messages)
+            summary = ReportSummary()
+            summary.timer = timer
             
-            # Adicionar estatísticas
-            total = len(messages)
-            enviados = len([m for m in messages if m.get('status_envio') == '✅ Enviado'])
-            erros = total - enviados
+            def rows():
+                for message in messages:
+                    summary.add(message)
+                    yield [message.get(column) for column in ReportGenerator.COLUMNS]
             
-            # Salvar CSV
-            df.to_csv(filepath, index=False, encoding='utf-8-sig')
+            if fmt == 'xlsx':
+                ReportGenerator._write_xlsx(filepath, rows(), summary)
+            else:
+                ReportGenerator._write_csv(filepath, rows(), summary, compress=fmt == 'csv.gz')
             
             logger.info(f"Relatório gerado: {filepath}")
-            logger.info(f"Total: {total}, Enviados: {enviados}, Erros: {erros}")
+            logger.info(f"Total: {summary.total}, Enviados: {summary.sent}, Erros: {summary.errors}")
             
-            return filepath
+            return filepath, summary
             
         except Exception as e:
             logger.error(f"Erro ao gerar relatório: {e}")
-            return None
+            return None, None
+    
+    @staticmethod
+    def _write_csv(filepath: str, rows: Iterator[List[Any]], summary: ReportSummary, compress: bool = False):
+        """CSV (opcionalmente gzip) com o resumo após uma linha em branco"""
+        opener = gzip.open if compress else open
+        with opener(filepath, 'wt', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(ReportGenerator.COLUMNS)
+            writer.writerows(rows)
+            writer.writerow([])
+            writer.writerow(['Resumo'])
+            writer.writerows(summary.rows())
+    
+    @staticmethod
+    def _write_xlsx(filepath: str, rows: Iterator[List[Any]], summary: ReportSummary):
+        """XLSX em modo write-only, com o resumo em uma aba própria"""
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet('Envios')
+        sheet.append(ReportGenerator.COLUMNS)
+        for row in rows:
+            sheet.append(row)
+        summary_sheet = workbook.create_sheet('Resumo')
+        for row in summary.rows():
+            summary_sheet.append(list(row))
+        workbook.save(filepath)
+    
+    @staticmethod
+    async def generate_campaign_report(store: 'CampaignStore', campaign_id: str, user_id: str,
+                                       fmt: str = REPORT_FORMAT,
+                                       timer: Optional['StageTimer'] = None) -> Tuple[Optional[str], Optional[ReportSummary]]:
+        """
+        Relatório da campanha lido do banco e gravado em uma thread, sem
+        bloquear o event loop (as demais campanhas seguem enviando)
+        """
+        return await asyncio.to_thread(
+            ReportGenerator.write_report, store.report_rows(campaign_id), user_id, fmt, timer
+        )
+
+class Session:
+    """
+    Sessão de um usuário, em __slots__ (sem um dict por usuário)
+    Mantém o acesso no estilo dict usado pelos handlers (get, [], in, update);
+    get devolve o padrão informado também quando o valor é None
+    """
+    
+    # Gravados no banco (sessões autenticadas); os demais só existem em execução
+    PERSISTED = ('authenticated', 'language', 'login_attempts', 'state', 'current_config',
+                 'selected_template', 'temp_template', 'campaign_id', 'rejected_rows', 'last_activity',
+                 'interval_minutes', 'messages_per_cycle')
+    RUNTIME = ('messages_queue', 'control', 'progress', 'stage_timer',
+               'ingesting', 'sending_active', 'sending_paused')
+    __slots__ = ('user_id', 'touched') + PERSISTED + RUNTIME
+    
+    # Estados que dependem da fila em memória (voltam ao menu se ela não puder ser recriada)
+    QUEUE_STATES = ('file_uploaded', 'awaiting_interval', 'awaiting_batch_size', 'config_summary', 'sending')
+    
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.touched = time.monotonic()  # último acesso (ordem de descarte)
+        self.authenticated = False
+        self.language = 'pt-BR'
+        self.login_attempts = 0
+        self.state = 'login'
+        self.current_config: Dict[str, Any] = {}
+        self.last_activity = datetime.now().isoformat()
+        self.selected_template: Optional[str] = None
+        self.temp_template: Optional[Dict[str, Any]] = None
+        self.campaign_id: Optional[str] = None
+        self.rejected_rows: Optional[Dict[str, int]] = None
+        self.interval_minutes: Optional[int] = None  # configuração do loop infinito
+        self.messages_per_cycle: Optional[int] = None
+        self.messages_queue: Optional['MessageQueue'] = None
+        self.control: Optional['CampaignControl'] = None
+        self.progress: Optional['CampaignProgress'] = None
+        self.stage_timer: Optional['StageTimer'] = None
+        self.ingesting = False
+        self.sending_active = False
+        self.sending_paused = False
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None)
+        return default if value is None else value
+    
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+    
+    def __setitem__(self, key: str, value: Any):
+        setattr(self, key, value)
+    
+    def __contains__(self, key: str) -> bool:
+        return getattr(self, key, None) is not None
+    
+    def update(self, updates: Dict[str, Any]):
+        for key, value in updates.items():
+            setattr(self, key, value)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Campos persistidos (sem fila, controle, progresso nem medições)"""
+        return {key: getattr(self, key) for key in Session.PERSISTED}
+    
+    @staticmethod
+    def from_dict(user_id: str, data: Dict[str, Any]) -> 'Session':
+        session = Session(user_id)
+        for key in Session.PERSISTED:
+            if key in data:
+                setattr(session, key, data[key])
+        return session
+
 
 class UserSession:
-    """Gerencia sessões de usuário"""
+    """
+    Gerencia sessões de usuário
+    Ficam em memória em ordem de uso (LRU): as não autenticadas expiram
+    após SESSION_TTL sem atividade e são as primeiras a sair quando há mais
+    de SESSION_MAX_ENTRIES sessões. As autenticadas são gravadas no banco
+    (SESSION_PERSIST) e carregadas no primeiro acesso após um reinício
+    """
     
-    def __init__(self):
-        self.sessions = {}
-    
-    def get_session(self, user_id: str) -> Dict[str, Any]:
-        """Obtém sessão do usuário"""
-        if user_id not in self.sessions:
-            self.sessions[user_id] = {
-                'authenticated': False,
-                'language': 'pt-BR',
-                'login_attempts': 0,
-                'state': 'login',
-                'messages_queue': [],
-                'current_config': {},
-                'sending_active': False,
-                'sending_paused': False,
-                'last_activity': datetime.now().isoformat()
-            }
-        return self.sessions[user_id]
+    def __init__(self, persist: bool = SESSION_PERSIST, ttl: float = SESSION_TTL,
+                 max_entries: int = SESSION_MAX_ENTRIES):
+        self.persist = persist
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sessions: 'OrderedDict[str, Session]' = OrderedDict()
+    
+    def get_session(self, user_id: str) -> Session:
+        """Obtém sessão do usuário (do banco no primeiro acesso, se persistida)"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self._load(user_id) or Session(user_id)
+            self.sessions[user_id] = session
+            self._evict(time.monotonic(), keep=user_id)
+        else:
+            self.sessions.move_to_end(user_id)
+        session.touched = time.monotonic()
+        return session
     
     def update_session(self, user_id: str, updates: Dict[str, Any]):
-        """Atualiza sessão do usuário"""
+        """Atualiza sessão do usuário (grava no banco se um campo persistido mudou)"""
         session = self.get_session(user_id)
         session.update(updates)
-        session['last_activity'] = datetime.now().isoformat()
+        session.last_activity = datetime.now().isoformat()
+        if self.persist and session.authenticated and not updates.keys().isdisjoint(Session.PERSISTED):
+            self._save(session)
     
     def clear_session(self, user_id: str):
-        """Limpa sessão do usuário"""
-        if user_id in self.sessions:
+        """Limpa sessão do usuário (também a persistida)"""
+        self.sessions.pop(user_id, None)
+        if self.persist:
+            try:
+                CampaignStore.default().delete_session(user_id)
+            except Exception as e:
+                logger.error(f"Erro ao remover sessão de {user_id}: {e}")
+    
+    @staticmethod
+    def _evictable(session: Session) -> bool:
+        return not session.authenticated and not session.sending_active and session.campaign_id is None
+    
+    def _evict(self, now: float, keep: Optional[str] = None):
+        """
+        Descarta não autenticadas expiradas e, acima do limite, as menos usadas
+        A sessão keep (a que acabou de ser criada) nunca é descartada
+        """
+        # Percorre só o início da ordem de uso: o custo não cresce com o total
+        expired = now - self.ttl
+        excess = len(self.sessions) - self.max_entries
+        victims = []
+        for user_id, session in self.sessions.items():
+            if session.touched > expired and len(victims) >= excess:
+                break
+            if user_id != keep and self._evictable(session):
+                victims.append(user_id)
+        for user_id in victims:
             del self.sessions[user_id]
+    
+    def _load(self, user_id: str) -> Optional[Session]:
+        """Sessão gravada, com o rascunho da campanha recriado a partir do banco"""
+        if not self.persist:
+            return None
+        try:
+            data = CampaignStore.default().load_session(user_id)
+            if data is None:
+                return None
+            session = Session.from_dict(user_id, data)
+            UserSession._restore_draft(session)
+            return session
+        except Exception as e:
+            logger.error(f"Erro ao carregar sessão de {user_id}: {e}")
+            return None
+    
+    @staticmethod
+    def _restore_draft(session: Session):
+        """
+        Recria a fila do rascunho lido por completo antes do reinício; sem ele,
+        estados que dependem da fila voltam ao menu (campanhas em envio são
+        retomadas à parte pelo supervisor)
+        """
+        if session.campaign_id:
+            store = CampaignStore.default()
+            campaign = store.get_campaign(session.campaign_id)
+            if campaign and campaign['status'] == 'draft' and campaign['config'].get('ingested'):
+                session.messages_queue = MessageQueue(store, campaign['id'])
+                session.ingesting = False
+                return
+            session.campaign_id = None
+        if session.state in Session.QUEUE_STATES:
+            session.state = 'main_menu'
+    
+    def _save(self, session: Session):
+        try:
+            CampaignStore.default().save_session(session.user_id, session.to_dict())
+        except Exception as e:
+            logger.error(f"Erro ao gravar sessão de {session.user_id}: {e}")
+
 
 def validate_number(text: str, min_val: int = 1, max_val: int = None) -> Optional[int]:
     """Valida se texto é um número válido dentro dos limites"""
@@ -349,36 +2437,98 @@ def format_duration(seconds: int) -> str:
 
 def sanitize_filename(filename: str) -> str:
     """Remove caracteres inválidos do nome do arquivo"""
-    import re
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
+def atomic_write(path: str, content: str):
+    """
+    Grava arquivo de forma atômica: escreve em arquivo temporário no mesmo
+    diretório, faz fsync e renomeia sobre o destino
+    Uma queda no meio da gravação mantém a versão anterior intacta
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    # Persistir a renomeação (nem todo sistema permite fsync em diretório)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
 
 class MessageTemplate:
     """Classe para gerenciar templates de mensagens"""
     
     TEMPLATES_FILE = 'message_templates.json'
     
+    # Cache em memória: o arquivo só é relido quando muda (mtime/tamanho)
+    _cache: Optional[Dict[str, Any]] = None
+    _cache_key: Optional[Tuple] = None
+    
     @staticmethod
-    def load_templates() -> Dict[str, Any]:
-        """Carrega templates salvos"""
+    def _file_key() -> Optional[Tuple]:
+        """Identifica a versão do arquivo de templates (None se não existe)"""
         try:
-            if os.path.exists(MessageTemplate.TEMPLATES_FILE):
+            stat = os.stat(MessageTemplate.TEMPLATES_FILE)
+        except FileNotFoundError:
+            return None
+        return (os.path.abspath(MessageTemplate.TEMPLATES_FILE), stat.st_mtime_ns, stat.st_size)
+    
+    @staticmethod
+    def _templates() -> Dict[str, Any]:
+        """Templates em cache (somente leitura), recarregados se o arquivo mudou"""
+        key = MessageTemplate._file_key()
+        if MessageTemplate._cache is not None and key == MessageTemplate._cache_key:
+            return MessageTemplate._cache
+        
+        templates = {}
+        try:
+            if key is not None:
                 with open(MessageTemplate.TEMPLATES_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
+                    templates = json.load(f)
         except Exception as e:
             logger.error(f"Erro ao carregar templates: {e}")
             return {}
+        
+        MessageTemplate._cache = templates
+        MessageTemplate._cache_key = key
+        return templates
+    
+    @staticmethod
+    def invalidate_cache():
+        """Descarta o cache (o próximo acesso relê o arquivo)"""
+        MessageTemplate._cache = None
+        MessageTemplate._cache_key = None
+    
+    @staticmethod
+    def load_templates() -> Dict[str, Any]:
+        """Carrega templates salvos (cópia que pode ser alterada)"""
+        return copy.deepcopy(MessageTemplate._templates())
     
     @staticmethod
     def save_templates(templates: Dict[str, Any]) -> bool:
-        """Salva templates"""
+        """Salva templates e atualiza o cache"""
         try:
-            with open(MessageTemplate.TEMPLATES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(templates, f, ensure_ascii=False, indent=2)
+            atomic_write(MessageTemplate.TEMPLATES_FILE, json.dumps(templates, ensure_ascii=False, indent=2))
+            MessageTemplate._cache = copy.deepcopy(templates)
+            MessageTemplate._cache_key = MessageTemplate._file_key()
             logger.info("Templates salvos com sucesso")
             return True
         except Exception as e:
+            MessageTemplate.invalidate_cache()
             logger.error(f"Erro ao salvar templates: {e}")
             return False
     
@@ -420,15 +2570,13 @@ class MessageTemplate:
     
     @staticmethod
     def get_template(name: str) -> Optional[Dict[str, Any]]:
-        """Obtém template específico"""
-        templates = MessageTemplate.load_templates()
-        return templates.get(name)
+        """Obtém template específico (do cache; não deve ser alterado)"""
+        return MessageTemplate._templates().get(name)
     
     @staticmethod
     def list_templates() -> List[str]:
         """Lista nomes dos templates"""
-        templates = MessageTemplate.load_templates()
-        return list(templates.keys())
+        return list(MessageTemplate._templates().keys())
 
 
 class MessageBuilder: